@@ -2,22 +2,42 @@
 import datetime
 import logging
 import random
+import re
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import HTMLResponse
+from starlette.responses import HTMLResponse, StreamingResponse
 from fastapi.responses import JSONResponse
-from starlette.staticfiles import StaticFiles
 
-from backend import config
-from backend.auth import token_cookie_guard
-from backend.db import get_db, User, SecretSantaPair, Gift, Vote
-from backend.gifts import get_receiver, get_gift_list, GiftOut, UserGiftList, get_own_gift_list, add_or_update_gift
+from backend import config, events, preview_worker, http_client, renditions
+from backend.auth import AuthMiddleware, Principal, PUBLIC, STATIC
+from backend.db import get_async_db, async_engine, AsyncSessionLocal, User, Gift, Vote
+from backend.groups import resolve_group_id, get_group_members, is_group_member
+from backend.response_cache import bump_version, cached_json_response, get_version
+from backend.static_files import CONTENT_HASHED_PATH, PreviewStaticFiles
+from backend.gifts import get_gift_lists, GiftOut, UserGiftList, filter_own_gifts, add_or_update_gift, \
+    get_vote_totals, user_vote_state, get_renditions, get_gift, get_receiver_name, get_pairs_with_names, PairOut, \
+    preview_url
 from pydantic import BaseModel
 from typing import List
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    preview_worker.requeue_pending_previews()
+    await events.broker.start()
+    yield
+    await events.broker.stop()
+    await async_engine.dispose()
+    preview_worker.shutdown()
+    http_client.close_client()
+    renditions.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # set loglevel to info
 logging.basicConfig(level=logging.INFO)
@@ -27,6 +47,19 @@ origins = [
     "https://localhost:3000"
 ]
 
+# added before CORS, so CORS is the outer middleware and also answers preflights and 401s
+app.add_middleware(
+    AuthMiddleware,
+    routes=[
+        ("/api/healthcheck", PUBLIC),
+        # only the content hashed files of the preview store and the default preview are served without a session,
+        # user photos and the legacy previews with short numeric names stay protected
+        (re.compile("/static/" + CONTENT_HASHED_PATH.pattern), STATIC),
+        ("/" + config.default_preview_image_path, STATIC),
+    ],
+    admin_only=True,
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -35,13 +68,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# add static for static/preview
-app.mount("/static", StaticFiles(directory=str(config.static.absolute())), name="static")
-
-
-@app.middleware("http")
-async def middleware_wrapper(request: Request, call_next):
-    return await token_cookie_guard(request, call_next, admin_only=True, protected_route_prefixes=None)
+# add static for static/preview, content hashed previews are cached for a year and can be handed to nginx
+app.mount("/static", PreviewStaticFiles(directory=str(config.static.absolute()), delivery=config.static_delivery,
+                                        accel_redirect_prefix=config.static_accel_redirect_prefix), name="static")
 
 
 @app.get("/api/healthcheck")
@@ -50,9 +79,9 @@ def read_root():
 
 
 @app.get("/api/auth")
-def check_auth(request: Request, db: Session = Depends(get_db)):
+def check_auth(request: Request):
     try:
-        user = get_current_db_user(request, db)
+        user = get_current_principal(request)
     except HTTPException as exc:
         # ensure frontend receives a JSON object with a success flag and message
         return JSONResponse(status_code=exc.status_code, content={"success": False, "message": str(exc.detail)})
@@ -60,56 +89,77 @@ def check_auth(request: Request, db: Session = Depends(get_db)):
     return JSONResponse(content={"success": True, "username": user.name})
 
 
-def get_current_db_user(request: Request, db: Session) -> User:
+def get_current_principal(request: Request) -> Principal:
     """
-    Returns the SQLAlchemy User object for the authenticated user in request.state.user.
-    Raises HTTPException(401) if not found or not authenticated.
+    Returns the authenticated user from the verified session in request.state.principal, without a database query.
+    Raises HTTPException(401) if not authenticated.
     """
-    username = getattr(request.state, "user", None)
-    if not username:
+    principal = getattr(request.state, "principal", None)
+    if principal is None:
         raise HTTPException(status_code=401, detail="User not authenticated")
-    user = db.query(User).filter_by(name=username).first()
+    return principal
+
+
+async def get_current_db_user(request: Request, db: AsyncSession) -> User:
+    """
+    Returns the SQLAlchemy User object for the authenticated user, only needed by endpoints working with the row.
+    Raises HTTPException(401) if not found or not authenticated.
+    """
+    principal = get_current_principal(request)
+    user = await db.get(User, principal.id)
     if not user:
         raise HTTPException(status_code=401, detail="User not found in database")
     return user
 
 
 @app.get("/api/welcome", response_class=HTMLResponse)
-async def welcome(request: Request, db: Session = Depends(get_db)):
-    user_obj = get_current_db_user(request, db)
-    username = user_obj.name
+async def welcome(request: Request):
+    username = get_current_principal(request).name
     return f"<h1>Welcome to Secret Santa, {username}!</h1><p>This is the home page.</p>"
 
 
 @app.get("/api/users", response_model=List[str])
-def list_users(db: Session = Depends(get_db)):
-    users = db.query(User).all()
-    return [u.name for u in users]
-
-
-@app.get("/api/gift-lists", response_model=List[UserGiftList])
-def get_gift_lists_for_current_year(request: Request, db: Session = Depends(get_db)):
-    user = get_current_db_user(request, db)
-    logging.info(f"Fetching gift lists for user: {user.name}")
-    current_year = datetime.datetime.now().year
+async def list_users(request: Request, group_id: int | None = None, db: AsyncSession = Depends(get_async_db)):
+    group_id = await resolve_group_id(get_current_principal(request), db, group_id)
 
-    receiver = get_receiver(user, db, current_year)
-    gift_receiver_name = receiver.name if receiver else "?"
+    async def build():
+        return [u.name for u in await get_group_members(group_id, db)]
 
-    result = [get_own_gift_list(user, db, current_year)]
+    version = await get_version(db, group_id)
+    return await cached_json_response(request, ("users", group_id), version, build)
 
-    # get all users except admin
-    other_users = db.query(User).filter(User.name != "admin").all()
-    for other_user in sorted(other_users, key=lambda u: u.name):
-        gift_list = get_gift_list(other_user, db, current_year)
 
-        if other_user.name == user.name:
-            continue
-        if other_user.name == gift_receiver_name:
-            result.insert(0, gift_list)
-        else:
-            result.append(gift_list)
-    return result
+@app.get("/api/gift-lists", response_model=List[UserGiftList])
+async def get_gift_lists_for_current_year(request: Request, group_id: int | None = None,
+                                         db: AsyncSession = Depends(get_async_db)):
+    user = get_current_principal(request)
+    current_year = datetime.datetime.now().year
+    group_id = await resolve_group_id(user, db, group_id)
+
+    async def build():
+        logging.info(f"Building gift lists for user: {user.name}")
+        gift_receiver_name = await get_receiver_name(user, db, current_year, group_id=group_id) or "?"
+
+        # get all members of the group, their gift lists are loaded at once
+        users = await get_group_members(group_id, db)
+        if user.id not in {u.id for u in users}:
+            users.append(await get_current_db_user(request, db))
+        gift_lists = await get_gift_lists(users, db, current_year, current_user=user, group_id=group_id)
+
+        result = [filter_own_gifts(gift_lists[user.id])]
+        for other_user in users:
+            if other_user.name == user.name:
+                continue
+            gift_list = gift_lists[other_user.id]
+            if other_user.name == gift_receiver_name:
+                result.insert(0, gift_list)
+            else:
+                result.append(gift_list)
+        return result
+
+    # the lists depend on the user (own gifts, votes, receiver first), so responses are cached per user
+    version = await get_version(db, group_id)
+    return await cached_json_response(request, ("gift-lists", user.id, group_id, current_year), version, build)
 
 
 # --- Slogan endpoint ---
@@ -132,21 +182,18 @@ def get_card_slogan():
 
 # --- Get gift receiver for current user ---
 @app.get("/api/receiver")
-def get_gift_receiver(request: Request, db: Session = Depends(get_db)):
-    logging.info("/receiver endpoint called")
-    user_obj = get_current_db_user(request, db)
+async def get_gift_receiver(request: Request, group_id: int | None = None,
+                            db: AsyncSession = Depends(get_async_db)):
+    user_obj = get_current_principal(request)
     current_year = datetime.datetime.now().year
-    logging.info(f"Current user: {getattr(user_obj, 'name', None)}, current year: {current_year}")
-    pairs = db.query(SecretSantaPair).filter_by(giver_id=user_obj.id, year=current_year).all()
-    logging.info(f"Found {len(pairs)} pairs with users: {[(pair.giver_id, pair.receiver_id, pair.year) for pair in pairs]}")
+    group_id = await resolve_group_id(user_obj, db, group_id)
+
+    async def build():
+        receiver_name = await get_receiver_name(user_obj, db, current_year, group_id=group_id)
+        return {"gift_receiver_name": receiver_name or "?"}
 
-    if pairs:
-        pair = pairs[0]
-        receiver = db.query(User).filter_by(id=pair.receiver_id).first()
-        logging.info(f"Receiver found: {getattr(receiver, 'name', None)}")
-        return {"gift_receiver_name": receiver.name}
-    logging.info("No receiver found, returning '?'")
-    return {"gift_receiver_name": "?"}
+    version = await get_version(db, group_id)
+    return await cached_json_response(request, ("receiver", user_obj.id, group_id, current_year), version, build)
 
 
 class GiftCreate(BaseModel):
@@ -154,21 +201,25 @@ class GiftCreate(BaseModel):
     title: str
     description: str = ""
     link: str = ""
+    group_id: int | None = None
 
 
 @app.post("/api/gifts/add", response_model=GiftOut)
-def add_gift(gift: GiftCreate, request: Request, db: Session = Depends(get_db)):
-    user_obj = get_current_db_user(request, db)
-    created_for_user = db.query(User).filter_by(name=gift.created_for).first()
-    if not created_for_user:
+async def add_gift(gift: GiftCreate, request: Request, db: AsyncSession = Depends(get_async_db)):
+    user_obj = get_current_principal(request)
+    group_id = await resolve_group_id(user_obj, db, gift.group_id)
+    result = await db.execute(select(User).where(User.name == gift.created_for))
+    created_for_user = result.scalars().first()
+    if not created_for_user or not await is_group_member(created_for_user.id, group_id, db):
         raise HTTPException(status_code=404, detail="User not found")
 
-    return add_or_update_gift(
+    return await add_or_update_gift(
         db=db,
         title=gift.title,
         created_by=user_obj,
         created_for=created_for_user,
-        link=gift.link
+        link=gift.link,
+        group_id=group_id
     )
 
 
@@ -178,15 +229,15 @@ class GiftUpdate(BaseModel):
 
 
 @app.patch("/api/gifts/{gift_id}", response_model=GiftOut)
-def update_gift(gift_id: int, update: GiftUpdate, request: Request, db: Session = Depends(get_db)):
-    user_obj = get_current_db_user(request, db)
-    gift = db.query(Gift).filter_by(id=gift_id).first()
+async def update_gift(gift_id: int, update: GiftUpdate, request: Request, db: AsyncSession = Depends(get_async_db)):
+    user_obj = get_current_principal(request)
+    gift = await get_gift(gift_id, db)
     if not gift:
         raise HTTPException(status_code=404, detail="Gift not found")
-    if gift.created_by != user_obj:
+    if gift.created_by_id != user_obj.id:
         raise HTTPException(status_code=403, detail="Not allowed")
 
-    return add_or_update_gift(
+    return await add_or_update_gift(
         db=db,
         gift_pk=gift_id,
         title=update.title,
@@ -197,65 +248,100 @@ def update_gift(gift_id: int, update: GiftUpdate, request: Request, db: Session
 
 
 @app.delete("/api/gifts/{gift_id}")
-def delete_gift(gift_id: int, request: Request, db: Session = Depends(get_db)):
-    user_obj = get_current_db_user(request, db)
-    gift = db.query(Gift).filter_by(id=gift_id).first()
+async def delete_gift(gift_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
+    user_obj = get_current_principal(request)
+    gift = await db.get(Gift, gift_id)
     if not gift:
         raise HTTPException(status_code=404, detail="Gift not found")
-    if gift.created_by != user_obj:
+    if gift.created_by_id != user_obj.id:
         raise HTTPException(status_code=403, detail="Not allowed")
-    db.delete(gift)
-    db.commit()
+    await db.delete(gift)
+    await bump_version(db, gift.group_id)
+    await db.commit()
+    await events.apublish(*events.gift_event(events.GIFT_DELETED, gift.id, gift.group_id, gift.created_by_id,
+                                             gift.created_for_id))
     return {"success": True}
 
 
+@app.get("/api/gifts/{gift_id}/preview")
+async def get_gift_preview(gift_id: int, request: Request, db: AsyncSession = Depends(get_async_db)):
+    """
+    Returns the preview state of a gift, clients poll this after adding a gift until the preview is ready.
+    Surprise gifts others added for the user are answered like missing ones.
+    """
+    user_obj = get_current_principal(request)
+    gift = await db.get(Gift, gift_id)
+    if not gift or (gift.group_id is not None and not await is_group_member(user_obj.id, gift.group_id, db)):
+        raise HTTPException(status_code=404, detail="Gift not found")
+    if gift.created_for_id == user_obj.id and gift.created_by_id != user_obj.id:
+        raise HTTPException(status_code=404, detail="Gift not found")
+    return {
+        "pk": gift.id,
+        "preview_status": preview_worker.preview_status(gift),
+        "preview_image_path": preview_url(gift.preview_image_path),
+        "renditions": get_renditions(gift.preview_image_path)
+    }
+
+
 class VoteRequest(BaseModel):
     vote_type: str
 
 
 @app.post("/api/gifts/{gift_id}/vote")
-def vote_gift(gift_id: int, vote: VoteRequest, request: Request, db: Session = Depends(get_db)):
-    user_obj = get_current_db_user(request, db)
-    gift = db.query(Gift).filter_by(id=gift_id).first()
-    if not gift:
+async def vote_gift(gift_id: int, vote: VoteRequest, request: Request, db: AsyncSession = Depends(get_async_db)):
+    user_obj = get_current_principal(request)
+    gift = await db.get(Gift, gift_id)
+    if not gift or (gift.group_id is not None and not await is_group_member(user_obj.id, gift.group_id, db)):
         raise HTTPException(status_code=404, detail="Gift not found")
     vote_value = 1 if vote.vote_type == "up" else -1
-    current_vote = db.query(Vote).filter_by(gift=gift, user=user_obj).first()
+    result = await db.execute(select(Vote).where(Vote.gift_id == gift.id, Vote.user_id == user_obj.id))
+    current_vote = result.scalars().first()
     if current_vote:
         if current_vote.value == vote_value:
-            db.delete(current_vote)
-            db.commit()
-            user_vote = "inactive"
+            await db.delete(current_vote)
+            user_vote = user_vote_state(None)
         else:
             current_vote.value = vote_value
-            db.commit()
-            user_vote = "up" if vote_value == 1 else "down"
+            user_vote = user_vote_state(vote_value)
     else:
-        new_vote = Vote(gift=gift, user=user_obj, value=vote_value)
-        db.add(new_vote)
-        db.commit()
-        user_vote = "up" if vote_value == 1 else "down"
-    # Update vote count (sum all votes for this gift)
-    total_votes = db.query(Vote).filter_by(gift=gift).with_entities(Vote.value).all()
-    vote_count = sum(v[0] for v in total_votes)
+        db.add(Vote(gift_id=gift.id, user_id=user_obj.id, value=vote_value))
+        user_vote = user_vote_state(vote_value)
+    await db.flush()
+    # sum all votes for this gift in the database instead of loading every vote row
+    vote_count = (await get_vote_totals([gift.id], db)).get(gift.id, 0)
+    await bump_version(db, gift.group_id)
+    await db.commit()
+    await events.apublish(*events.gift_event(events.VOTE_CHANGED, gift.id, gift.group_id, gift.created_by_id,
+                                             gift.created_for_id, {"votes": vote_count}))
     return {"success": True, "vote_count": vote_count, "user_vote": user_vote}
 
 
-@app.get("/api/pairing")
-def show_current_pairing(request: Request, db: Session = Depends(get_db)):
+@app.get("/api/events")
+async def stream_events(request: Request, group_id: int | None = None):
+    """
+    Server-Sent Events with the changes of the group's gifts and votes. Clients fetch /api/gift-lists on the
+    first (and every later) resync event and patch their state with the others.
+    """
+    user = get_current_principal(request)
+    # a short session only for the membership check, the stream must not hold a connection
+    async with AsyncSessionLocal() as db:
+        group_id = await resolve_group_id(user, db, group_id)
+    return StreamingResponse(
+        events.stream(events.group_channel(group_id), user.id, request.is_disconnected),
+        media_type="text/event-stream",
+        # no buffering in nginx, the events have to reach the client immediately
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/pairing", response_model=List[PairOut])
+async def show_current_pairing(request: Request, year: int | None = None, group_id: int | None = None,
+                               db: AsyncSession = Depends(get_async_db)):
     """
-    Show the current pairing for all users.
-    :param request:
-    :param db:
-    :return:
+    Shows the pairing of all groups (or one group) for the year, defaults to the current year. Admin only.
     """
-    pairings = SecretSantaPair.query.filter_by(year=datetime.datetime.now().year).all()
-    result = []
-    for pairing in pairings:
-        giver = db.query(User).filter_by(id=pairing.giver_id).first()
-        receiver = db.query(User).filter_by(id=pairing.receiver_id).first()
-        result.append({
-            "giver": giver.name,
-            "receiver": receiver.name
-        })
-    return result
+    if not get_current_principal(request).is_admin:
+        raise HTTPException(status_code=403, detail="Admin only")
+    if year is None:
+        year = datetime.datetime.now().year
+    return await get_pairs_with_names(db, year, group_id)
@@ -1,111 +1,370 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
 import logging
-from multiprocessing.util import MAXFD
-from typing import Optional
-
-from fastapi import HTTPException
-from starlette.requests import Request
-from starlette.responses import RedirectResponse, JSONResponse
-
-credentials = {
-    "admin": "5cf4c2e2-3e2b-4d3a-9f4b-8f0e5c6d7a8b",
-    "Max": "numberone",
-    "Anka": "sweety",
-    "Roswitha": "bigMama",
-    "Jürgen": "daddyCool",
-    "Katharina": "mostlyNaked",
-    "Christoph": "bigDickEnergy"
-}
-
-def get_token_user(token: str) -> Optional[str]:
+import os
+import re
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+from urllib.parse import parse_qs
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from starlette.requests import Request, cookie_parser
+from starlette.responses import RedirectResponse, JSONResponse, Response
+
+from backend import config
+from backend.db import SessionLocal, User
+
+logger = logging.getLogger(__name__)
+
+SESSION_COOKIE = "APP_SESSION"
+LEGACY_TOKEN_COOKIE = "APP_TOKEN"
+
+# the index is reloaded at the latest after this time, to pick up tokens changed by other processes
+TOKEN_INDEX_TTL_SECONDS = 60
+# number of bytes of the token hash used as dict key
+INDEX_KEY_BYTES = 8
+
+
+def hash_token(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+@dataclass(frozen=True)
+class Principal:
+    """The authenticated user as known from the session, without loading the database row."""
+    id: int
+    name: str
+
+    @property
+    def is_admin(self) -> bool:
+        return self.name == "admin"
+
+
+class TokenIndex:
+    """
+    In-memory index of token hashes to user names, loaded from the users.token column.
+    Lookups are a single dict access on a prefix of the hash instead of a scan over all users,
+    the full hash is then compared in constant time. The index is invalidated when users are
+    written through the ORM in this process and reloaded after TOKEN_INDEX_TTL_SECONDS in any case.
+    """
+
+    def __init__(self, ttl_seconds: float = TOKEN_INDEX_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._index: dict[bytes, list[tuple[bytes, Principal]]] | None = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._index = None
+
+    def _load(self) -> dict[bytes, list[tuple[bytes, Principal]]]:
+        db = SessionLocal()
+        try:
+            rows = db.query(User.id, User.name, User.token).filter(User.token.isnot(None)).all()
+        finally:
+            db.close()
+        index = {}
+        for user_id, name, token in rows:
+            token_hash = hash_token(token)
+            index.setdefault(token_hash[:INDEX_KEY_BYTES], []).append((token_hash, Principal(user_id, name)))
+        return index
+
+    def _is_stale(self) -> bool:
+        return self._index is None or time.monotonic() - self._loaded_at > self.ttl_seconds
+
+    def _get_index(self) -> dict[bytes, list[tuple[bytes, Principal]]]:
+        index = self._index
+        if self._is_stale():
+            with self._lock:
+                index = self._index
+                if self._is_stale():
+                    index = self._load()
+                    self._index = index
+                    self._loaded_at = time.monotonic()
+        return index
+
+    @staticmethod
+    def _find(index: dict[bytes, list[tuple[bytes, Principal]]], token: str) -> Optional[Principal]:
+        token_hash = hash_token(token)
+        for stored_hash, principal in index.get(token_hash[:INDEX_KEY_BYTES], ()):
+            if hmac.compare_digest(stored_hash, token_hash):
+                return principal
+        return None
+
+    def lookup(self, token: str) -> Optional[Principal]:
+        return self._find(self._get_index(), token)
+
+    async def alookup(self, token: str) -> Optional[Principal]:
+        """lookup for the event loop, a reload queries the database in a worker thread instead of blocking it."""
+        index = self._index
+        if index is None or self._is_stale():
+            index = await asyncio.to_thread(self._get_index)
+        return self._find(index, token)
+
+
+token_index = TokenIndex()
+
+
+@event.listens_for(Session, "after_flush")
+def _track_user_changes(session, flush_context):
+    if any(isinstance(obj, User) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info["users_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_token_index(session):
+    # only after the commit, a reload before could cache the old tokens again
+    if session.info.pop("users_changed", False):
+        token_index.invalidate()
+
+
+def get_token_user(token: Optional[str]) -> Optional[Principal]:
     """Return the user associated with the given token, or None if not found."""
-    for user, user_token in credentials.items():
-        if token == user_token:
-            return user
-    return None
+    if not token:
+        return None
+    return token_index.lookup(token)
 
 
-def user_is_allowed_to_access(token: str, admin_only: bool = True, allow_users: Optional[list[str]] = None) -> tuple[
-    bool, str]:
-    """Check if the provided token is valid. Returns are the user and if the user is allowed to access the site"""
-    token_user = get_token_user(token)
+async def aget_token_user(token: Optional[str]) -> Optional[Principal]:
+    """get_token_user for the event loop, see TokenIndex.alookup."""
+    if not token:
+        return None
+    return await token_index.alookup(token)
 
-    if token_user is None:
-        logging.warning("Invalid token attempt, token not found in credentials.")
-        return False, ""
 
-    if token_user is not None:
-        if admin_only and token_user == "admin":
-            logging.info("Admin access granted.")
-            return True, "admin"
+def _load_session_secret() -> bytes:
+    secret = os.environ.get("SESSION_SECRET")
+    if secret:
+        return secret.encode("utf-8")
+    path = config.session_secret_path
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # exclusive create, so concurrently starting workers agree on one secret
+        try:
+            with open(path, "xb") as secret_file:
+                secret_file.write(secrets.token_bytes(32))
+        except FileExistsError:
+            pass
+        return path.read_bytes()
 
-        if allow_users is None or token_user in allow_users:
-            logging.info(f"Access granted for user '{token_user}'.")
-            return True, token_user
 
-    return False, ""
+_session_secret: bytes | None = None
 
 
-def set_token_and_user_in_cookies(request: Request, token_param: str, user: str) -> RedirectResponse:
-    clean_url = str(request.url).replace(f"token={token_param}", "").rstrip("&?")
-    if "?" in clean_url and clean_url.endswith("?"):
-        clean_url = clean_url[:-1]
-    resp = RedirectResponse(clean_url or "/")
-    resp.set_cookie(
-        key="APP_TOKEN",
-        value=token_param,
+def get_session_secret() -> bytes:
+    global _session_secret
+    if _session_secret is None:
+        _session_secret = _load_session_secret()
+    return _session_secret
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def create_session_token(principal: Principal, max_age_seconds: int = None) -> str:
+    """Signs the user id, name and expiry with HMAC-SHA256: <payload>.<signature>, both base64url."""
+    if max_age_seconds is None:
+        max_age_seconds = config.session_max_age_seconds
+    payload = json.dumps({"uid": principal.id, "name": principal.name, "exp": int(time.time()) + max_age_seconds},
+                         separators=(",", ":")).encode("utf-8")
+    signature = hmac.new(get_session_secret(), payload, hashlib.sha256).digest()
+    return f"{_b64encode(payload)}.{_b64encode(signature)}"
+
+
+def verify_session_token(session_token: Optional[str]) -> Optional[Principal]:
+    """Returns the principal of a valid, unexpired session token, None otherwise. Does not touch the database."""
+    if not session_token or "." not in session_token:
+        return None
+    try:
+        encoded_payload, encoded_signature = session_token.split(".", 1)
+        payload = _b64decode(encoded_payload)
+        expected = hmac.new(get_session_secret(), payload, hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64decode(encoded_signature)):
+            return None
+        data = json.loads(payload)
+        if data["exp"] < time.time():
+            return None
+        return Principal(id=int(data["uid"]), name=str(data["name"]))
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def is_allowed(principal: Optional[Principal], admin_only: bool = True,
+               allow_users: Optional[list[str]] = None) -> bool:
+    """Check if the user is allowed to access the site."""
+    if principal is None:
+        return False
+    if admin_only and principal.is_admin:
+        return True
+    return allow_users is None or principal.name in allow_users
+
+
+def set_session_cookies(response: Response, principal: Principal):
+    response.set_cookie(
+        key=SESSION_COOKIE,
+        value=create_session_token(principal),
         httponly=True,
         samesite="lax",
         secure=False,  # True if you serve over HTTPS
-        max_age=60 * 60 * 24 * 30,  # 30 days
+        max_age=config.session_max_age_seconds,
     )
-    resp.set_cookie(
+    response.set_cookie(
         key="APP_USER",
-        value=user,
+        value=principal.name,
         httponly=False,
         samesite="lax",
         secure=False,  # True if you serve over HTTPS
-        max_age=60 * 60 * 24 * 30,  # 30 days
+        max_age=config.session_max_age_seconds,
     )
 
+
+def set_token_and_user_in_cookies(request: Request, token_param: str, user: Principal) -> RedirectResponse:
+    clean_url = str(request.url).replace(f"token={token_param}", "").rstrip("&?")
+    if "?" in clean_url and clean_url.endswith("?"):
+        clean_url = clean_url[:-1]
+    resp = RedirectResponse(clean_url or "/")
+    set_session_cookies(resp, user)
+    resp.delete_cookie(LEGACY_TOKEN_COOKIE)
     return resp
 
 
-async def token_cookie_guard(request: Request, call_next, admin_only: bool = True,
-                             protected_route_prefixes: Optional[tuple[str]] = None,
-                             allow_users: Optional[list[str]] = None):
-    logging.info(f"token_cookie_guard called for path: {request.url.path}")
-
-    # check token in url
-    token_param = request.query_params.get("token")
-
-    if token_param is not None:
-        logging.info(f"Token param found: {token_param}")
-        allowed, user = user_is_allowed_to_access(token=token_param, admin_only=admin_only, allow_users=allow_users)
-        logging.info(f"Allowed: {allowed}, User: {user}")
-        if allowed:
-            logging.info("Token is valid, setting cookies.")
-            return set_token_and_user_in_cookies(request, token_param=token_param, user=user)
-        logging.warning("Invalid token, raising HTTPException.")
-        raise HTTPException(status_code=401, detail="Invalid token")
-
-    # 2) Require cookie for protected paths
-    if protected_route_prefixes is None:
-        protected_route_prefixes = ("/",)
-
-    if request.url.path.startswith(protected_route_prefixes):
-        logging.info(f"Protected path accessed: {request.url.path}")
-        token_cookie = request.cookies.get("APP_TOKEN")
-        allowed, user = user_is_allowed_to_access(token=token_cookie, admin_only=admin_only, allow_users=allow_users)
-        logging.info(f"Cookie allowed: {allowed}, User: {user}")
-        if allowed:
-            logging.info("Cookie is valid, attaching user to request.state.")
-            request.state.user = user  # Attach user to request.state
-            request.state.is_superuser = (user == "admin")
-            return await call_next(request)
-        logging.warning("Unauthorized access, returning JSONResponse.")
-        return JSONResponse(
-            {"detail": "Unauthorized. Append ?token=YOUR_SECRET to the URL."},
-            status_code=401
-        )
-
-    return await call_next(request)
+# actions of the route table
+PUBLIC = "public"  # no authentication at all
+STATIC = "static"  # files served without a session, only for paths that are not guessable or not secret
+PROTECTED = "protected"  # needs a valid session
+
+
+def _route_regex(pattern: str | re.Pattern) -> str:
+    if isinstance(pattern, re.Pattern):
+        return f"(?:{pattern.pattern})$"
+    return re.escape(pattern) + ("" if pattern.endswith("/") else "$")
+
+
+def compile_route_table(routes: list[tuple[str | re.Pattern, str]],
+                        default: str = PROTECTED) -> Callable[[str], str]:
+    """
+    Compiles (pattern, action) rules into one regex, so a request costs a single match instead of a loop over
+    prefixes. A string pattern ending with "/" matches the prefix, any other string the exact path and a compiled
+    regex the full path. Longer patterns win. Returns a function path -> action.
+    """
+    ordered = sorted(routes, key=lambda route: len(_route_regex(route[0])), reverse=True)
+    parts = [f"(?P<r{i}>{_route_regex(pattern)})" for i, (pattern, _) in enumerate(ordered)]
+    regex = re.compile("|".join(parts)) if parts else None
+    actions = {f"r{i}": action for i, (_, action) in enumerate(ordered)}
+
+    def match(path: str) -> str:
+        found = regex.match(path) if regex is not None else None
+        return actions[found.lastgroup] if found else default
+
+    return match
+
+
+def _json_response(status_code: int, detail: str) -> JSONResponse:
+    return JSONResponse({"detail": detail}, status_code=status_code)
+
+
+class AuthMiddleware:
+    """
+    Pure ASGI authentication. Looks up the path in a precompiled route table: public and static paths pass
+    without touching cookies, protected ones need a valid signed session (or a legacy token cookie, which is
+    swapped for a session) and get the principal in request.state.principal. A ?token= login on any path
+    validates the token and redirects to the same URL without it, with the session cookies set.
+    Nothing is logged on the success path, failures are logged without the token.
+    """
+
+    def __init__(self, app, routes: list[tuple[str, str]], admin_only: bool = True,
+                 allow_users: Optional[list[str]] = None):
+        self.app = app
+        self.route_action = compile_route_table(routes)
+        self.admin_only = admin_only
+        self.allow_users = allow_users
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope["path"]
+        query_string = scope.get("query_string", b"")
+        if b"token=" in query_string:
+            token = parse_qs(query_string.decode("latin-1")).get("token", [None])[0]
+            if token is not None:
+                await self._login(scope, receive, send, token)
+                return
+
+        action = self.route_action(path)
+        if action != PROTECTED:
+            await self.app(scope, receive, send)
+            return
+
+        cookies = _cookies(scope)
+        principal = verify_session_token(cookies.get(SESSION_COOKIE))
+        # cookies from before signed sessions carry the raw token, they are swapped for a session below
+        upgrade_legacy_cookie = principal is None and LEGACY_TOKEN_COOKIE in cookies
+        if upgrade_legacy_cookie:
+            principal = await aget_token_user(cookies.get(LEGACY_TOKEN_COOKIE))
+        if not is_allowed(principal, admin_only=self.admin_only, allow_users=self.allow_users):
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("auth_denied path=%s reason=%s", path,
+                            "not_allowed" if principal is not None else "no_valid_session")
+            await _json_response(401, "Unauthorized. Append ?token=YOUR_SECRET to the URL.")(scope, receive, send)
+            return
+
+        state = scope.setdefault("state", {})
+        state["principal"] = principal
+        state["user"] = principal.name
+        state["is_superuser"] = principal.is_admin
+        if upgrade_legacy_cookie:
+            send = _with_headers(send, _session_cookie_headers(principal, delete_legacy=True))
+        await self.app(scope, receive, send)
+
+    async def _login(self, scope, receive, send, token: str):
+        principal = await aget_token_user(token)
+        if not is_allowed(principal, admin_only=self.admin_only, allow_users=self.allow_users):
+            logger.warning("auth_login_failed path=%s reason=%s", scope["path"],
+                           "invalid_token" if principal is None else "not_allowed")
+            await _json_response(401, "Invalid token")(scope, receive, send)
+            return
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("auth_login user=%s", principal.name)
+        response = set_token_and_user_in_cookies(Request(scope), token_param=token, user=principal)
+        await response(scope, receive, send)
+
+
+def _cookies(scope) -> dict[str, str]:
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            return cookie_parser(value.decode("latin-1"))
+    return {}
+
+
+def _session_cookie_headers(principal: Principal, delete_legacy: bool = False) -> list[tuple[bytes, bytes]]:
+    response = Response()
+    set_session_cookies(response, principal)
+    if delete_legacy:
+        response.delete_cookie(LEGACY_TOKEN_COOKIE)
+    return [header for header in response.raw_headers if header[0] == b"set-cookie"]
+
+
+def _with_headers(send, headers: list[tuple[bytes, bytes]]):
+    """Wraps send so the response start message carries the extra headers."""
+    async def send_with_headers(message):
+        if message["type"] == "http.response.start":
+            message = {**message, "headers": [*message.get("headers", []), *headers]}
+        await send(message)
+
+    return send_with_headers
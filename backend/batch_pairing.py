@@ -0,0 +1,153 @@
+# Pairing of many groups and years at once: the solver runs in a process pool, each group is written in one transaction.
+# Run with: python -m backend.batch_pairing --years 2025 2026 [--groups family friends] [--replace]
+import argparse
+import json
+import logging
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, asdict
+
+from sqlalchemy import select
+
+from backend import config
+from backend.db import Group, SecretSantaPair, SessionLocal
+from backend.pairing import PairingInput, load_pairing_input, save_pairs, solve_pairing
+from backend.pairing_runs import new_seed
+
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+
+MIN_PARTICIPANTS = 2
+
+
+@dataclass
+class GroupResult:
+    group_id: int
+    group_name: str
+    year: int
+    status: str
+    participants: int = 0
+    pairs: int = 0
+    load_ms: float = 0.0
+    solve_ms: float = 0.0
+    write_ms: float = 0.0
+    seed: int | None = None
+    run_id: int | None = None
+    error: str | None = None
+
+
+def _elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def _load_jobs(session_factory, jobs: list[tuple[Group, int]], replace: bool, allow_last_year_pairing: bool,
+               allow_vice_versa: bool) -> tuple[list[tuple[PairingInput, GroupResult]], list[GroupResult]]:
+    """
+    Loads the solver input of every group and year. Groups that are already paired are skipped unless replaced,
+    groups with fewer than MIN_PARTICIPANTS members always.
+    """
+    loaded, skipped = [], []
+    with session_factory() as db:
+        paired = set(db.execute(
+            select(SecretSantaPair.group_id, SecretSantaPair.year).distinct()
+            .where(SecretSantaPair.year.in_({year for _, year in jobs}))
+        ).all())
+        for group, year in jobs:
+            result = GroupResult(group_id=group.id, group_name=group.name, year=year, status=STATUS_OK)
+            if not replace and (group.id, year) in paired:
+                result.status = STATUS_SKIPPED
+                result.error = "already paired"
+                skipped.append(result)
+                continue
+            start = time.perf_counter()
+            pairing_input = load_pairing_input(db, group.id, year, allow_last_year_pairing, allow_vice_versa)
+            result.load_ms = _elapsed_ms(start)
+            result.participants = len(pairing_input.user_ids)
+            if result.participants < MIN_PARTICIPANTS:
+                # e.g. the default group of a new database, nothing to pair rather than a failure
+                result.status = STATUS_SKIPPED
+                result.error = f"fewer than {MIN_PARTICIPANTS} members"
+                skipped.append(result)
+                continue
+            loaded.append((pairing_input, result))
+    return loaded, skipped
+
+
+def run_batch(groups: list[Group], years: list[int], replace: bool = False, allow_last_year_pairing: bool = False,
+              allow_vice_versa: bool = False, workers: int = None, session_factory=SessionLocal) -> list[GroupResult]:
+    """
+    Pairs every group for every year. The solving runs in parallel processes, the results are written as they
+    come in, one transaction per group and year, so a failing group does not affect the others.
+    Years are paired in ascending order in separate rounds because a year's constraints depend on the previous one.
+    Every written group gets a pairing run record with its seed, see backend.pairing.replay_run.
+    """
+    results = []
+    with ProcessPoolExecutor(max_workers=workers or config.pairing_workers,
+                             mp_context=multiprocessing.get_context("spawn")) as executor:
+        for year in sorted(years):
+            loaded, skipped = _load_jobs(session_factory, [(group, year) for group in groups], replace,
+                                         allow_last_year_pairing, allow_vice_versa)
+            results.extend(skipped)
+            futures = {}
+            for pairing_input, result in loaded:
+                # seeds are drawn here, so every group's run is recorded and replayable
+                result.seed = new_seed()
+                futures[executor.submit(solve_pairing, pairing_input, result.seed)] = (pairing_input, result)
+            for future in as_completed(futures):
+                pairing_input, result = futures[future]
+                try:
+                    solve_result = future.result()
+                    result.solve_ms = round(solve_result.duration_ms, 2)
+                    start = time.perf_counter()
+                    with session_factory.begin() as db:
+                        run = save_pairs(db, pairing_input, solve_result, replace=replace)
+                        db.flush()
+                        result.run_id = run.id
+                    result.pairs = len(solve_result.receiver_of)
+                    result.write_ms = _elapsed_ms(start)
+                except Exception as e:
+                    result.status = STATUS_FAILED
+                    result.error = f"{type(e).__name__}: {e}"
+                    logging.warning(f"Pairing group {result.group_name} ({result.group_id}) for {year} failed: "
+                                    f"{result.error}")
+                results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    import datetime
+
+    parser = argparse.ArgumentParser(description="Create secret santa pairs for many groups and years in parallel.")
+    parser.add_argument("--years", type=int, nargs="+", default=[datetime.datetime.now().year])
+    parser.add_argument("--groups", nargs="+", default=None, help="group names, defaults to all groups")
+    parser.add_argument("--workers", type=int, default=None, help=f"defaults to {config.pairing_workers}")
+    parser.add_argument("--replace", action="store_true", help="replace existing pairs instead of skipping the group")
+    parser.add_argument("--allow-last-year-pairing", action="store_true")
+    parser.add_argument("--allow-vice-versa", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    with SessionLocal() as session:
+        query = select(Group).order_by(Group.id)
+        if args.groups:
+            query = query.where(Group.name.in_(args.groups))
+        selected_groups = list(session.execute(query).scalars().all())
+        session.expunge_all()
+    missing_groups = set(args.groups or []) - {group.name for group in selected_groups}
+    if missing_groups:
+        parser.error(f"unknown groups: {', '.join(sorted(missing_groups))}")
+
+    batch_start = time.perf_counter()
+    batch_results = run_batch(selected_groups, args.years, replace=args.replace,
+                              allow_last_year_pairing=args.allow_last_year_pairing,
+                              allow_vice_versa=args.allow_vice_versa, workers=args.workers)
+    # one JSON object per group and year on stdout, followed by a summary line
+    for batch_result in batch_results:
+        print(json.dumps(asdict(batch_result), ensure_ascii=False))
+    counts = {status: sum(r.status == status for r in batch_results)
+              for status in (STATUS_OK, STATUS_FAILED, STATUS_SKIPPED)}
+    print(json.dumps({"summary": counts, "total_ms": _elapsed_ms(batch_start)}))
+    sys.exit(1 if counts[STATUS_FAILED] else 0)
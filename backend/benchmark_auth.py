@@ -0,0 +1,156 @@
+# Requests per second through the auth middleware, the previous BaseHTTPMiddleware guard vs. AuthMiddleware.
+# Calls the ASGI apps directly without a server, so only the middleware cost is measured.
+import argparse
+import asyncio
+import logging
+import re
+import secrets
+import time
+from typing import Optional
+
+from fastapi import HTTPException
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse
+
+from backend import config
+from backend.auth import AuthMiddleware, PUBLIC, SESSION_COOKIE, STATIC, Principal, create_session_token
+from backend.static_files import CONTENT_HASHED_PATH
+
+ROUTES = [
+    ("/api/healthcheck", PUBLIC),
+    (re.compile("/static/" + CONTENT_HASHED_PATH.pattern), STATIC),
+    ("/" + config.default_preview_image_path, STATIC),
+]
+
+# the previous guard checked tokens against a dict in the code, admin first, with random tokens here
+credentials: dict[str, str] = {}
+
+
+async def endpoint(scope, receive, send):
+    await PlainTextResponse("ok")(scope, receive, send)
+
+
+# the previous guard from auth.py as it was, only the credentials differ
+
+
+def legacy_get_token_user(token: str) -> Optional[str]:
+    for user, user_token in credentials.items():
+        if token == user_token:
+            return user
+    return None
+
+
+def legacy_user_is_allowed_to_access(token: str, admin_only: bool = True,
+                                     allow_users: Optional[list[str]] = None) -> tuple[bool, str]:
+    token_user = legacy_get_token_user(token)
+
+    if token_user is None:
+        logging.warning("Invalid token attempt, token not found in credentials.")
+        return False, ""
+
+    if token_user is not None:
+        if admin_only and token_user == "admin":
+            logging.info("Admin access granted.")
+            return True, "admin"
+
+        if allow_users is None or token_user in allow_users:
+            logging.info(f"Access granted for user '{token_user}'.")
+            return True, token_user
+
+    return False, ""
+
+
+async def legacy_guard(request: Request, call_next, admin_only: bool = True,
+                       protected_route_prefixes: Optional[tuple[str]] = None,
+                       allow_users: Optional[list[str]] = None):
+    logging.info(f"token_cookie_guard called for path: {request.url.path}")
+
+    token_param = request.query_params.get("token")
+
+    if token_param is not None:
+        logging.info(f"Token param found: {token_param}")
+        allowed, user = legacy_user_is_allowed_to_access(token=token_param, admin_only=admin_only,
+                                                         allow_users=allow_users)
+        logging.info(f"Allowed: {allowed}, User: {user}")
+        if allowed:
+            return JSONResponse({"detail": "logins are not benchmarked"}, status_code=400)
+        logging.warning("Invalid token, raising HTTPException.")
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    if protected_route_prefixes is None:
+        protected_route_prefixes = ("/",)
+
+    if request.url.path.startswith(protected_route_prefixes):
+        logging.info(f"Protected path accessed: {request.url.path}")
+        token_cookie = request.cookies.get("APP_TOKEN")
+        allowed, user = legacy_user_is_allowed_to_access(token=token_cookie, admin_only=admin_only,
+                                                         allow_users=allow_users)
+        logging.info(f"Cookie allowed: {allowed}, User: {user}")
+        if allowed:
+            logging.info("Cookie is valid, attaching user to request.state.")
+            request.state.user = user
+            request.state.is_superuser = (user == "admin")
+            return await call_next(request)
+        logging.warning("Unauthorized access, returning JSONResponse.")
+        return JSONResponse(
+            {"detail": "Unauthorized. Append ?token=YOUR_SECRET to the URL."},
+            status_code=401
+        )
+
+    return await call_next(request)
+
+
+def make_scope(path: str, cookie: str) -> dict:
+    return {
+        "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": path,
+        "raw_path": path.encode(),
+        "root_path": "", "query_string": b"", "server": ("testserver", 80), "client": ("127.0.0.1", 1234),
+        "headers": [(b"host", b"testserver"), (b"cookie", cookie.encode("latin-1"))],
+    }
+
+
+async def run(app, scope: dict, requests: int) -> float:
+    """Returns requests per second."""
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receive, send)
+    return requests / (time.perf_counter() - start)
+
+
+async def main(requests: int, users: int):
+    credentials["admin"] = secrets.token_urlsafe(16)
+    for i in range(1, users + 1):
+        credentials[f"user{i}"] = secrets.token_urlsafe(16)
+    # the last user, the previous guard scans all credentials for their token
+    name = f"user{users}"
+    cookies = {
+        "before": f"APP_TOKEN={credentials[name]}",
+        "after": f"{SESSION_COOKIE}={create_session_token(Principal(id=users + 1, name=name))}",
+    }
+    apps = {
+        "before": BaseHTTPMiddleware(endpoint, dispatch=legacy_guard),
+        "after": AuthMiddleware(endpoint, routes=ROUTES),
+    }
+    paths = ("/api/users", "/static/users/max.png", f"/static/previews/ab/{'ab' * 32}.png")
+    for path in paths:
+        for label, app in apps.items():
+            rps = await run(app, make_scope(path, cookies[label]), requests)
+            print(f"{label:7s} {path[:40]:40s} {rps:10.0f} requests/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the previous auth guard with AuthMiddleware.")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=6, help="users besides the admin, the baseline had 6")
+    args = parser.parse_args()
+
+    # INFO as in production (app.py), the logs of the previous guard are part of its cost
+    logging.basicConfig(level=logging.INFO, filename="/dev/null")
+    asyncio.run(main(args.requests, args.users))
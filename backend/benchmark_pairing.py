@@ -0,0 +1,155 @@
+# Benchmark and property checks of the pairing solver on synthetic groups, runs without a database
+import argparse
+import itertools
+import math
+import random
+import statistics
+import sys
+import time
+from collections import Counter
+
+from backend.pairing_solver import PairingError, SolverStats, assignment_violations, solve_assignment
+
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+# up to this size a PairingError is checked against all permutations
+BRUTE_FORCE_MAX_N = 8
+
+
+def synthetic_exclusions(n: int, density: float, max_exclusions: int, couples: bool,
+                         rng: random.Random) -> list[set[int]]:
+    """
+    Every giver excludes density * (n - 1) random receivers (at most max_exclusions), like the history and rules
+    of a real group. With couples, neighbours 2k and 2k + 1 additionally exclude each other.
+    """
+    per_user = min(max_exclusions, round(density * (n - 1)))
+    excluded = []
+    for giver in range(n):
+        excluded.append(set(rng.sample(range(n), per_user)) - {giver} if per_user else set())
+    if couples:
+        for first in range(0, n - 1, 2):
+            excluded[first].add(first + 1)
+            excluded[first + 1].add(first)
+    return excluded
+
+
+def valid_assignments(n: int, excluded: list[set[int]], allow_mutual: bool) -> list[tuple[int, ...]]:
+    """All valid assignments by brute force, only feasible for small n."""
+    return [permutation for permutation in itertools.permutations(range(n))
+            if not assignment_violations(list(permutation), excluded, allow_mutual)]
+
+
+def has_valid_assignment(n: int, excluded: list[set[int]], allow_mutual: bool) -> bool:
+    """Whether any valid assignment exists, by brute force."""
+    return any(not assignment_violations(list(permutation), excluded, allow_mutual)
+               for permutation in itertools.permutations(range(n)))
+
+
+def benchmark_size(n: int, runs: int, density: float, max_exclusions: int, couples: bool, allow_mutual: bool,
+                   seed: int) -> dict:
+    """
+    Solves runs synthetic groups of n users, checks every result and collects timings and solver counters.
+    Up to BRUTE_FORCE_MAX_N users a PairingError is checked by brute force: groups without any valid assignment
+    count as infeasible, the others as false negatives. Failures of larger groups cannot be checked.
+    """
+    rng = random.Random(seed)
+    times, infeasible, false_negatives, unverified, invalid = [], 0, 0, 0, 0
+    totals = Counter()
+    for _ in range(runs):
+        excluded = synthetic_exclusions(n, density, max_exclusions, couples, rng)
+        stats = SolverStats()
+        start = time.perf_counter()
+        try:
+            receiver_of = solve_assignment(n, excluded, allow_mutual=allow_mutual, rng=rng, stats=stats)
+        except PairingError:
+            times.append(time.perf_counter() - start)
+            totals.update(vars(stats))
+            if n > BRUTE_FORCE_MAX_N:
+                unverified += 1
+            elif has_valid_assignment(n, excluded, allow_mutual):
+                false_negatives += 1
+            else:
+                infeasible += 1
+            continue
+        times.append(time.perf_counter() - start)
+        totals.update(vars(stats))
+        if assignment_violations(receiver_of, excluded, allow_mutual):
+            invalid += 1
+    return {
+        "n": n,
+        "runs": runs,
+        "median_ms": statistics.median(times) * 1000,
+        "max_ms": max(times) * 1000,
+        "infeasible_rate": infeasible / runs,
+        "false_negatives": false_negatives,
+        "unverified_failures": unverified,
+        "invalid": invalid,
+        "augmenting_paths": totals["augmenting_paths"] / runs,
+        "visited_givers": totals["visited_givers"] / runs,
+        "mutual_pairs_removed": totals["mutual_pairs_removed"] / runs,
+        "acceptance_rate": totals["accepted_moves"] / max(1, totals["mixing_steps"]),
+    }
+
+
+def _chi_square_critical(degrees: int, z: float = 3.09) -> float:
+    """Wilson-Hilferty approximation of the chi-square quantile, z = 3.09 is the 99.9% level."""
+    a = 2 / (9 * degrees)
+    return degrees * (1 - a + z * math.sqrt(a)) ** 3
+
+
+def check_uniformity(n: int, samples: int, density: float, allow_mutual: bool, seed: int) -> dict:
+    """
+    Draws samples assignments for one small group and compares the frequency of every valid assignment with the
+    uniform distribution by a chi-square test. uniform is False if the deviation is significant at the 99.9% level.
+    """
+    rng = random.Random(seed)
+    excluded = synthetic_exclusions(n, density, n, couples=True, rng=rng)
+    outcomes = valid_assignments(n, excluded, allow_mutual)
+    if len(outcomes) < 2:
+        raise PairingError(f"The uniformity check needs at least two valid assignments, got {len(outcomes)}.")
+    counts = Counter(tuple(solve_assignment(n, excluded, allow_mutual=allow_mutual, rng=rng))
+                     for _ in range(samples))
+    expected = samples / len(outcomes)
+    chi_square = sum((counts[outcome] - expected) ** 2 / expected for outcome in outcomes)
+    critical = _chi_square_critical(len(outcomes) - 1)
+    return {
+        "n": n,
+        "valid_assignments": len(outcomes),
+        "samples": samples,
+        "unexpected_outcomes": len(set(counts) - set(outcomes)),
+        "chi_square": chi_square,
+        "critical": critical,
+        "uniform": chi_square <= critical and not set(counts) - set(outcomes),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pairing solver on synthetic groups.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES))
+    parser.add_argument("--runs", type=int, default=5, help="groups per size")
+    parser.add_argument("--density", type=float, default=0.01, help="fraction of receivers each giver excludes")
+    parser.add_argument("--max-exclusions", type=int, default=50, help="upper bound of exclusions per giver")
+    parser.add_argument("--no-couples", action="store_true", help="do not add mutual couple exclusions")
+    parser.add_argument("--no-mutual", action="store_true", help="forbid a <-> b pairs")
+    parser.add_argument("--uniformity-size", type=int, default=6, help="group size of the uniformity check, 0 skips it")
+    parser.add_argument("--uniformity-samples", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    failed = False
+    for size in args.sizes:
+        result = benchmark_size(size, args.runs, args.density, args.max_exclusions, not args.no_couples,
+                                not args.no_mutual, args.seed)
+        failed |= result["invalid"] > 0 or result["false_negatives"] > 0
+        print(f"n={result['n']:>7}  median {result['median_ms']:10.1f} ms  max {result['max_ms']:10.1f} ms  "
+              f"infeasible {result['infeasible_rate']:6.1%}  false negatives {result['false_negatives']}  "
+              f"unverified failures {result['unverified_failures']}  invalid {result['invalid']}  "
+              f"augmenting paths {result['augmenting_paths']:8.1f}  visited {result['visited_givers']:10.1f}  "
+              f"mutual fixes {result['mutual_pairs_removed']:6.1f}  acceptance {result['acceptance_rate']:6.1%}")
+
+    if args.uniformity_size:
+        result = check_uniformity(args.uniformity_size, args.uniformity_samples, 0.2, not args.no_mutual, args.seed)
+        failed |= not result["uniform"]
+        print(f"uniformity n={result['n']}: {result['valid_assignments']} valid assignments, "
+              f"chi-square {result['chi_square']:.1f} (critical {result['critical']:.1f}), "
+              f"unexpected outcomes {result['unexpected_outcomes']} -> {'ok' if result['uniform'] else 'NOT UNIFORM'}")
+    sys.exit(1 if failed else 0)
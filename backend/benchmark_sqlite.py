@@ -0,0 +1,150 @@
+# Benchmark of the hot queries on a throwaway sqlite database, measuring WAL, the other pragmas and the composite
+# indexes each on their own. The schema is built by the migrations and the pragmas come from db.set_sqlite_pragmas,
+# so the benchmark measures what ships.
+import argparse
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+from backend import migrations
+from backend.db import set_sqlite_pragmas
+
+YEARS = (2023, 2024, 2025)
+# the schema before the composite indexes of migration 2
+BASELINE_VERSION = 1
+
+
+def wal_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
+
+@dataclass
+class Profile:
+    name: str
+    schema_version: Optional[int]  # None: all migrations
+    on_connect: Optional[Callable]
+
+
+PROFILES = [
+    Profile("default", BASELINE_VERSION, None),
+    Profile("wal", BASELINE_VERSION, wal_only),
+    Profile("pragmas", BASELINE_VERSION, set_sqlite_pragmas),
+    Profile("indexes", None, None),
+    Profile("shipped", None, set_sqlite_pragmas),
+]
+
+
+def create_benchmark_engine(path: Path, profile: Profile) -> Engine:
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30, "check_same_thread": False})
+    if profile.on_connect is not None:
+        event.listen(engine, "connect", profile.on_connect)
+    return engine
+
+
+@contextmanager
+def connect(engine: Engine) -> Iterator[sqlite3.Connection]:
+    """The plain sqlite3 connection of the pool, so only the database is measured and not the SQLAlchemy layer."""
+    pooled = engine.raw_connection()
+    try:
+        yield pooled.driver_connection
+    finally:
+        pooled.close()
+
+
+def seed(engine: Engine, profile: Profile, users: int, gifts_per_user: int, votes_per_gift: int):
+    migrations.upgrade(engine, target=profile.schema_version)
+    rng = random.Random(0)
+    with connect(engine) as connection:
+        connection.executemany("INSERT INTO users (id, name, token) VALUES (?, ?, ?)",
+                               ((i, f"user{i}", f"token{i}") for i in range(1, users + 1)))
+        for year in YEARS:
+            receivers = list(range(1, users + 1))
+            rng.shuffle(receivers)
+            connection.executemany("INSERT INTO pairs (year, giver_id, receiver_id) VALUES (?, ?, ?)",
+                                   ((year, giver, receiver) for giver, receiver in enumerate(receivers, start=1)))
+        gift_rows = []
+        for year in YEARS:
+            for user in range(1, users + 1):
+                for _ in range(gifts_per_user):
+                    gift_rows.append(("gift", year, rng.randint(1, users), user))
+        connection.executemany("INSERT INTO gifts (title, year, created_by_id, created_for_id) VALUES (?, ?, ?, ?)",
+                               gift_rows)
+        vote_rows = set()
+        for gift_id in range(1, len(gift_rows) + 1):
+            for voter in rng.sample(range(1, users + 1), min(votes_per_gift, users)):
+                vote_rows.add((gift_id, voter))
+        connection.executemany("INSERT INTO votes (value, gift_id, user_id) VALUES (1, ?, ?)", vote_rows)
+        connection.commit()
+        connection.execute("ANALYZE")
+
+
+def run_reads(connection: sqlite3.Connection, users: int, gifts: int, iterations: int, rng: random.Random) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        user = rng.randint(1, users)
+        connection.execute("SELECT receiver_id FROM pairs WHERE giver_id = ? AND year = ?", (user, YEARS[-1])).fetchall()
+        connection.execute("SELECT id FROM gifts WHERE created_for_id = ? AND year = ?", (user, YEARS[-1])).fetchall()
+        connection.execute("SELECT value FROM votes WHERE gift_id = ? AND user_id = ?",
+                           (rng.randint(1, gifts), user)).fetchall()
+    return time.perf_counter() - start
+
+
+def run_writes(engine: Engine, users: int, gifts: int, iterations: int, stop: threading.Event):
+    rng = random.Random(1)
+    with connect(engine) as connection:
+        for _ in range(iterations):
+            if stop.is_set():
+                break
+            connection.execute("UPDATE votes SET value = -value WHERE gift_id = ? AND user_id = ?",
+                               (rng.randint(1, gifts), rng.randint(1, users)))
+            connection.commit()
+
+
+def benchmark(profile: Profile, users: int, gifts_per_user: int, votes_per_gift: int, iterations: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_benchmark_engine(Path(tmp_dir) / "bench.db", profile)
+        seed(engine, profile, users, gifts_per_user, votes_per_gift)
+        gifts = users * gifts_per_user * len(YEARS)
+        rng = random.Random(2)
+        with connect(engine) as connection:
+            read_only = run_reads(connection, users, gifts, iterations, rng)
+
+            # reads while another connection keeps committing votes
+            stop = threading.Event()
+            writer = threading.Thread(target=run_writes, args=(engine, users, gifts, iterations, stop))
+            writer.start()
+            with_writer = run_reads(connection, users, gifts, iterations, rng)
+            stop.set()
+            writer.join()
+        engine.dispose()
+    return {"read_only": read_only, "with_writer": with_writer}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure WAL, the other sqlite pragmas and the composite indexes.")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--gifts-per-user", type=int, default=5)
+    parser.add_argument("--votes-per-gift", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--profiles", nargs="*", default=[profile.name for profile in PROFILES],
+                        choices=[profile.name for profile in PROFILES])
+    args = parser.parse_args()
+
+    for bench_profile in PROFILES:
+        if bench_profile.name not in args.profiles:
+            continue
+        result = benchmark(bench_profile, args.users, args.gifts_per_user, args.votes_per_gift, args.iterations)
+        print(f"{bench_profile.name:8s} read only: {result['read_only'] * 1000:8.1f} ms   "
+              f"with concurrent writer: {result['with_writer'] * 1000:8.1f} ms   "
+              f"({args.iterations} x 3 hot queries)")
@@ -0,0 +1,222 @@
+# Bulk import of users, pairings and wish lists from CSV or JSON files
+import argparse
+import csv
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Iterable
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection, Engine
+
+from backend.db import User, SecretSantaPair, Gift, Group, Membership
+from backend.response_cache import bump_statement
+from backend.tokens import is_guessable, new_token
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+class BulkImportError(Exception):
+    """Raised when the import data references unknown users, misses required fields or has guessable tokens."""
+
+
+def read_rows(path: Path) -> list[dict]:
+    """Reads a CSV file with header or a JSON file with a list of objects."""
+    if path.suffix.lower() == ".json":
+        with open(path, encoding="utf-8") as json_file:
+            rows = json.load(json_file)
+        if not isinstance(rows, list):
+            raise BulkImportError(f"{path} must contain a list of objects")
+        return rows
+    with open(path, encoding="utf-8", newline="") as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+def chunks(rows: list, chunk_size: int) -> Iterable[list]:
+    for start in range(0, len(rows), chunk_size):
+        yield rows[start:start + chunk_size]
+
+
+def _insert(connection: Connection):
+    """Returns the dialect specific insert, which supports ON CONFLICT."""
+    if connection.dialect.name == "postgresql":
+        return postgresql.insert
+    return sqlite.insert
+
+
+def resolve_user_ids(connection: Connection, names: Iterable[str]) -> dict[str, int]:
+    """Resolves all user names with one query per chunk instead of one per row."""
+    names = sorted(set(names))
+    ids = {}
+    for chunk in chunks(names, DEFAULT_CHUNK_SIZE):
+        ids.update(connection.execute(select(User.name, User.id).where(User.name.in_(chunk))).all())
+    missing = set(names) - ids.keys()
+    if missing:
+        raise BulkImportError(f"Unknown users: {', '.join(sorted(missing))}")
+    return ids
+
+
+def resolve_group_ids(connection: Connection, names: Iterable[str], create: bool = False) -> dict[str, int]:
+    """Resolves group names in one query, missing groups are created if create is set."""
+    names = sorted({name for name in names if name})
+    if not names:
+        return {}
+    if create:
+        connection.execute(_insert(connection)(Group).values([{"name": name} for name in names])
+                           .on_conflict_do_nothing(index_elements=[Group.name]))
+    ids = dict(connection.execute(select(Group.name, Group.id).where(Group.name.in_(names))).all())
+    missing = set(names) - ids.keys()
+    if missing:
+        raise BulkImportError(f"Unknown groups: {', '.join(sorted(missing))}")
+    return ids
+
+
+def import_memberships(engine: Engine, rows: list[dict], chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Adds users to groups (user, group, optional household), groups are created if needed.
+    The household of existing memberships is updated if given. Returns the number of written memberships.
+    """
+    rows = [row for row in rows if row.get("group")]
+    if not rows:
+        return 0
+    with engine.begin() as connection:
+        user_ids = resolve_user_ids(connection, [row["user"] for row in rows])
+        group_ids = resolve_group_ids(connection, [row["group"] for row in rows], create=True)
+    memberships = [{"user_id": user_ids[row["user"]], "group_id": group_ids[row["group"]],
+                    "household": row.get("household") or None} for row in rows]
+    written = 0
+    for chunk in chunks(memberships, chunk_size):
+        with engine.begin() as connection:
+            statement = _insert(connection)(Membership).values(chunk)
+            statement = statement.on_conflict_do_update(
+                index_elements=[Membership.group_id, Membership.user_id],
+                set_={"household": func.coalesce(statement.excluded.household, Membership.household)})
+            written += connection.execute(statement).rowcount
+    with engine.begin() as connection:
+        connection.execute(bump_statement(group_ids.values()))
+    return written
+
+
+def import_users(engine: Engine, rows: list[dict], chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 overwrite_tokens: bool = True) -> int:
+    """
+    Upserts users by name. Rows with a token overwrite the stored token (unless overwrite_tokens is False),
+    rows without one keep an existing user as it is and get a random token if they are new.
+    Users of rows with a group are added to it (and its household, if given). Returns the number of user rows written.
+    Guessable tokens (see tokens.is_guessable) fail the import before anything is written.
+    """
+    memberships = [{"user": row["name"], "group": row.get("group"), "household": row.get("household")}
+                   for row in rows]
+    rows = [{"name": row["name"], "token": row.get("token") or None} for row in rows]
+    guessable = sorted(row["name"] for row in rows if row["token"] and is_guessable(row["name"], row["token"]))
+    if guessable:
+        raise BulkImportError(f"Guessable tokens for users: {', '.join(guessable)}")
+    with_token = [row for row in rows if row["token"]] if overwrite_tokens else []
+    keep_existing = [{"name": row["name"], "token": row["token"] or new_token()}
+                     for row in rows if not (overwrite_tokens and row["token"])]
+    written = 0
+    for chunk in chunks(with_token, chunk_size):
+        with engine.begin() as connection:
+            statement = _insert(connection)(User).values(chunk)
+            statement = statement.on_conflict_do_update(index_elements=[User.name],
+                                                        set_={"token": statement.excluded.token})
+            written += connection.execute(statement).rowcount
+    for chunk in chunks(keep_existing, chunk_size):
+        with engine.begin() as connection:
+            statement = _insert(connection)(User).values(chunk).on_conflict_do_nothing(index_elements=[User.name])
+            written += connection.execute(statement).rowcount
+    import_memberships(engine, memberships, chunk_size)
+    return written
+
+
+def import_pairs(engine: Engine, rows: list[dict], chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Inserts pairings (giver, receiver, year, optional group). Givers that already have a receiver in that year and
+    group are skipped, so the import can be repeated. Returns the number of inserted pairs.
+    """
+    inserted = 0
+    with engine.connect() as connection:
+        ids = resolve_user_ids(connection, [r["giver"] for r in rows] + [r["receiver"] for r in rows])
+        group_ids = resolve_group_ids(connection, [row.get("group") for row in rows])
+        years = {int(row["year"]) for row in rows}
+        existing = set(connection.execute(
+            select(SecretSantaPair.giver_id, SecretSantaPair.year, SecretSantaPair.group_id)
+            .where(SecretSantaPair.year.in_(years))
+        ).all())
+    new_rows = []
+    for row in rows:
+        key = (ids[row["giver"]], int(row["year"]), group_ids.get(row.get("group")))
+        if key not in existing:
+            existing.add(key)
+            new_rows.append({"giver_id": key[0], "receiver_id": ids[row["receiver"]], "year": key[1],
+                             "group_id": key[2]})
+    for chunk in chunks(new_rows, chunk_size):
+        with engine.begin() as connection:
+            connection.execute(SecretSantaPair.__table__.insert(), chunk)
+        inserted += len(chunk)
+    if new_rows:
+        with engine.begin() as connection:
+            connection.execute(bump_statement({row["group_id"] for row in new_rows}))
+    return inserted
+
+
+def import_gifts(engine: Engine, rows: list[dict], chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Inserts wish list entries (title, created_by, created_for, year, optional group, description and link).
+    Gifts with the same title, creator, receiver, year and group are skipped. Returns the number of inserted gifts.
+    """
+    with engine.connect() as connection:
+        ids = resolve_user_ids(connection, [r["created_by"] for r in rows] + [r["created_for"] for r in rows])
+        group_ids = resolve_group_ids(connection, [row.get("group") for row in rows])
+        years = {int(row["year"]) for row in rows}
+        existing = set(connection.execute(
+            select(Gift.title, Gift.created_by_id, Gift.created_for_id, Gift.year, Gift.group_id)
+            .where(Gift.year.in_(years))
+        ).all())
+    new_rows = []
+    for row in rows:
+        key = (row["title"], ids[row["created_by"]], ids[row["created_for"]], int(row["year"]),
+               group_ids.get(row.get("group")))
+        if key not in existing:
+            existing.add(key)
+            new_rows.append({
+                "title": key[0],
+                "created_by_id": key[1],
+                "created_for_id": key[2],
+                "year": key[3],
+                "group_id": key[4],
+                "description": row.get("description") or "",
+                "link": row.get("link") or "",
+            })
+    inserted = 0
+    for chunk in chunks(new_rows, chunk_size):
+        with engine.begin() as connection:
+            connection.execute(Gift.__table__.insert(), chunk)
+        inserted += len(chunk)
+    if new_rows:
+        with engine.begin() as connection:
+            connection.execute(bump_statement({row["group_id"] for row in new_rows}))
+    return inserted
+
+
+if __name__ == "__main__":
+    from backend.db import engine as default_engine
+
+    parser = argparse.ArgumentParser(description="Import users, pairings and wish lists from CSV or JSON files.")
+    parser.add_argument("--users", type=Path, help="name[,token,group,household]")
+    parser.add_argument("--pairs", type=Path, help="giver,receiver,year[,group]")
+    parser.add_argument("--gifts", type=Path, help="title,created_by,created_for,year[,group,description,link]")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for label, path, import_function in (("users", args.users, import_users),
+                                         ("pairs", args.pairs, import_pairs),
+                                         ("gifts", args.gifts, import_gifts)):
+        if path is None:
+            continue
+        start = time.perf_counter()
+        count = import_function(default_engine, read_rows(path), chunk_size=args.chunk_size)
+        print(f"Imported {count} {label} from {path} in {time.perf_counter() - start:.2f}s")
@@ -9,8 +9,74 @@ if os.path.exists("/app/db"):
 else:
     db_path = base_dir / "secretsanta.db"
 
+# sqlite by default, set DATABASE_URL (e.g. postgresql://user:pw@host/db) to use another database
+database_url = os.environ.get("DATABASE_URL", f"sqlite:///{db_path}")
+db_pool_size = int(os.environ.get("DB_POOL_SIZE", "10"))
+db_max_overflow = int(os.environ.get("DB_MAX_OVERFLOW", "20"))
+db_pool_timeout_seconds = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+# number of compiled statements SQLAlchemy keeps cached per engine
+db_statement_cache_size = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "500"))
+
+# group that all users and data from before groups existed belong to
+default_group_name = "default"
+
 static = base_dir / "static"
 previews = static / "previews"
 
 previews_url = "static/previews/"
 default_preview_image_path = "static/previews/default_preview.png"
+
+# content hashed preview urls can be signed with an expiry, so they only work for users who got them from the api.
+# Signed urls stay the same within a window of the ttl and expire one to two ttls after they were handed out.
+static_url_signing = os.environ.get("STATIC_URL_SIGNING", "false").lower() in ("1", "true", "yes")
+static_url_ttl_seconds = int(os.environ.get("STATIC_URL_TTL", str(60 * 60 * 24 * 7)))
+# "python" streams /static from the app, "x-accel-redirect" (nginx) and "x-sendfile" hand the file to the web server
+static_delivery = os.environ.get("STATIC_DELIVERY", "python")
+# internal nginx location aliasing the static directory, used by x-accel-redirect
+static_accel_redirect_prefix = os.environ.get("STATIC_ACCEL_REDIRECT_PREFIX", "/internal/static/")
+
+# number of threads fetching link previews in the background
+preview_workers = int(os.environ.get("PREVIEW_WORKERS", "4"))
+
+# link previews are cached per url, failed lookups are retried with exponential backoff
+preview_cache_ttl_seconds = int(os.environ.get("PREVIEW_CACHE_TTL", str(60 * 60 * 24 * 7)))
+preview_failure_backoff_seconds = 5 * 60
+preview_failure_backoff_max_seconds = 60 * 60 * 24
+
+# outgoing http requests for link previews
+http_timeout_seconds = float(os.environ.get("HTTP_TIMEOUT", "5"))
+http_retries = int(os.environ.get("HTTP_RETRIES", "2"))
+http_pool_size = int(os.environ.get("HTTP_POOL_SIZE", "10"))
+http_max_concurrency = int(os.environ.get("HTTP_MAX_CONCURRENCY", "8"))
+
+# limits for downloading and decoding preview images
+preview_max_html_bytes = 2 * 1024 * 1024
+preview_max_image_bytes = 10 * 1024 * 1024
+preview_max_image_pixels = 40_000_000
+preview_thumbnail_size = 600
+
+# smaller renditions of each preview (longest edge in pixels), encoded as webp and jpeg fallback
+preview_rendition_sizes = (160, 320, 600)
+preview_rendition_formats = ("webp", "jpeg")
+rendition_workers = int(os.environ.get("RENDITION_WORKERS", "2"))
+
+# responses of /api/gift-lists, /api/users and /api/receiver kept per worker, see backend.response_cache
+response_cache_max_entries = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+
+# push of gift and vote changes: "local" for a single API worker, "postgres" (LISTEN/NOTIFY) for several
+event_broker = os.environ.get("EVENT_BROKER", "local")
+event_queue_size = int(os.environ.get("EVENT_QUEUE_SIZE", "100"))
+event_heartbeat_seconds = float(os.environ.get("EVENT_HEARTBEAT_SECONDS", "15"))
+event_retry_ms = int(os.environ.get("EVENT_RETRY_MS", "3000"))
+
+# processes solving the groups of a batch pairing run, defaults to one per CPU
+pairing_workers = int(os.environ.get("PAIRING_WORKERS", "0")) or os.cpu_count() or 1
+
+# secret for signing session cookies, generated and stored next to the database if not set
+session_secret_path = db_path.parent / "session_secret"
+session_max_age_seconds = 60 * 60 * 24 * 30  # 30 days
+
+# sqlite tuning, applied to every new connection
+sqlite_mmap_size_bytes = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+sqlite_cache_size_kib = int(os.environ.get("SQLITE_CACHE_SIZE_KIB", str(64 * 1024)))
+sqlite_busy_timeout_ms = 5000
@@ -1,17 +1,68 @@
 # SQLAlchemy setup and models for Secret Santa
 from fastapi import HTTPException
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey
+from sqlalchemy import (create_engine, event, BigInteger, Boolean, Column, Integer, String, Text, ForeignKey, Float,
+                        Index)
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship, Session
 from starlette.requests import Request
 
-from backend.config import db_path
+from backend import config
 
-DATABASE_URL = f"sqlite:///{db_path}"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+DATABASE_URL = config.database_url
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+
+def get_async_database_url(url: str) -> str:
+    """Swaps the driver of the url for its asyncio counterpart."""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith(("postgresql:", "postgres:")):
+        return "postgresql+asyncpg:" + url.split(":", 1)[1]
+    return url
+
+
+connect_args = {"check_same_thread": False} if IS_SQLITE else {}
+
+# sync engine for scripts and background threads
+engine = create_engine(DATABASE_URL, connect_args=connect_args, pool_pre_ping=True,
+                       query_cache_size=config.db_statement_cache_size)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# async engine for the request handlers
+async_engine = create_async_engine(
+    get_async_database_url(DATABASE_URL),
+    connect_args=connect_args,
+    pool_size=config.db_pool_size,
+    max_overflow=config.db_max_overflow,
+    pool_timeout=config.db_pool_timeout_seconds,
+    pool_pre_ping=True,
+    query_cache_size=config.db_statement_cache_size,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    WAL lets readers continue while a vote or gift is written, synchronous=NORMAL is safe with WAL and
+    avoids an fsync per commit. mmap and a larger page cache keep the hot tables in memory.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={config.sqlite_mmap_size_bytes}")
+    # negative values are KiB instead of pages
+    cursor.execute(f"PRAGMA cache_size=-{config.sqlite_cache_size_kib}")
+    cursor.execute(f"PRAGMA busy_timeout={config.sqlite_busy_timeout_ms}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+if IS_SQLITE:
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+
+
 def get_db():
     db = SessionLocal()
     try:
@@ -20,6 +71,11 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 # Example User model (replace with your fields)
 class User(Base):
     __tablename__ = "users"
@@ -28,14 +84,58 @@ class User(Base):
     token = Column(String, unique=True, index=True)
 
 
+class Group(Base):
+    """One independent secret santa exchange, e.g. a family or a team."""
+    __tablename__ = "user_groups"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+    # nobody gets a receiver they already had within the last history_years years
+    history_years = Column(Integer, nullable=False, default=1, server_default="1")
+    # bumped by every write that changes cached responses of the group, see backend.response_cache
+    cache_version = Column(Integer, nullable=False, default=0, server_default="0")
+
+
+class Membership(Base):
+    __tablename__ = "memberships"
+    id = Column(Integer, primary_key=True, index=True)
+    group_id = Column(Integer, ForeignKey("user_groups.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    # members of the same household never draw each other
+    household = Column(String, nullable=True)
+    group = relationship("Group")
+    user = relationship("User")
+    __table_args__ = (
+        Index("uq_memberships_group_id_user_id", "group_id", "user_id", unique=True),
+        Index("ix_memberships_user_id", "user_id"),
+    )
+
+
+class ExclusionRule(Base):
+    """The giver must not draw the receiver in this group, mutual rules (e.g. couples) apply in both directions."""
+    __tablename__ = "exclusion_rules"
+    id = Column(Integer, primary_key=True, index=True)
+    group_id = Column(Integer, ForeignKey("user_groups.id"), nullable=False)
+    giver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    receiver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    mutual = Column(Boolean, nullable=False, default=True, server_default="1")
+    __table_args__ = (
+        Index("uq_exclusion_rules_group_id_giver_id_receiver_id", "group_id", "giver_id", "receiver_id", unique=True),
+    )
+
+
 class SecretSantaPair(Base):
     __tablename__ = "pairs"
     id = Column(Integer, primary_key=True, index=True)
     year = Column(Integer, nullable=False)
     giver_id = Column(Integer, ForeignKey("users.id"))
     receiver_id = Column(Integer, ForeignKey("users.id"))
+    group_id = Column(Integer, ForeignKey("user_groups.id"), nullable=True)
     giver = relationship("User", foreign_keys=[giver_id])
     receiver = relationship("User", foreign_keys=[receiver_id])
+    __table_args__ = (
+        Index("ix_pairs_giver_id_year", "giver_id", "year"),
+        Index("ix_pairs_group_id_year", "group_id", "year"),
+    )
 
 
 class Gift(Base):
@@ -48,8 +148,13 @@ class Gift(Base):
     year = Column(Integer, nullable=False)
     created_by_id = Column(Integer, ForeignKey("users.id"))
     created_for_id = Column(Integer, ForeignKey("users.id"))
+    group_id = Column(Integer, ForeignKey("user_groups.id"), nullable=True)
     created_by = relationship("User", foreign_keys=[created_by_id])
     created_for = relationship("User", foreign_keys=[created_for_id])
+    __table_args__ = (
+        Index("ix_gifts_created_for_id_year", "created_for_id", "year"),
+        Index("ix_gifts_group_id_year_created_for_id", "group_id", "year", "created_for_id"),
+    )
 
 
 class Vote(Base):
@@ -60,6 +165,45 @@ class Vote(Base):
     gift_id = Column(Integer, ForeignKey("gifts.id"))
     user = relationship("User")
     gift = relationship("Gift")
+    __table_args__ = (
+        # one vote per user and gift, also serves the lookups by gift
+        Index("uq_votes_gift_id_user_id", "gift_id", "user_id", unique=True),
+    )
+
+
+class LinkPreview(Base):
+    """Cached result of a link preview, keyed by the normalized link. Failed lookups are cached as well."""
+    __tablename__ = "link_previews"
+    url = Column(String, primary_key=True)
+    image_url = Column(String, nullable=True)
+    preview_image_path = Column(String, nullable=True)
+    failures = Column(Integer, nullable=False, default=0)
+    fetched_at = Column(Float, nullable=False)
+    expires_at = Column(Float, nullable=False, index=True)
+
+
+class PairingRun(Base):
+    """
+    Audit record of one pairing run: the seed and the solver input snapshot are enough to replay it exactly,
+    the result hash proves which pairs it produced.
+    """
+    __tablename__ = "pairing_runs"
+    id = Column(Integer, primary_key=True, index=True)
+    group_id = Column(Integer, ForeignKey("user_groups.id"), nullable=False)
+    year = Column(Integer, nullable=False)
+    mode = Column(String, nullable=False)  # "full" or "incremental"
+    parent_run_id = Column(Integer, ForeignKey("pairing_runs.id"), nullable=True)
+    seed = Column(BigInteger, nullable=False)
+    solver = Column(String, nullable=False)
+    input_hash = Column(String(64), nullable=False)
+    input_snapshot = Column(Text, nullable=False)
+    result_hash = Column(String(64), nullable=False)
+    stats = Column(Text, nullable=False)
+    started_at = Column(Float, nullable=False)
+    duration_ms = Column(Float, nullable=False)
+    __table_args__ = (
+        Index("ix_pairing_runs_group_id_year", "group_id", "year"),
+    )
 
 
 def get_user_by_username(db, username: str):
@@ -0,0 +1,237 @@
+# Push of small change events (gifts, votes, previews) to the clients of a group over Server-Sent Events
+import asyncio
+import importlib.util
+import json
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import AsyncIterator
+
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+from backend import config
+
+GIFT_ADDED = "gift_added"
+GIFT_UPDATED = "gift_updated"
+GIFT_DELETED = "gift_deleted"
+VOTE_CHANGED = "vote_changed"
+PREVIEW_READY = "preview_ready"
+# sent instead of events a slow client missed, it has to fetch the full state again
+RESYNC = "resync"
+
+POSTGRES_CHANNEL = "secret_santa_events"
+
+
+def group_channel(group_id: int) -> str:
+    return f"group:{group_id}"
+
+
+@dataclass
+class Event:
+    type: str
+    data: dict
+    # gifts stay a surprise: the receiver of a gift added by someone else must not see its events
+    hidden_from_user_id: int | None = None
+
+    def to_json(self, channel: str) -> str:
+        return json.dumps({"channel": channel, "type": self.type, "data": self.data,
+                           "hidden_from_user_id": self.hidden_from_user_id}, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, payload: str) -> tuple[str, "Event"]:
+        message = json.loads(payload)
+        return message["channel"], cls(message["type"], message["data"], message["hidden_from_user_id"])
+
+
+def gift_event(event_type: str, gift_id: int, group_id: int | None, created_by_id: int, created_for_id: int,
+               data: dict = None) -> tuple[str | None, Event]:
+    """Builds the event of a gift change, returns its channel (None for gifts without group) and the event."""
+    hidden_from = created_for_id if created_by_id != created_for_id else None
+    payload = {"gift_id": gift_id, "created_for_id": created_for_id, **(data or {})}
+    return (group_channel(group_id) if group_id is not None else None), Event(event_type, payload, hidden_from)
+
+
+@dataclass(eq=False)
+class Subscription:
+    """Queue of one connected client. Events are put from any thread through the queue's loop."""
+    channel: str
+    user_id: int
+    loop: asyncio.AbstractEventLoop
+    queue: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(maxsize=config.event_queue_size))
+    overflowed: bool = False
+
+    def deliver(self, event: Event):
+        if event.hidden_from_user_id == self.user_id:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # the client is too slow, drop everything and let it fetch the full state again
+            self.overflowed = True
+
+    async def get(self) -> Event:
+        event = await self.queue.get()
+        if self.overflowed:
+            self.overflowed = False
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = Event(RESYNC, {})
+        return event
+
+
+class LocalBroker:
+    """In-process pub/sub, enough for a single API worker."""
+
+    def __init__(self):
+        self._subscriptions: dict[str, set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, channel: str, user_id: int) -> Subscription:
+        subscription = Subscription(channel=channel, user_id=user_id, loop=asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def deliver(self, channel: str, event: Event):
+        """Hands the event to all local subscribers of the channel, safe to call from any thread."""
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+
+    def publish(self, channel: str, event: Event):
+        """Publishes from sync code, e.g. the preview worker threads."""
+        self.deliver(channel, event)
+
+    async def apublish(self, channel: str, event: Event):
+        """Publishes from the event loop."""
+        self.deliver(channel, event)
+
+
+class PostgresBroker(LocalBroker):
+    """
+    Fans events out to every API worker with postgres LISTEN/NOTIFY. Each worker keeps one listening connection
+    and delivers the notifications to its local subscribers. Payloads are limited to 8000 bytes by postgres,
+    events only carry ids and a few fields.
+    """
+
+    def __init__(self, database_url: str):
+        super().__init__()
+        self.database_url = database_url
+        self._connection = None
+
+    async def start(self):
+        import asyncpg
+
+        # asyncpg takes a plain postgresql:// url without the sqlalchemy driver suffix
+        dsn = make_url(self.database_url).set(drivername="postgresql").render_as_string(hide_password=False)
+        self._connection = await asyncpg.connect(dsn)
+        await self._connection.add_listener(POSTGRES_CHANNEL, self._on_notification)
+
+    async def stop(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    def _on_notification(self, connection, pid, channel, payload):
+        try:
+            event_channel, event = Event.from_json(payload)
+        except (ValueError, KeyError) as e:
+            logging.warning(f"Ignoring malformed event notification: {e}")
+            return
+        self.deliver(event_channel, event)
+
+    def publish(self, channel: str, event: Event):
+        from backend.db import engine
+
+        with engine.begin() as connection:
+            connection.execute(text("SELECT pg_notify(:channel, :payload)"),
+                               {"channel": POSTGRES_CHANNEL, "payload": event.to_json(channel)})
+
+    async def apublish(self, channel: str, event: Event):
+        await asyncio.to_thread(self.publish, channel, event)
+
+
+def check_postgres_broker(database_url: str):
+    """
+    Raises a ValueError if the postgres broker cannot work with database_url: it needs a postgres database,
+    asyncpg for listening and the sync driver of the url for publishing (the postgres extra of the backend).
+    """
+    url = make_url(database_url)
+    if url.get_backend_name() != "postgresql":
+        raise ValueError(f"EVENT_BROKER=postgres needs a postgresql DATABASE_URL, got {url.get_backend_name()}")
+    missing = [module for module in ("asyncpg", url.get_dialect().driver) if importlib.util.find_spec(module) is None]
+    if missing:
+        raise ValueError(f"EVENT_BROKER=postgres needs {', '.join(missing)}, "
+                         "install the postgres extra: uv sync --extra postgres")
+
+
+def create_broker() -> LocalBroker:
+    if config.event_broker == "postgres":
+        check_postgres_broker(config.database_url)
+        return PostgresBroker(config.database_url)
+    if config.event_broker != "local":
+        raise ValueError(f"Unknown event broker: {config.event_broker}")
+    return LocalBroker()
+
+
+broker = create_broker()
+
+
+def publish(channel: str | None, event: Event):
+    """Publishes an event after the change was committed, events of gifts without group are dropped."""
+    if channel is None:
+        return
+    try:
+        broker.publish(channel, event)
+    except Exception as e:
+        # clients resync on reconnect, a lost event must never fail the write that caused it
+        logging.warning(f"Publishing {event.type} to {channel} failed: {e}")
+
+
+async def apublish(channel: str | None, event: Event):
+    if channel is None:
+        return
+    try:
+        await broker.apublish(channel, event)
+    except Exception as e:
+        logging.warning(f"Publishing {event.type} to {channel} failed: {e}")
+
+
+def format_sse(event: Event) -> str:
+    return f"event: {event.type}\ndata: {json.dumps(event.data, ensure_ascii=False)}\n\n"
+
+
+async def stream(channel: str, user_id: int, is_disconnected) -> AsyncIterator[str]:
+    """
+    Yields the Server-Sent Events of the channel for one client until it disconnects. Starts with a resync,
+    so the client fetches the full state once and then only patches it, and sends a comment as heartbeat.
+    :param is_disconnected: coroutine function telling if the client is gone (request.is_disconnected)
+    """
+    subscription = broker.subscribe(channel, user_id)
+    try:
+        yield f"retry: {config.event_retry_ms}\n" + format_sse(Event(RESYNC, {}))
+        while not await is_disconnected():
+            try:
+                event = await asyncio.wait_for(subscription.get(), timeout=config.event_heartbeat_seconds)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            yield format_sse(event)
+    finally:
+        broker.unsubscribe(subscription)
@@ -0,0 +1,80 @@
+# Exclusion rules of the pairing (couples, households, recent receivers) as an index based adjacency for the solver
+from collections import defaultdict
+
+from sqlalchemy import literal, select, union_all
+from sqlalchemy.orm import Session
+
+from backend.db import ExclusionRule, Group, Membership, SecretSantaPair, User
+
+
+def get_members_with_households(db: Session, group_id: int) -> list[tuple[int, str, str | None]]:
+    """Returns (user id, name, household) of all members of the group ordered by name."""
+    return list(db.execute(
+        select(User.id, User.name, Membership.household)
+        .join(Membership, Membership.user_id == User.id)
+        .where(Membership.group_id == group_id)
+        .order_by(User.name)
+    ).all())
+
+
+def get_history_years(db: Session, group_id: int) -> int:
+    return db.execute(select(Group.history_years).where(Group.id == group_id)).scalar_one()
+
+
+def excluded_edges_query(group_id: int, year: int, history_years: int):
+    """
+    One query for every excluded (giver id, receiver id) edge of the group: the rules, mutual rules reversed,
+    and the pairs of the history_years years before year (served by ix_pairs_group_id_year).
+    """
+    rules = select(ExclusionRule.giver_id, ExclusionRule.receiver_id).where(ExclusionRule.group_id == group_id)
+    reversed_rules = (select(ExclusionRule.receiver_id, ExclusionRule.giver_id)
+                      .where(ExclusionRule.group_id == group_id, ExclusionRule.mutual == literal(True)))
+    parts = [rules, reversed_rules]
+    if history_years > 0:
+        parts.append(select(SecretSantaPair.giver_id, SecretSantaPair.receiver_id).where(
+            SecretSantaPair.group_id == group_id,
+            SecretSantaPair.year >= year - history_years,
+            SecretSantaPair.year < year,
+        ))
+    return union_all(*parts)
+
+
+def build_adjacency(user_ids: list[int], households: list[str | None],
+                    edges: list[tuple[int, int]]) -> list[set[int]]:
+    """
+    Turns excluded id edges and households into excluded[giver index] = receiver indices, the format of
+    pairing_solver.solve_assignment. Edges of users outside the group are ignored.
+    """
+    index_of = {user_id: i for i, user_id in enumerate(user_ids)}
+    excluded = [set() for _ in user_ids]
+    for giver_id, receiver_id in edges:
+        giver, receiver = index_of.get(giver_id), index_of.get(receiver_id)
+        if giver is not None and receiver is not None:
+            excluded[giver].add(receiver)
+
+    members_of = defaultdict(list)
+    for i, household in enumerate(households):
+        if household:
+            members_of[household].append(i)
+    for members in members_of.values():
+        for i in members:
+            excluded[i].update(members)
+    return excluded
+
+
+def load_exclusions(db: Session, group_id: int, year: int, user_ids: list[int], households: list[str | None],
+                    history_years: int = None) -> list[set[int]]:
+    """Loads all exclusions of the group for a pairing in year, history_years defaults to the group's setting."""
+    if history_years is None:
+        history_years = get_history_years(db, group_id)
+    edges = db.execute(excluded_edges_query(group_id, year, history_years)).all()
+    return build_adjacency(user_ids, households, edges)
+
+
+def add_exclusion_rule(db: Session, group_id: int, giver_id: int, receiver_id: int, mutual: bool = True):
+    """Adds the rule unless it exists already. Does not commit."""
+    exists = db.execute(select(ExclusionRule.id).where(
+        ExclusionRule.group_id == group_id, ExclusionRule.giver_id == giver_id, ExclusionRule.receiver_id == receiver_id
+    )).first()
+    if exists is None:
+        db.add(ExclusionRule(group_id=group_id, giver_id=giver_id, receiver_id=receiver_id, mutual=mutual))
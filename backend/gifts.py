@@ -1,13 +1,25 @@
 import datetime
 import logging
 
-from backend import config
-from backend.db import User, SecretSantaPair, Gift, Vote
-from sqlalchemy.orm import Session
+from backend import config, events, preview_store
+from backend.auth import Principal
+from backend.db import User, Group, SecretSantaPair, Gift, Vote
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased, joinedload
 from pydantic import BaseModel
-from typing import Union, List
+from typing import List
 
-from backend.link_preview import preview_external_links
+from backend.renditions import rendition_suffix
+from backend.preview_worker import schedule_preview, preview_status, PREVIEW_READY
+from backend.response_cache import bump_version
+from backend.static_files import sign_url
+
+
+class Rendition(BaseModel):
+    url: str
+    max_size: int
+    format: str
 
 
 class GiftOut(BaseModel):
@@ -15,10 +27,12 @@ class GiftOut(BaseModel):
     title: str
     created_by_name: str
     created_for_name: str
-    votes: Union[str, int]
+    votes: int
     preview_image_path: str
     link: str | None = None
-
+    user_vote: str | None = None
+    preview_status: str = PREVIEW_READY
+    renditions: List[Rendition] = []
 
 
 class UserGiftList(BaseModel):
@@ -27,113 +41,239 @@ class UserGiftList(BaseModel):
     gifts: List[GiftOut]
 
 
-def get_receiver(user: User, db: Session, year: int = None) -> User | None:
+def preview_url(preview_image_path: str | None) -> str:
+    """Url of the gift's preview for clients: the default preview if it has none, signed if signing is enabled."""
+    return sign_url(preview_image_path) if preview_image_path else config.default_preview_image_path
+
+
+def get_renditions(preview_image_path: str | None) -> List[Rendition]:
     """
-    Returns the receiver User object for the given user and year.
+    Returns the smaller renditions of a stored preview image, smallest first, so clients can pick the first
+    one that fits. The default and legacy previews have none.
     """
+    if not preview_store.is_stored_url(preview_image_path):
+        return []
+    stem = preview_image_path.rsplit(".", 1)[0]
+    return [
+        Rendition(url=sign_url(f"{stem}_{rendition_suffix(size, image_format)}"), max_size=size, format=image_format)
+        for size in sorted(config.preview_rendition_sizes)
+        for image_format in config.preview_rendition_formats
+    ]
+
+
+async def get_receiver_name(user: User | Principal, db: AsyncSession, year: int = None,
+                            group_id: int = None) -> str | None:
+    """Returns only the name of the user's receiver, one joined query without loading the User row."""
     if year is None:
         year = datetime.datetime.now().year
-    pair = db.query(SecretSantaPair).filter_by(giver_id=user.id, year=year).first()
-    return pair.receiver if pair and pair.receiver else None
+    statement = (
+        select(User.name)
+        .join(SecretSantaPair, SecretSantaPair.receiver_id == User.id)
+        .where(SecretSantaPair.giver_id == user.id, SecretSantaPair.year == year)
+    )
+    if group_id is not None:
+        statement = statement.where(SecretSantaPair.group_id == group_id)
+    result = await db.execute(statement.limit(1))
+    return result.scalar_one_or_none()
+
+
+class PairOut(BaseModel):
+    group: str | None
+    giver: str
+    receiver: str
+
+
+async def get_pairs_with_names(db: AsyncSession, year: int, group_id: int = None) -> list[PairOut]:
+    """
+    Returns all pairs of the year (of one group if given) with giver, receiver and group names.
+    Giver and receiver are joined as aliases of users, so it is one query at any group size.
+    """
+    giver = aliased(User)
+    receiver = aliased(User)
+    statement = (
+        select(Group.name, giver.name, receiver.name)
+        .select_from(SecretSantaPair)
+        .join(giver, SecretSantaPair.giver_id == giver.id)
+        .join(receiver, SecretSantaPair.receiver_id == receiver.id)
+        .outerjoin(Group, SecretSantaPair.group_id == Group.id)
+        .where(SecretSantaPair.year == year)
+        .order_by(Group.name, giver.name)
+    )
+    if group_id is not None:
+        statement = statement.where(SecretSantaPair.group_id == group_id)
+    result = await db.execute(statement)
+    return [PairOut(group=group_name, giver=giver_name, receiver=receiver_name)
+            for group_name, giver_name, receiver_name in result.all()]
+
+
+def filter_own_gifts(gift_list: UserGiftList) -> UserGiftList:
+    """Only keeps the gifts a user added to their own list, gifts added by others stay a surprise."""
+    gift_list.gifts = [g for g in gift_list.gifts if g.created_by_name == gift_list.username]
+    return gift_list
+
 
+def user_vote_state(value: int | None) -> str:
+    """Maps the value of a user's vote to the state reported to the frontend."""
+    if value is None:
+        return "inactive"
+    return "up" if value > 0 else "down"
 
-def get_own_gift_list(user: User, db: Session, year: int = None) -> UserGiftList:
-    own_gift_list = get_gift_list(user, db, year)
-    own_gift_list.gifts = [g for g in own_gift_list.gifts if g.created_by_name == user.name]
-    return own_gift_list
+
+async def get_vote_totals(gift_ids: List[int], db: AsyncSession) -> dict[int, int]:
+    """Returns the sum of all votes per gift id in one GROUP BY query. Gifts without votes are left out."""
+    if not gift_ids:
+        return {}
+    result = await db.execute(
+        select(Vote.gift_id, func.sum(Vote.value))
+        .where(Vote.gift_id.in_(gift_ids))
+        .group_by(Vote.gift_id)
+    )
+    return dict(result.all())
 
 
-def get_gift_list(user: User, db: Session, year: int = None, current_user: User = None) -> UserGiftList:
+def gift_out(gift: Gift, votes: int = 0, user_vote: str | None = None) -> GiftOut:
+    """Builds the GiftOut of a gift whose created_by and created_for are loaded."""
+    return GiftOut(
+        pk=gift.id,
+        title=gift.title,
+        created_by_name=gift.created_by.name,
+        created_for_name=gift.created_for.name,
+        votes=votes,
+        user_vote=user_vote,
+        link=gift.link,
+        preview_image_path=preview_url(gift.preview_image_path),
+        preview_status=preview_status(gift),
+        renditions=get_renditions(gift.preview_image_path)
+    )
+
+
+async def get_gift_lists(users: List[User], db: AsyncSession, year: int = None,
+                         current_user: User | Principal = None, group_id: int = None) -> dict[int, UserGiftList]:
     """
-    Returns a list of GiftOut for each gift for a user in a given year.
-    If current_user is provided, includes the vote by current_user for each gift.
+    Returns the UserGiftList for each of the given users in a given year (and group, if given), keyed by user id.
+    All gifts are loaded in one query with their users, the vote totals in a second one and the votes of
+    current_user (if provided) in a third one.
     """
     if year is None:
         year = datetime.datetime.now().year
-    gifts = db.query(Gift).filter_by(created_for_id=user.id, year=year).all()
-    gift_list = []
+    user_ids = [user.id for user in users]
+    statement = (
+        select(Gift)
+        .options(joinedload(Gift.created_by), joinedload(Gift.created_for))
+        .where(Gift.created_for_id.in_(user_ids), Gift.year == year)
+    )
+    if group_id is not None:
+        statement = statement.where(Gift.group_id == group_id)
+    result = await db.execute(statement.order_by(Gift.id))
+    gifts = result.scalars().all()
+
+    gift_ids = [gift.id for gift in gifts]
+    vote_totals = await get_vote_totals(gift_ids, db)
+    user_votes = {}
+    if current_user and gifts:
+        result = await db.execute(
+            select(Vote.gift_id, Vote.value)
+            .where(Vote.user_id == current_user.id, Vote.gift_id.in_(gift_ids))
+        )
+        user_votes = dict(result.all())
+
+    gifts_by_user = {user_id: [] for user_id in user_ids}
     for gift in gifts:
-        if current_user:
-            vote = db.query(Vote).filter_by(gift_id=gift.id, user_id=current_user.id).first()
-            votes = vote.value if vote else "undefined"
-        else:
-            votes = 0
-        gift_list.append(GiftOut(
-            pk=gift.id,
-            title=gift.title,
-            created_by_name=gift.created_by.name,
-            created_for_name=gift.created_for.name,
-            votes=votes,
-            link=gift.link if hasattr(gift, 'link') else None,
-            preview_image_path=gift.preview_image_path if gift.preview_image_path else config.default_preview_image_path
+        gifts_by_user[gift.created_for_id].append(gift_out(
+            gift,
+            votes=vote_totals.get(gift.id, 0),
+            user_vote=user_vote_state(user_votes.get(gift.id)) if current_user else None
         ))
 
-    return UserGiftList(
-        pk=user.id,
-        username=user.name,
-        gifts=gift_list
+    return {
+        user.id: UserGiftList(pk=user.id, username=user.name, gifts=gifts_by_user[user.id])
+        for user in users
+    }
+
+
+async def get_gift(gift_id: int, db: AsyncSession) -> Gift | None:
+    """Loads a gift together with the users it was created by and for."""
+    result = await db.execute(
+        select(Gift)
+        .options(joinedload(Gift.created_by), joinedload(Gift.created_for))
+        .where(Gift.id == gift_id)
     )
+    return result.scalars().first()
 
 
-def add_or_update_gift(db: Session,
-                       title: str,
-                       created_by: User,
-                       created_for: User,
-                       year: int = None,
-                       description: str = "",
-                       link: str = "",
-                       gift_pk: int = None) -> GiftOut:
+async def add_or_update_gift(db: AsyncSession,
+                             title: str,
+                             created_by: User | Principal,
+                             created_for: User,
+                             year: int = None,
+                             description: str = "",
+                             link: str = "",
+                             gift_pk: int = None,
+                             group_id: int = None) -> GiftOut:
     """
     Adds a new gift or updates an existing gift.
     If gift_pk is provided, updates the existing gift with that primary key.
+    The link preview is generated in the background, until then the gift is returned with a pending preview.
     """
     if year is None:
         year = datetime.datetime.now().year
 
     is_new_gift = gift_pk is None
+    previous_link = None
     if is_new_gift:
         gift = Gift(
             title=title,
             description=description,
             link=link,
             year=year,
-            created_by=created_by,
             created_by_id=created_by.id,
-            created_for=created_for,
-            created_for_id=created_for.id
+            created_for_id=created_for.id,
+            group_id=group_id
         )
     else:
-        gift = db.query(Gift).filter_by(id=gift_pk).first()
+        gift = await db.get(Gift, gift_pk)
         if gift is None:
             raise ValueError("Gift with the given primary key does not exist.")
+        previous_link = gift.link
 
         gift.title = title
         gift.description = description
         gift.link = link
         gift.year = year
-        gift.created_by = created_by
         gift.created_by_id = created_by.id
-        gift.created_for = created_for
         gift.created_for_id = created_for.id
 
-    if gift.link:
-        logging.info(f"Generating preview for link: {gift.link}")
-        gift.preview_image_path = preview_external_links(gift.link)
-    else:
+    if not gift.link:
         logging.info("No link provided, using default preview image.")
         gift.preview_image_path = config.default_preview_image_path
+    elif gift.link != previous_link:
+        gift.preview_image_path = None
 
     if is_new_gift:
         db.add(gift)
 
-    db.commit()
+    await bump_version(db, gift.group_id)
+    await db.commit()
 
-    return GiftOut(
+    if gift.link and gift.link != previous_link:
+        logging.info(f"Scheduling preview for link: {gift.link}")
+        schedule_preview(gift.id, gift.link)
+
+    votes = 0 if is_new_gift else (await get_vote_totals([gift.id], db)).get(gift.id, 0)
+    gift_out = GiftOut(
         pk=gift.id,
         title=gift.title,
         created_by_name=created_by.name,
         created_for_name=created_for.name,
-        votes=0,
-        preview_image_path=gift.preview_image_path,
+        votes=votes,
+        preview_image_path=preview_url(gift.preview_image_path),
+        preview_status=preview_status(gift),
+        renditions=get_renditions(gift.preview_image_path),
         link=gift.link
-    )
\ No newline at end of file
+    )
+    # user_vote is the creator's own state, other clients keep theirs
+    await events.apublish(*events.gift_event(
+        events.GIFT_ADDED if is_new_gift else events.GIFT_UPDATED, gift.id, gift.group_id,
+        gift.created_by_id, gift.created_for_id, {"gift": gift_out.model_dump(exclude={"user_vote"})}
+    ))
+    return gift_out
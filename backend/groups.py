@@ -0,0 +1,56 @@
+# Groups (independent exchanges) and the lookups scoping requests to one of them
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from backend.auth import Principal
+from backend.db import Group, Membership, User
+
+
+async def get_user_group_ids(user: User | Principal, db: AsyncSession) -> list[int]:
+    result = await db.execute(
+        select(Membership.group_id).where(Membership.user_id == user.id).order_by(Membership.group_id)
+    )
+    return list(result.scalars().all())
+
+
+async def resolve_group_id(user: User | Principal, db: AsyncSession, group_id: int | None = None) -> int:
+    """
+    Returns the group a request works on: the requested one if the user is a member, otherwise the user's first group.
+    The admin may access every group. Raises HTTPException(403) if the user is not in the requested group
+    or in no group at all.
+    """
+    is_admin = user.name == "admin"
+    if group_id is not None:
+        if not is_admin and not await is_group_member(user.id, group_id, db):
+            raise HTTPException(status_code=403, detail="Not a member of this group")
+        return group_id
+    group_ids = await get_user_group_ids(user, db)
+    if not group_ids and is_admin:
+        group_ids = list((await db.execute(select(Group.id).order_by(Group.id).limit(1))).scalars().all())
+    if not group_ids:
+        raise HTTPException(status_code=403, detail="Not a member of any group")
+    return group_ids[0]
+
+
+async def get_group_members(group_id: int, db: AsyncSession) -> list[User]:
+    """Returns the members of a group ordered by name, using the membership index instead of scanning all users."""
+    result = await db.execute(
+        select(User)
+        .join(Membership, Membership.user_id == User.id)
+        .where(Membership.group_id == group_id)
+        .order_by(User.name)
+    )
+    return list(result.scalars().all())
+
+
+async def is_group_member(user_id: int, group_id: int, db: AsyncSession) -> bool:
+    result = await db.execute(
+        select(Membership.id).where(Membership.user_id == user_id, Membership.group_id == group_id)
+    )
+    return result.first() is not None
+
+
+def get_group_by_name(db: Session, name: str) -> Group | None:
+    return db.query(Group).filter_by(name=name).first()
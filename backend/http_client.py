@@ -0,0 +1,140 @@
+# Shared http client for outgoing requests, reuses connections per host instead of opening new ones per request
+import asyncio
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from backend import config
+
+
+class HttpClient:
+    """
+    Shares per host connection pools with a retry policy for transient errors between all threads and bounds
+    the number of requests running at the same time, including the download of streamed bodies.
+    requests only speaks HTTP/1.1, connections are kept alive and reused instead.
+
+    requests.Session is not documented to be thread safe, it keeps cookies and settings per instance. Every thread
+    therefore gets its own session, all of them mount the same HTTPAdapter, whose urllib3 pools are thread safe.
+    """
+
+    def __init__(self, timeout: float = None, retries: int = None, pool_size: int = None,
+                 max_concurrency: int = None):
+        self.timeout = config.http_timeout_seconds if timeout is None else timeout
+        retries = config.http_retries if retries is None else retries
+        pool_size = config.http_pool_size if pool_size is None else pool_size
+        max_concurrency = config.http_max_concurrency if max_concurrency is None else max_concurrency
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            backoff_factor=0.3,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET", "HEAD"),
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self._local = threading.local()
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    @property
+    def session(self) -> requests.Session:
+        """The session of the calling thread."""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self._local.session = session
+        return session
+
+    def get(self, url: str, headers: dict = None, timeout: float = None, stream: bool = False) -> requests.Response:
+        """
+        Sends a GET request over a pooled connection, waits if max_concurrency requests are running.
+        A streamed response holds its slot until it is closed, so callers must close it (use it as context manager).
+        """
+        self._semaphore.acquire()
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout if timeout is None else timeout,
+                                        stream=stream)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        if not stream:
+            # the body was read by requests already
+            self._semaphore.release()
+            return response
+        self._release_on_close(response)
+        return response
+
+    async def aget(self, url: str, headers: dict = None, timeout: float = None,
+                   stream: bool = False) -> requests.Response:
+        """
+        get for async handlers. The request and the wait for a free slot run in a worker thread, sync and async
+        callers share the max_concurrency bound. Reading a streamed body blocks as well, read it in a thread too.
+        A streamed response whose caller was cancelled is closed, so its slot is not lost.
+        """
+        lock = threading.Lock()
+        state = {"cancelled": False, "response": None}
+
+        def get_unless_cancelled() -> requests.Response:
+            response = self.get(url, headers=headers, timeout=timeout, stream=stream)
+            with lock:
+                if state["cancelled"]:
+                    response.close()
+                state["response"] = response
+            return response
+
+        try:
+            return await asyncio.to_thread(get_unless_cancelled)
+        except asyncio.CancelledError:
+            with lock:
+                state["cancelled"] = True
+                response = state["response"]
+            if response is not None:
+                response.close()
+            raise
+
+    def _release_on_close(self, response: requests.Response):
+        close = response.close
+        # popped exactly once, even if the response is closed twice or from several threads
+        pending_release = [self._semaphore.release]
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                try:
+                    release = pending_release.pop()
+                except IndexError:
+                    return
+                release()
+
+        response.close = close_and_release
+
+    def close(self):
+        self.adapter.close()
+
+
+_client: HttpClient | None = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> HttpClient:
+    """Returns the process wide client, created on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HttpClient()
+    return _client
+
+
+def close_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
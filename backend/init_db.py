@@ -1,17 +1,13 @@
 # Script to initialize the database and add the admin user
 import datetime
 
-from backend.db import User, Base, DATABASE_URL, SecretSantaPair
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from backend.db import User, engine, SessionLocal
+from backend import config, migrations, bulk_import
 
+from backend.exclusions import add_exclusion_rule
+from backend.groups import get_group_by_name
 from backend.pairing import create_secret_santa_pairs
-
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-# Create tables if they do not exist
-Base.metadata.create_all(bind=engine)
+from backend.tokens import new_token
 
 
 # Add admin user if not present
@@ -19,10 +15,10 @@ def add_admin():
     db = SessionLocal()
     admin = db.query(User).filter_by(name="admin").first()
     if not admin:
-        admin = User(name="admin", token="admin")
+        admin = User(name="admin", token=new_token())
         db.add(admin)
         db.commit()
-        print("Admin user created.")
+        print(f"Admin user created, login token: {admin.token}")
     else:
         print("Admin user already exists.")
     db.close()
@@ -37,42 +33,32 @@ def add_users():
         "Katharina",
         "Christoph"
     ]
+    # existing users are kept as they are, new ones get a random token (see python -m backend.tokens)
+    created = bulk_import.import_users(engine, [{"name": username, "group": config.default_group_name}
+                                               for username in users])
+    print(f"{created} of {len(users)} users created.")
+
+
+def add_couples(couples: list[tuple[str, str]]):
+    """Partners never draw each other, the rules are stored for the default group."""
     db = SessionLocal()
-    for username in users:
-        user = db.query(User).filter_by(name=username).first()
-        if not user:
-            user = User(name=username, token=username)
-            db.add(user)
-            print(f"User '{username}' created.")
-        else:
-            print(f"User '{username}' already exists.")
+    group = get_group_by_name(db, config.default_group_name)
+    ids = dict(db.query(User.name, User.id).filter(User.name.in_([name for couple in couples for name in couple])))
+    for first, second in couples:
+        add_exclusion_rule(db, group.id, ids[first], ids[second], mutual=True)
     db.commit()
     db.close()
+    print(f"{len(couples)} couples added.")
 
 
 def add_pairing(pairings: dict, year: str):
-    # create 3 pairs out of the 6 users
-    db = SessionLocal()
-
-    for giver_name, receiver_name in pairings.items():
-        giver = db.query(User).filter_by(name=giver_name).first()
-        receiver = db.query(User).filter_by(name=receiver_name).first()
-
-        existing_pair = db.query(SecretSantaPair).filter_by(giver_id=giver.id, year=year).first()
-        if not existing_pair:
-            pair = SecretSantaPair(giver_id=giver.id, receiver_id=receiver.id, year=year)
-            db.add(pair)
-            print(f"Pair ({giver.name} -> {receiver.name}) created for year {year}.")
-        else:
-            print(f"Pair for giver '{giver.name}' and year {year} already exists with receiver {pair.receiver_id}")
-
-    db.commit()
-    db.close()
+    rows = [{"giver": giver_name, "receiver": receiver_name, "year": year, "group": config.default_group_name}
+            for giver_name, receiver_name in pairings.items()]
+    created = bulk_import.import_pairs(engine, rows)
+    print(f"{created} of {len(rows)} pairs created for year {year}.")
 
 
 def init_gifts():
-    from backend.gifts import Gift
-    db = SessionLocal()
     gifts = [
         {
             "title": "Lego Set",
@@ -118,38 +104,25 @@ def init_gifts():
         }
     ]
     year = datetime.datetime.now().year
-    for gift_data in gifts:
-        created_by = db.query(User).filter_by(name=gift_data["created_by_name"]).first()
-        created_for = db.query(User).filter_by(name=gift_data["created_for_name"]).first()
-        if created_by and created_for:
-            existing_gift = db.query(Gift).filter_by(
-                title=gift_data["title"],
-                created_by_id=created_by.id,
-                created_for_id=created_for.id,
-                year=year
-            ).first()
-            if not existing_gift:
-                gift = Gift(
-                    title=gift_data["title"],
-                    description=gift_data["description"],
-                    link=gift_data["link"],
-                    created_by_id=created_by.id,
-                    created_for_id=created_for.id,
-                    year=year
-                )
-                db.add(gift)
-                print(
-                    f"Gift '{gift_data['title']}' from '{gift_data['created_by_name']}' to '{gift_data['created_for_name']}' created.")
-            else:
-                print(
-                    f"Gift '{gift_data['title']}' from '{gift_data['created_by_name']}' to '{gift_data['created_for_name']}' already exists.")
-    db.commit()
-    db.close()
+    rows = [{
+        "title": gift_data["title"],
+        "description": gift_data["description"],
+        "link": gift_data["link"],
+        "created_by": gift_data["created_by_name"],
+        "created_for": gift_data["created_for_name"],
+        "year": year,
+        "group": config.default_group_name
+    } for gift_data in gifts]
+    created = bulk_import.import_gifts(engine, rows)
+    print(f"{created} of {len(rows)} gifts created.")
 
 
 if __name__ == "__main__":
+    # Create or update the schema
+    migrations.upgrade(engine)
     add_admin()
     add_users()
+    add_couples([("Max", "Anka"), ("Katharina", "Christoph"), ("Roswitha", "Jürgen")])
     add_pairing(year="2024", pairings={
             "Max": "Katharina",
             "Katharina": "Jürgen",
@@ -4,40 +4,65 @@ from typing import Optional
 
 import requests
 from pathlib import Path
-from urllib.parse import urlparse, urljoin
-from PIL import Image
+from urllib.parse import urljoin
 from io import BytesIO
 from bs4 import BeautifulSoup
 
-from backend import config
+from backend import config, preview_store, preview_cache, http_client, renditions
 
 
-def fetch_url_content(url: str, timeout: int = 5) -> Optional[requests.Response]:
-    """Fetches the content from a URL and returns the response object. Sets browser-like headers to avoid blocks."""
-    user_agents = [
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Edge/91.0.864.59",
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    ]
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Edge/91.0.864.59",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+]
 
-    # Randomly select a user-agent from the list
-    headers = {
-        "User-Agent": random.choice(user_agents),
+
+def browser_headers() -> dict[str, str]:
+    """Browser-like headers with a random user agent, to avoid blocks."""
+    return {
+        "User-Agent": random.choice(USER_AGENTS),
         "Accept-Language": "en-US,en;q=0.5",
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
-        "Connection": "keep-alive",
         "Upgrade-Insecure-Requests": "1"
     }
+
+
+def _checked(response: requests.Response) -> Optional[requests.Response]:
     try:
-        response = requests.get(url, timeout=timeout, headers=headers)
         response.raise_for_status()
-        return response
+    except requests.HTTPError as e:
+        # a streamed response holds a slot of the client until it is closed
+        response.close()
+        logging.warning(f"Error fetching URL content: {e}")
+        return None
+    return response
+
+
+def fetch_url_content(url: str, timeout: float = None, stream: bool = False) -> Optional[requests.Response]:
+    """
+    Fetches the content from a URL over the shared pooled client and returns the response object,
+    None on errors.
+    """
+    try:
+        response = http_client.get_client().get(url, headers=browser_headers(), timeout=timeout, stream=stream)
+    except Exception as e:
+        logging.warning(f"Error fetching URL content: {e}")
+        return None
+    return _checked(response)
+
+
+async def afetch_url_content(url: str, timeout: float = None, stream: bool = False) -> Optional[requests.Response]:
+    """fetch_url_content for async handlers, without blocking the event loop."""
+    try:
+        response = await http_client.get_client().aget(url, headers=browser_headers(), timeout=timeout, stream=stream)
     except Exception as e:
         logging.warning(f"Error fetching URL content: {e}")
         return None
+    return _checked(response)
 
 
-def parse_html_for_image_url(html: str, base_url: str) -> str | None:
+def parse_html_for_image_url(html: str | bytes, base_url: str) -> str | None:
     """Parses HTML for Open Graph, Twitter Card, or favicon image URLs."""
     soup = BeautifulSoup(html, 'html.parser')
 
@@ -62,54 +87,102 @@ def parse_html_for_image_url(html: str, base_url: str) -> str | None:
     return None
 
 
-def download_and_save_image(img_url: str, fallback_name: str = 'preview_image') -> Path | None:
-    """Downloads an image from a URL and saves it locally as PNG. Returns the local path."""
+def read_capped(response: requests.Response, max_bytes: int, truncate: bool = False) -> bytes | None:
+    """
+    Reads a streamed response body, gives up as soon as it exceeds max_bytes.
+    Checks the announced Content-Length first so oversized bodies are not downloaded at all.
+    With truncate the first max_bytes are returned instead, enough for the head of an HTML page.
+    """
+    content_length = response.headers.get("Content-Length")
+    if not truncate and content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        logging.warning(f"Response of {response.url} too large: {content_length} bytes")
+        return None
+    buffer = BytesIO()
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        buffer.write(chunk)
+        if buffer.tell() > max_bytes:
+            if truncate:
+                logging.info(f"Response of {response.url} exceeded {max_bytes} bytes, using the first part")
+                return buffer.getvalue()[:max_bytes]
+            logging.warning(f"Response of {response.url} exceeded {max_bytes} bytes, aborting download")
+            return None
+    return buffer.getvalue()
+
+
+def download_and_save_image(img_url: str) -> Path | None:
+    """
+    Downloads an image from a URL and saves it as PNG thumbnail plus smaller renditions in the preview store.
+    Returns the local path of the PNG. The download is capped at config.preview_max_image_bytes and images with
+    more than config.preview_max_image_pixels pixels are rejected before decoding.
+    """
     try:
-
-        img_response = fetch_url_content(img_url, timeout=5)
-        img_response.raise_for_status()
-        image = Image.open(BytesIO(img_response.content))
-        parsed_url = urlparse(img_url)
-        # Always use .png extension for consistency
-        # random number as filename:
-        filename = f"{random.randint(1000, 9999)}.png"
-        local_path = config.previews / filename
-        local_path.parent.mkdir(parents=True, exist_ok=True)
-        # Convert to RGB if needed (e.g., for JPEG or palette images)
-        if image.mode in ("RGBA", "P", "LA"):
-            image = image.convert("RGBA")
-        else:
-            image = image.convert("RGB")
-        image.save(local_path, format="PNG")
-        return local_path
+        img_response = fetch_url_content(img_url, stream=True)
+        if img_response is None:
+            return None
+        with img_response:
+            data = read_capped(img_response, config.preview_max_image_bytes)
+        if data is None:
+            return None
+
+        rendered = renditions.render(data)
+        path = preview_store.store_image_bytes(rendered.png)
+        preview_store.store_renditions(path, rendered.renditions)
+        return path
     except Exception as e:
-        print(f"Error downloading image: {e}")
+        logging.warning(f"Error downloading image {img_url}: {e}")
         return None
 
 
-def preview_external_links(link: str) -> str:
+def fetch_preview(link: str) -> tuple[str | None, Path | None]:
     """
-    Fetches a preview image from the external link (Open Graph, Twitter Card, favicon, or direct image),
-    stores it locally, and returns the path to the stored image.
+    Fetches a preview image from the external link (Open Graph, Twitter Card, favicon, or direct image)
+    and stores it locally. Returns the resolved image url and the local path, both None if nothing was found.
     """
-    logging.info(f"Fetching link preview for: {link}")
-    response = fetch_url_content(link)
+    response = fetch_url_content(link, stream=True)
+    img_url = None
     img_path = None
     if not response:
         logging.info("No response received for link preview.")
 
     else:
-        if 'image' in response.headers.get('Content-Type', ''):
+        with response:
+            is_image = 'image' in response.headers.get('Content-Type', '')
+            # og:image and amazon's landingImage come early, large pages are parsed from their first part
+            html = None if is_image else read_capped(response, config.preview_max_html_bytes, truncate=True)
+
+        if is_image:
+            img_url = link
             img_path = download_and_save_image(link)
+        elif html is not None:
+            img_url = parse_html_for_image_url(html, link)
+            if img_url:
+                img_path = download_and_save_image(img_url)
+
+    return img_url, img_path
+
+
+def preview_external_links(link: str) -> str:
+    """
+    Returns the path to the locally stored preview image of the external link.
+    Results are cached per normalized url, so popular links are only fetched once per cache period
+    and failing links are not retried on every call.
+    """
+    logging.info(f"Fetching link preview for: {link}")
+    cache_key = preview_cache.normalize_url(link)
+    cached = preview_cache.lookup(cache_key)
+    if cached is not None:
+        logging.info(f"Link preview cache hit for: {cache_key}")
+        return config.default_preview_image_path if cached.failed else cached.preview_image_path
 
-        img_url = parse_html_for_image_url(response.text, link)
-        if img_url:
-            img_path = download_and_save_image(img_url)
+    img_url, img_path = fetch_preview(link)
 
     if img_path is None:
         logging.info("No preview image could be fetched.")
+        preview_cache.store(cache_key, img_url, None)
         return config.default_preview_image_path
 
     else:
         logging.info(f"Preview image saved at: {img_path}")
-        return config.previews_url + img_path.name
+        preview_image_path = preview_store.url_for_path(img_path)
+        preview_cache.store(cache_key, img_url, preview_image_path)
+        return preview_image_path
@@ -0,0 +1,327 @@
+# Versioned schema migrations, run with: python -m backend.migrations upgrade
+import argparse
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import Callable
+
+from sqlalchemy import (create_engine, inspect, text, BigInteger, Boolean, Column, Float, ForeignKey, Index, Integer,
+                        MetaData, String, Table, Text)
+from sqlalchemy.engine import Connection, Engine
+
+from backend import config
+from backend.tokens import is_guessable, new_token
+
+MIGRATIONS_TABLE = "schema_migrations"
+DEFAULT_BATCH_SIZE = 1000
+
+
+@dataclass
+class Migration:
+    """
+    One schema change. Transactional migrations run in a single transaction together with their bookkeeping.
+    Non transactional ones get an autocommit connection, so indexes can be built concurrently and backfills commit
+    per batch without locking the table for the whole run; they have to be safe to run again after a crash.
+    """
+    version: int
+    name: str
+    upgrade: Callable[[Connection], None]
+    transactional: bool = True
+
+
+def is_postgres(connection: Connection) -> bool:
+    return connection.dialect.name == "postgresql"
+
+
+def create_index(connection: Connection, name: str, table: str, columns: list[str], unique: bool = False):
+    """Creates the index if missing, concurrently on postgres (needs a non transactional migration)."""
+    concurrently = " CONCURRENTLY" if is_postgres(connection) else ""
+    unique_sql = "UNIQUE " if unique else ""
+    connection.execute(text(
+        f"CREATE {unique_sql}INDEX{concurrently} IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+    ))
+
+
+def add_column(connection: Connection, table: str, column: str, definition: str):
+    """Adds the column if the table does not have it yet."""
+    if column not in {c["name"] for c in inspect(connection).get_columns(table)}:
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+
+
+def run_in_batches(connection: Connection, statement: str, batch_size: int = DEFAULT_BATCH_SIZE, **params) -> int:
+    """
+    Repeats a statement limited by :batch_size (e.g. an UPDATE ... WHERE id IN (SELECT ... LIMIT :batch_size))
+    until it touches less than batch_size rows. On an autocommit connection every batch is committed on its own.
+    Returns the total number of rows.
+    """
+    total = 0
+    while True:
+        rowcount = connection.execute(text(statement), {"batch_size": batch_size, **params}).rowcount
+        total += rowcount
+        if rowcount < batch_size:
+            return total
+
+
+# Tables as each migration created them. Never import the models here: they describe the latest schema, a migration
+# has to create exactly what it did when it was written and leave later changes to the later migrations.
+frozen = MetaData()
+
+Table(
+    "users", frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("name", String, unique=True, index=True),
+    Column("token", String, unique=True, index=True),
+)
+Table(
+    "pairs", frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("year", Integer, nullable=False),
+    Column("giver_id", Integer, ForeignKey("users.id")),
+    Column("receiver_id", Integer, ForeignKey("users.id")),
+)
+Table(
+    "gifts", frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("title", String(200), nullable=False),
+    Column("description", String, nullable=True),
+    Column("link", String, nullable=True),
+    Column("preview_image_path", String, nullable=True),
+    Column("year", Integer, nullable=False),
+    Column("created_by_id", Integer, ForeignKey("users.id")),
+    Column("created_for_id", Integer, ForeignKey("users.id")),
+)
+Table(
+    "votes", frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("value", Integer),
+    Column("user_id", Integer, ForeignKey("users.id")),
+    Column("gift_id", Integer, ForeignKey("gifts.id")),
+)
+Table(
+    "link_previews", frozen,
+    Column("url", String, primary_key=True),
+    Column("image_url", String, nullable=True),
+    Column("preview_image_path", String, nullable=True),
+    Column("failures", Integer, nullable=False),
+    Column("fetched_at", Float, nullable=False),
+    Column("expires_at", Float, nullable=False, index=True),
+)
+Table(
+    "user_groups", frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("name", String, unique=True, nullable=False),
+)
+Table(
+    "memberships", frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("group_id", Integer, ForeignKey("user_groups.id"), nullable=False),
+    Column("user_id", Integer, ForeignKey("users.id"), nullable=False),
+)
+Table(
+    "exclusion_rules", frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("group_id", Integer, ForeignKey("user_groups.id"), nullable=False),
+    Column("giver_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("receiver_id", Integer, ForeignKey("users.id"), nullable=False),
+    Column("mutual", Boolean, nullable=False, server_default="1"),
+)
+Table(
+    "pairing_runs", frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("group_id", Integer, ForeignKey("user_groups.id"), nullable=False),
+    Column("year", Integer, nullable=False),
+    Column("mode", String, nullable=False),
+    Column("parent_run_id", Integer, ForeignKey("pairing_runs.id"), nullable=True),
+    Column("seed", BigInteger, nullable=False),
+    Column("solver", String, nullable=False),
+    Column("input_hash", String(64), nullable=False),
+    Column("input_snapshot", Text, nullable=False),
+    Column("result_hash", String(64), nullable=False),
+    Column("stats", Text, nullable=False),
+    Column("started_at", Float, nullable=False),
+    Column("duration_ms", Float, nullable=False),
+    Index("ix_pairing_runs_group_id_year", "group_id", "year"),
+)
+
+
+def create_tables(connection: Connection, names: list[str]):
+    """Creates the frozen tables (with their indexes) that don't exist yet."""
+    frozen.create_all(bind=connection, checkfirst=True, tables=[frozen.tables[name] for name in names])
+
+
+def _initial_schema(connection: Connection):
+    # the schema before migrations existed, databases of that time already have these tables
+    create_tables(connection, ["users", "pairs", "gifts", "votes", "link_previews"])
+
+
+def _hot_query_indexes(connection: Connection):
+    # duplicate votes of a user for a gift would break the unique index, the newest one is kept
+    removed = run_in_batches(connection, """
+        DELETE FROM votes WHERE id IN (
+            SELECT id FROM votes
+            WHERE id NOT IN (SELECT MAX(id) FROM votes GROUP BY gift_id, user_id)
+            LIMIT :batch_size
+        )
+    """)
+    if removed:
+        logging.info(f"Removed {removed} duplicate votes.")
+    create_index(connection, "uq_votes_gift_id_user_id", "votes", ["gift_id", "user_id"], unique=True)
+    create_index(connection, "ix_pairs_giver_id_year", "pairs", ["giver_id", "year"])
+    create_index(connection, "ix_gifts_created_for_id_year", "gifts", ["created_for_id", "year"])
+
+
+def _groups(connection: Connection):
+    create_tables(connection, ["user_groups", "memberships"])
+    add_column(connection, "pairs", "group_id", "INTEGER REFERENCES user_groups(id)")
+    add_column(connection, "gifts", "group_id", "INTEGER REFERENCES user_groups(id)")
+
+    # everything that exists so far belongs to one default group with all users except admin
+    connection.execute(text(
+        f"INSERT INTO user_groups (name) SELECT '{config.default_group_name}' "
+        f"WHERE NOT EXISTS (SELECT 1 FROM user_groups WHERE name = '{config.default_group_name}')"
+    ))
+    default_group_id = connection.execute(
+        text("SELECT id FROM user_groups WHERE name = :name"), {"name": config.default_group_name}
+    ).scalar_one()
+    connection.execute(text("""
+        INSERT INTO memberships (group_id, user_id)
+        SELECT :group_id, users.id FROM users
+        WHERE users.name != 'admin'
+          AND NOT EXISTS (SELECT 1 FROM memberships m WHERE m.group_id = :group_id AND m.user_id = users.id)
+    """), {"group_id": default_group_id})
+    for table in ("pairs", "gifts"):
+        run_in_batches(connection, f"""
+            UPDATE {table} SET group_id = :group_id WHERE id IN (
+                SELECT id FROM {table} WHERE group_id IS NULL LIMIT :batch_size
+            )
+        """, group_id=default_group_id)
+
+    create_index(connection, "uq_memberships_group_id_user_id", "memberships", ["group_id", "user_id"], unique=True)
+    create_index(connection, "ix_memberships_user_id", "memberships", ["user_id"])
+    create_index(connection, "ix_pairs_group_id_year", "pairs", ["group_id", "year"])
+    create_index(connection, "ix_gifts_group_id_year_created_for_id", "gifts", ["group_id", "year", "created_for_id"])
+
+
+# the exclusions that were hardcoded in pairing.py before rules were stored per group
+LEGACY_COUPLES = [("Max", "Anka"), ("Katharina", "Christoph"), ("Roswitha", "Jürgen")]
+
+
+def _exclusion_rules(connection: Connection):
+    create_tables(connection, ["exclusion_rules"])
+    add_column(connection, "user_groups", "history_years", "INTEGER NOT NULL DEFAULT 1")
+    add_column(connection, "memberships", "household", "VARCHAR")
+    create_index(connection, "uq_exclusion_rules_group_id_giver_id_receiver_id", "exclusion_rules",
+                 ["group_id", "giver_id", "receiver_id"], unique=True)
+
+    for giver_name, receiver_name in LEGACY_COUPLES:
+        connection.execute(text("""
+            INSERT INTO exclusion_rules (group_id, giver_id, receiver_id, mutual)
+            SELECT g.id, giver.id, receiver.id, :mutual
+            FROM user_groups g, users giver, users receiver
+            WHERE g.name = :group_name AND giver.name = :giver_name AND receiver.name = :receiver_name
+              AND NOT EXISTS (SELECT 1 FROM exclusion_rules r
+                              WHERE r.group_id = g.id AND r.giver_id = giver.id AND r.receiver_id = receiver.id)
+        """), {"mutual": True, "group_name": config.default_group_name,
+               "giver_name": giver_name, "receiver_name": receiver_name})
+
+
+def _pairing_runs(connection: Connection):
+    create_tables(connection, ["pairing_runs"])
+
+
+def _cache_versions(connection: Connection):
+    add_column(connection, "user_groups", "cache_version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _replace_guessable_tokens(connection: Connection):
+    # init_db seeded the user name (and "admin") as login token, the real tokens are set with backend.tokens
+    rows = connection.execute(text("SELECT id, name, token FROM users")).all()
+    guessable = [user_id for user_id, name, token in rows if is_guessable(name, token)]
+    for user_id in guessable:
+        connection.execute(text("UPDATE users SET token = :token WHERE id = :id"),
+                           {"token": new_token(), "id": user_id})
+    if guessable:
+        logging.warning(f"Replaced {len(guessable)} guessable login tokens, set the real ones with "
+                        f"python -m backend.tokens import or generate new ones with python -m backend.tokens generate")
+
+
+MIGRATIONS = [
+    Migration(1, "initial schema", _initial_schema),
+    Migration(2, "composite indexes for hot queries", _hot_query_indexes, transactional=False),
+    Migration(3, "groups and memberships", _groups, transactional=False),
+    Migration(4, "exclusion rules, households and history years", _exclusion_rules, transactional=False),
+    Migration(5, "pairing runs", _pairing_runs),
+    Migration(6, "response cache versions", _cache_versions),
+    Migration(7, "replace guessable login tokens", _replace_guessable_tokens),
+]
+
+
+def _ensure_migrations_table(engine: Engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} "
+            f"(version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at VARCHAR NOT NULL)"
+        ))
+
+
+def applied_versions(engine: Engine) -> set[int]:
+    _ensure_migrations_table(engine)
+    with engine.connect() as connection:
+        return {row[0] for row in connection.execute(text(f"SELECT version FROM {MIGRATIONS_TABLE}"))}
+
+
+def _record(connection: Connection, migration: Migration):
+    connection.execute(
+        text(f"INSERT INTO {MIGRATIONS_TABLE} (version, name, applied_at) VALUES (:version, :name, :applied_at)"),
+        {"version": migration.version, "name": migration.name,
+         "applied_at": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+    )
+
+
+def upgrade(engine: Engine, target: int = None, migrations: list[Migration] = None) -> list[Migration]:
+    """Applies all pending migrations up to target (default: all) in version order. Returns the applied ones."""
+    if migrations is None:
+        migrations = MIGRATIONS
+    done = applied_versions(engine)
+    applied = []
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version in done or (target is not None and migration.version > target):
+            continue
+        logging.info(f"Applying migration {migration.version}: {migration.name}")
+        if migration.transactional:
+            with engine.begin() as connection:
+                migration.upgrade(connection)
+                _record(connection, migration)
+        else:
+            with engine.connect() as connection:
+                migration.upgrade(connection.execution_options(isolation_level="AUTOCOMMIT"))
+            with engine.begin() as connection:
+                _record(connection, migration)
+        applied.append(migration)
+    return applied
+
+
+def status(engine: Engine, migrations: list[Migration] = None) -> list[tuple[Migration, bool]]:
+    """Returns each migration and whether it was applied."""
+    if migrations is None:
+        migrations = MIGRATIONS
+    done = applied_versions(engine)
+    return [(migration, migration.version in done) for migration in sorted(migrations, key=lambda m: m.version)]
+
+
+if __name__ == "__main__":
+    from backend.db import engine as default_engine
+
+    parser = argparse.ArgumentParser(description="Manage the database schema.")
+    parser.add_argument("command", choices=["upgrade", "status"])
+    parser.add_argument("--target", type=int, default=None, help="upgrade up to this version")
+    parser.add_argument("--database-url", default=None, help="defaults to the configured database")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    migration_engine = create_engine(args.database_url) if args.database_url else default_engine
+    if args.command == "upgrade":
+        for applied_migration in upgrade(migration_engine, target=args.target):
+            print(f"Applied {applied_migration.version}: {applied_migration.name}")
+    for listed_migration, is_applied in status(migration_engine):
+        print(f"{listed_migration.version:4d} {'applied' if is_applied else 'pending':8s} {listed_migration.name}")
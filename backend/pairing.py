@@ -1,72 +1,258 @@
 import datetime
+import logging
 import random
-from backend.db import SecretSantaPair
-from backend.db import User
+import time
+from dataclasses import dataclass, asdict
 
-forbidden_combinations = {
-    "Max": ["Anka"],
-    "Anka": ["Max"],
-    "Katharina": ["Christoph"],
-    "Christoph": ["Katharina"],
-    "Roswitha": ["Jürgen"],
-    "Jürgen": ["Roswitha"],
-}
+from sqlalchemy import delete, insert, update
 
+from backend import config
+from backend.db import PairingRun, SecretSantaPair
+from backend.exclusions import get_members_with_households, load_exclusions
+from backend.groups import get_group_by_name
+from backend.pairing_runs import (MODE_FULL, MODE_INCREMENTAL, SOLVER_NAME, get_latest_run, get_stored_pairs,
+                                  load_snapshot, new_seed, record_run, result_hash)
+from backend.pairing_solver import (PairingError, SolverStats, default_mixing_steps, solve_assignment,
+                                    splice_participant)
+from backend.response_cache import bump_statement
 
-def get_last_year_pairs(db, year: int):
-    return db.query(SecretSantaPair).filter(SecretSantaPair.year == year).all()
 
+@dataclass
+class PairingInput:
+    """Everything the solver needs for one group and year, plain data so it can be sent to another process."""
+    group_id: int
+    year: int
+    user_ids: list[int]
+    excluded: list[set[int]]  # indices into user_ids
+    allow_mutual: bool
 
-def create_secret_santa_pairs(db, allow_last_year_pairing: bool = False, allow_vice_versa: bool = False):
+
+@dataclass
+class SolveResult:
+    receiver_of: list[int]
+    seed: int
+    mixing_steps: int
+    stats: dict
+    started_at: float
+    duration_ms: float
+
+
+@dataclass
+class ReplayResult:
+    run_id: int
+    reproduced: bool  # replaying seed and snapshot gives the recorded result
+    matches_stored: bool  # the pairs in the database are the recorded result
+
+
+def load_pairing_input(db, group_id: int, year: int, allow_last_year_pairing: bool = False,
+                       allow_vice_versa: bool = False, history_years: int = None) -> PairingInput:
     """
-    This function gets all users that are not admin and creates secret santa pairs for them,
-    ensuring that no user is paired with themselves or with users in their forbidden list or with the same user as last year.
-    :return: Nothing, stores the pairs in the database.
+    Loads the members of the group and its exclusion rules, households and recent pairs as index sets.
+    history_years defaults to the group's setting, allow_last_year_pairing ignores the history completely.
+    """
+    members = get_members_with_households(db, group_id)
+    user_ids = [user_id for user_id, _, _ in members]
+    if allow_last_year_pairing:
+        history_years = 0
+    excluded = load_exclusions(db, group_id, year, user_ids, [household for _, _, household in members],
+                               history_years)
+    return PairingInput(group_id=group_id, year=year, user_ids=user_ids, excluded=excluded,
+                        allow_mutual=allow_vice_versa)
+
+
+def input_snapshot(pairing_input: PairingInput, mixing_steps: int) -> dict:
+    """The complete solver input as JSON compatible data, stored with the run so it can be replayed later."""
+    return {
+        "group_id": pairing_input.group_id,
+        "year": pairing_input.year,
+        "user_ids": pairing_input.user_ids,
+        "excluded": [sorted(receivers) for receivers in pairing_input.excluded],
+        "allow_mutual": pairing_input.allow_mutual,
+        "mixing_steps": mixing_steps,
+    }
+
+
+def solve_pairing(pairing_input: PairingInput, seed: int = None, mixing_steps: int = None) -> SolveResult:
     """
+    Solves the pairing with a generator seeded by seed (a new random seed if None), so the same input and seed
+    always give the same result. Runs in the batch pairing pool, so it must not touch the db.
+    """
+    if seed is None:
+        seed = new_seed()
+    if mixing_steps is None:
+        mixing_steps = default_mixing_steps(len(pairing_input.user_ids))
+    stats = SolverStats()
+    started_at = time.time()
+    start = time.perf_counter()
+    receiver_of = solve_assignment(len(pairing_input.user_ids), pairing_input.excluded,
+                                   allow_mutual=pairing_input.allow_mutual, rng=random.Random(seed),
+                                   mixing_steps=mixing_steps, stats=stats)
+    return SolveResult(receiver_of=receiver_of, seed=seed, mixing_steps=mixing_steps, stats=asdict(stats),
+                       started_at=started_at, duration_ms=(time.perf_counter() - start) * 1000)
+
+
+def _id_pairs(user_ids: list[int], receiver_of: list[int]) -> list[tuple[int, int]]:
+    return [(user_ids[giver], user_ids[receiver]) for giver, receiver in enumerate(receiver_of)]
+
+
+def save_pairs(db, pairing_input: PairingInput, result: SolveResult, replace: bool = False) -> PairingRun:
+    """
+    Writes all pairs of the group with one bulk insert, optionally replacing the existing pairs of that year,
+    and adds the audit record of the run. Does not commit, so the caller decides about the transaction.
+    """
+    if replace:
+        db.execute(delete(SecretSantaPair).where(SecretSantaPair.group_id == pairing_input.group_id,
+                                                 SecretSantaPair.year == pairing_input.year))
+    pairs = _id_pairs(pairing_input.user_ids, result.receiver_of)
+    db.execute(insert(SecretSantaPair), [{
+        "giver_id": giver_id,
+        "receiver_id": receiver_id,
+        "year": pairing_input.year,
+        "group_id": pairing_input.group_id,
+    } for giver_id, receiver_id in pairs])
+    db.execute(bump_statement(pairing_input.group_id))
+    return record_run(db, input_snapshot(pairing_input, result.mixing_steps), result.seed, MODE_FULL, pairs,
+                      result.stats, result.started_at, result.duration_ms)
+
+
+def create_secret_santa_pairs(db, group_id: int = None, allow_last_year_pairing: bool = False,
+                              allow_vice_versa: bool = False, seed: int = None, year: int = None) -> PairingRun:
+    """
+    This function gets all members of the group (default: the default group) and creates secret santa pairs for them,
+    ensuring that no user is paired with themselves, with users excluded by the group's rules or households
+    or with a receiver they had within the group's history years.
+    Many groups at once are better paired with backend.batch_pairing.
+    :param seed: seed of the run, a random one is drawn and recorded if not given
+    :return: the recorded run, the pairs are stored in the database.
+    :raises PairingError: if no valid pairing exists for the constraints.
+    """
+    if group_id is None:
+        group_id = get_group_by_name(db, config.default_group_name).id
+    if year is None:
+        year = datetime.datetime.now().year
+
+    pairing_input = load_pairing_input(db, group_id, year, allow_last_year_pairing, allow_vice_versa)
+    try:
+        result = solve_pairing(pairing_input, seed)
+    except PairingError as e:
+        logging.error(f"Failed to create valid Secret Santa pairs for group {group_id}: {e}")
+        raise
+
+    run = save_pairs(db, pairing_input, result)
+    db.commit()
+    logging.info(f"Created {len(result.receiver_of)} Secret Santa pairs for group {group_id} in {year} "
+                 f"(run {run.id}, seed {result.seed}, {result.duration_ms:.1f} ms)")
+    return run
+
+
+def add_late_participant(db, user_id: int, group_id: int = None, year: int = None, seed: int = None) -> PairingRun:
+    """
+    Adds a member who signed up after the pairing by splicing them into the existing assignment: one giver gets
+    the new member, who gets that giver's former receiver. All other pairs stay as they are.
+    :raises PairingError: if the member is already paired or no giver can take them, a full pairing is needed then.
+    """
+    if group_id is None:
+        group_id = get_group_by_name(db, config.default_group_name).id
+    if year is None:
+        year = datetime.datetime.now().year
+    if seed is None:
+        seed = new_seed()
+
+    existing = get_stored_pairs(db, group_id, year)
+    if not existing:
+        raise PairingError(f"Group {group_id} has no pairs in {year} yet.")
+    user_ids = [giver_id for giver_id, _ in existing]
+    if user_id in user_ids:
+        raise PairingError(f"User {user_id} is already paired in {year}.")
+    households = {member_id: household for member_id, _, household in get_members_with_households(db, group_id)}
+    if user_id not in households:
+        raise PairingError(f"User {user_id} is not a member of group {group_id}.")
+    user_ids.append(user_id)
+    index_of = {member_id: i for i, member_id in enumerate(user_ids)}
+    if any(receiver_id not in index_of for _, receiver_id in existing):
+        raise PairingError(f"The pairs of group {group_id} in {year} are not a closed assignment.")
+
+    snapshot = {
+        "group_id": group_id,
+        "year": year,
+        "user_ids": user_ids,
+        "excluded": [sorted(receivers) for receivers in load_exclusions(
+            db, group_id, year, user_ids, [households.get(member_id) for member_id in user_ids])],
+        "assignment": [index_of[receiver_id] for _, receiver_id in existing],
+    }
+    stats = SolverStats()
+    started_at = time.time()
+    start = time.perf_counter()
+    receiver_of = splice_participant(snapshot["assignment"], [set(e) for e in snapshot["excluded"]],
+                                     random.Random(seed), stats)
+    duration_ms = (time.perf_counter() - start) * 1000
+
+    giver_index = receiver_of.index(len(user_ids) - 1)
+    db.execute(update(SecretSantaPair)
+               .where(SecretSantaPair.group_id == group_id, SecretSantaPair.year == year,
+                      SecretSantaPair.giver_id == user_ids[giver_index])
+               .values(receiver_id=user_id))
+    db.add(SecretSantaPair(giver_id=user_id, receiver_id=user_ids[receiver_of[-1]], year=year, group_id=group_id))
+    db.execute(bump_statement(group_id))
+    parent = get_latest_run(db, group_id, year)
+    run = record_run(db, snapshot, seed, MODE_INCREMENTAL, _id_pairs(user_ids, receiver_of), asdict(stats),
+                     started_at, duration_ms, parent_run_id=parent.id if parent else None)
+    db.commit()
+    logging.info(f"Added user {user_id} to the pairs of group {group_id} in {year} (run {run.id}, seed {seed})")
+    return run
+
+
+def replay_run(db, run_id: int) -> ReplayResult:
+    """
+    Runs the solver again with the recorded seed and input snapshot and compares the result with the recorded one
+    and with the pairs currently stored (which only match for the latest run of a group and year).
+    :raises ValueError: if the run was made by another solver version or its snapshot was altered.
+    """
+    run = db.get(PairingRun, run_id)
+    if run is None:
+        raise ValueError(f"Pairing run {run_id} does not exist.")
+    if run.solver != SOLVER_NAME:
+        raise ValueError(f"Pairing run {run_id} was made by {run.solver}, it can only be replayed by that solver.")
+    snapshot = load_snapshot(run)
+    user_ids = snapshot["user_ids"]
+    excluded = [set(receivers) for receivers in snapshot["excluded"]]
+    if run.mode == MODE_INCREMENTAL:
+        receiver_of = splice_participant(snapshot["assignment"], excluded, random.Random(run.seed))
+    else:
+        pairing_input = PairingInput(group_id=snapshot["group_id"], year=snapshot["year"], user_ids=user_ids,
+                                     excluded=excluded, allow_mutual=snapshot["allow_mutual"])
+        receiver_of = solve_pairing(pairing_input, run.seed, snapshot["mixing_steps"]).receiver_of
+    return ReplayResult(
+        run_id=run.id,
+        reproduced=result_hash(_id_pairs(user_ids, receiver_of)) == run.result_hash,
+        matches_stored=result_hash(get_stored_pairs(db, run.group_id, run.year)) == run.result_hash,
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    from backend.db import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Create, extend or verify the secret santa pairs of a group.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    create_parser = subparsers.add_parser("create", help="pair the group")
+    create_parser.add_argument("--seed", type=int, default=None)
+    add_parser = subparsers.add_parser("add", help="splice a late participant into the existing pairs")
+    add_parser.add_argument("user_id", type=int)
+    add_parser.add_argument("--seed", type=int, default=None)
+    replay_parser = subparsers.add_parser("replay", help="verify a recorded run")
+    replay_parser.add_argument("run_id", type=int)
+    for sub in (create_parser, add_parser):
+        sub.add_argument("--group-id", type=int, default=None, help="defaults to the default group")
+        sub.add_argument("--year", type=int, default=None, help="defaults to the current year")
+    args = parser.parse_args()
 
-    users = db.query(User).filter(User.name != "admin").all()
-    user_names = [user.name for user in users]
-    name_to_user = {user.name: user for user in users}
-
-    current_year = datetime.datetime.now().year
-    last_year_pairs = get_last_year_pairs(db, current_year - 1)
-    last_year_dict = {pair.giver.name: pair.receiver.name for pair in last_year_pairs}
-
-    max_attempts = 1000
-    attempts = 0
-
-    while attempts < max_attempts:
-        attempts += 1
-        shuffled_names = user_names[:]
-        random.shuffle(shuffled_names)
-
-        valid = True
-        pairs = {}
-        for giver_name, receiver_name in zip(user_names, shuffled_names):
-            if giver_name == receiver_name:
-                valid = False
-            if receiver_name in forbidden_combinations.get(giver_name, []):
-                valid = False
-
-            if not allow_last_year_pairing and last_year_dict.get(giver_name) == receiver_name:
-                valid = False
-
-            if not allow_vice_versa and pairs.get(receiver_name) == giver_name:
-                valid = False
-
-            if not valid:
-                break
-            pairs[giver_name] = receiver_name
-
-        if valid:
-            for giver_name, receiver_name in pairs.items():
-                giver = name_to_user[giver_name]
-                receiver = name_to_user[receiver_name]
-                print(giver.name, "gets", receiver.name)
-                pair = SecretSantaPair(giver_id=giver.id, receiver_id=receiver.id, year=current_year)
-                db.add(pair)
-            db.commit()
-            print(f"Secret Santa pairs created successfully on try {attempts}")
-            return
-
-    print("Failed to create valid Secret Santa pairs after multiple attempts.")
+    logging.basicConfig(level=logging.INFO)
+    with SessionLocal() as session:
+        if args.command == "create":
+            create_secret_santa_pairs(session, group_id=args.group_id, seed=args.seed, year=args.year)
+        elif args.command == "add":
+            add_late_participant(session, args.user_id, group_id=args.group_id, year=args.year, seed=args.seed)
+        else:
+            replay = replay_run(session, args.run_id)
+            print(f"run {replay.run_id}: reproduced={replay.reproduced} matches_stored={replay.matches_stored}")
@@ -0,0 +1,75 @@
+# Audit records of pairing runs: seed, input snapshot and its hash, solver stats and timing
+import hashlib
+import json
+import secrets
+
+from sqlalchemy import select
+
+from backend.db import PairingRun, SecretSantaPair
+from backend.pairing_solver import SOLVER_VERSION
+
+MODE_FULL = "full"
+MODE_INCREMENTAL = "incremental"
+SOLVER_NAME = f"pairing_solver/{SOLVER_VERSION}"
+
+
+def new_seed() -> int:
+    # 63 bits, so it fits a signed BIGINT
+    return secrets.randbits(63)
+
+
+def canonical_json(data) -> str:
+    return json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def sha256_hex(data) -> str:
+    return hashlib.sha256(canonical_json(data).encode("utf-8")).hexdigest()
+
+
+def result_hash(pairs: list[tuple[int, int]]) -> str:
+    """Hash of the (giver id, receiver id) pairs, independent of their order."""
+    return sha256_hex(sorted([giver_id, receiver_id] for giver_id, receiver_id in pairs))
+
+
+def get_stored_pairs(db, group_id: int, year: int) -> list[tuple[int, int]]:
+    return [tuple(row) for row in db.execute(
+        select(SecretSantaPair.giver_id, SecretSantaPair.receiver_id)
+        .where(SecretSantaPair.group_id == group_id, SecretSantaPair.year == year)
+        .order_by(SecretSantaPair.giver_id)
+    ).all()]
+
+
+def get_latest_run(db, group_id: int, year: int) -> PairingRun | None:
+    return db.execute(
+        select(PairingRun).where(PairingRun.group_id == group_id, PairingRun.year == year)
+        .order_by(PairingRun.id.desc()).limit(1)
+    ).scalars().first()
+
+
+def record_run(db, snapshot: dict, seed: int, mode: str, pairs: list[tuple[int, int]], stats: dict,
+               started_at: float, duration_ms: float, parent_run_id: int = None) -> PairingRun:
+    """Adds the audit record of a run to the session, the caller commits it together with the pairs."""
+    run = PairingRun(
+        group_id=snapshot["group_id"],
+        year=snapshot["year"],
+        mode=mode,
+        parent_run_id=parent_run_id,
+        seed=seed,
+        solver=SOLVER_NAME,
+        input_hash=sha256_hex(snapshot),
+        input_snapshot=canonical_json(snapshot),
+        result_hash=result_hash(pairs),
+        stats=canonical_json(stats),
+        started_at=started_at,
+        duration_ms=round(duration_ms, 2),
+    )
+    db.add(run)
+    return run
+
+
+def load_snapshot(run: PairingRun) -> dict:
+    """Returns the stored input of the run, raises ValueError if it does not match the recorded hash."""
+    snapshot = json.loads(run.input_snapshot)
+    if sha256_hex(snapshot) != run.input_hash:
+        raise ValueError(f"Input snapshot of pairing run {run.id} does not match its hash.")
+    return snapshot
@@ -0,0 +1,356 @@
+"""
+Constraint solver for secret santa assignments.
+
+Participants are plain indices 0..n-1 and every giver has a set of receivers it must not get (itself included).
+The solver treats this as a bipartite graph givers -> receivers and finds a perfect matching with augmenting
+paths instead of shuffling until a valid permutation shows up. The found assignment is then randomized with a
+Markov chain of swap and rotation moves that only ever visits valid assignments, so the result is a (close to)
+uniformly random valid assignment.
+"""
+import math
+import random
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+
+# bump on every change that alters the result for the same input and seed, recorded with each pairing run
+SOLVER_VERSION = 3
+# start matchings tried before the exhaustive search decides, if mutual pairs can't be repaired
+MUTUAL_REPAIR_RESTARTS = 5
+# receiver checks the exhaustive search may spend before giving up with a PairingError
+EXACT_SEARCH_MAX_WORK = 5_000_000
+
+
+class PairingError(Exception):
+    """Raised when no valid secret santa assignment exists for the given constraints."""
+
+
+@dataclass
+class SolverStats:
+    """Counters of one solve_assignment call, to compare runs and spot regressions."""
+    greedy_matched: int = 0  # givers matched by the random start permutation
+    augmenting_paths: int = 0  # givers that needed an augmenting path search
+    visited_givers: int = 0  # givers visited by all augmenting path searches together
+    mutual_pairs_removed: int = 0
+    mixing_steps: int = 0
+    accepted_moves: int = 0  # mixing steps that changed the assignment
+    splice_candidates: int = 0  # givers a late participant could be spliced in after
+    restarts: int = 0  # new start matchings after the mutual pair repair failed
+    exact_search_nodes: int = 0  # assignments tried by the exhaustive search, only used if all restarts failed
+
+
+def _is_valid_move(receiver_of: list[int], excluded: list[set[int]], allow_mutual: bool,
+                   moves: dict[int, int]) -> bool:
+    """Checks if reassigning the givers in moves (giver -> new receiver) keeps the assignment valid."""
+    for giver, receiver in moves.items():
+        if receiver in excluded[giver]:
+            return False
+        if not allow_mutual and moves.get(receiver, receiver_of[receiver]) == giver:
+            return False
+    return True
+
+
+def _augment(start: int, receiver_of: list[int], giver_of: list[int], excluded: list[set[int]],
+             free_receivers: set[int], rng: random.Random, stats: SolverStats) -> bool:
+    """
+    Searches an augmenting path from the unmatched giver start with a BFS and flips it.
+    Returns False if there is none, which means no perfect matching exists.
+    """
+    n = len(receiver_of)
+    came_from = {start: None}  # giver -> giver that takes over its receiver
+    visited_receivers = set()
+    queue = deque([start])
+    while queue:
+        giver = queue.popleft()
+        stats.visited_givers += 1
+        free_candidates = [r for r in free_receivers if r not in excluded[giver]]
+        if free_candidates:
+            receiver = rng.choice(free_candidates)
+            free_receivers.discard(receiver)
+            # flip the path back to start
+            while giver is not None:
+                previous = receiver_of[giver]
+                receiver_of[giver] = receiver
+                giver_of[receiver] = giver
+                receiver = previous
+                giver = came_from[giver]
+            return True
+
+        offset = rng.randrange(n)
+        for i in range(n):
+            receiver = (offset + i) % n
+            if receiver in visited_receivers or receiver in excluded[giver]:
+                continue
+            visited_receivers.add(receiver)
+            owner = giver_of[receiver]
+            if owner not in came_from:
+                came_from[owner] = giver
+                queue.append(owner)
+    return False
+
+
+def _remove_mutual_pairs(receiver_of: list[int], excluded: list[set[int]], rng: random.Random,
+                         stats: SolverStats) -> bool:
+    """
+    Breaks up all a <-> b pairs by swapping receivers with another giver or, if no swap fits, by moving the
+    receivers along an alternating cycle through a or b. Returns False if a pair can't be broken up this way,
+    which doesn't mean that no assignment without mutual pairs exists.
+    """
+    n = len(receiver_of)
+    giver_of = [0] * n
+    for giver, receiver in enumerate(receiver_of):
+        giver_of[receiver] = giver
+    for giver in range(n):
+        receiver = receiver_of[giver]
+        if receiver_of[receiver] != giver:
+            continue
+        partners = [g for g in range(n) if g not in (giver, receiver)]
+        rng.shuffle(partners)
+        for partner in partners:
+            moves = {giver: receiver_of[partner], partner: receiver}
+            if _is_valid_move(receiver_of, excluded, False, moves):
+                break
+        else:
+            moves = (_find_alternating_cycle(receiver_of, giver_of, excluded, giver)
+                     or _find_alternating_cycle(receiver_of, giver_of, excluded, receiver))
+            if moves is None:
+                return False
+        for moved_giver, new_receiver in moves.items():
+            receiver_of[moved_giver] = new_receiver
+            giver_of[new_receiver] = moved_giver
+        stats.mutual_pairs_removed += 1
+    return True
+
+
+def _find_alternating_cycle(receiver_of: list[int], giver_of: list[int], excluded: list[set[int]],
+                            start: int) -> Optional[dict[int, int]]:
+    """
+    Searches givers start, g1, ..., gk where each giver takes the receiver of the next one and gk takes the receiver
+    of start, without creating a mutual pair. Breadth first, so the shortest cycles are tried first, and every giver
+    is expanded at most once, O(n^2) at worst. Returns the moves (giver -> new receiver) or None.
+    """
+    n = len(receiver_of)
+    came_from = {start: None}  # giver -> giver that takes over its receiver
+    queue = deque([start])
+    while queue:
+        giver = queue.popleft()
+        if giver != start and receiver_of[start] not in excluded[giver]:
+            moves = {giver: receiver_of[start]}
+            current = giver
+            while came_from[current] is not None:
+                moves[came_from[current]] = receiver_of[current]
+                current = came_from[current]
+            if _is_valid_move(receiver_of, excluded, False, moves):
+                return moves
+        for receiver in range(n):
+            if receiver not in excluded[giver] and giver_of[receiver] not in came_from:
+                came_from[giver_of[receiver]] = giver
+                queue.append(giver_of[receiver])
+    return None
+
+
+def _exact_assignment(excluded: list[set[int]], allow_mutual: bool, stats: SolverStats,
+                      max_work: int = EXACT_SEARCH_MAX_WORK) -> Optional[list[int]]:
+    """
+    Backtracking search over all assignments, always extending the giver with the fewest receivers left.
+    Only used after the repair failed. Avoiding mutual pairs is NP-complete in general (a cycle cover without
+    2-cycles), so the search is iterative and stops after max_work receiver checks.
+
+    :return: a valid assignment, or None if there is none
+    :raises PairingError: if the search exceeds max_work before deciding
+    """
+    n = len(excluded)
+    receiver_of = [-1] * n
+    giver_of = [-1] * n
+    work = 0
+
+    def branch() -> Optional[list]:
+        """[giver, receivers left, next index] for the most constrained unassigned giver, None if all are."""
+        nonlocal work
+        best = None
+        for giver in range(n):
+            if receiver_of[giver] != -1:
+                continue
+            work += n
+            options = [r for r in range(n) if giver_of[r] == -1 and r not in excluded[giver]
+                       and (allow_mutual or receiver_of[r] != giver)]
+            if best is None or len(options) < len(best[1]):
+                best = [giver, options, 0]
+                if not options:
+                    break
+        return best
+
+    stack = []
+    frame = branch()
+    while frame is not None:
+        stack.append(frame)
+        while stack:
+            giver, options, index = stack[-1]
+            if receiver_of[giver] != -1:
+                # take back the previous choice of this giver
+                giver_of[receiver_of[giver]] = -1
+                receiver_of[giver] = -1
+            if index == len(options):
+                stack.pop()
+                continue
+            if work > max_work:
+                raise PairingError("No assignment without mutual pairs found within the search limit, "
+                                   "the exclusions are too tight.")
+            stack[-1][2] += 1
+            receiver_of[giver], giver_of[options[index]] = options[index], giver
+            stats.exact_search_nodes += 1
+            break
+        else:
+            return None
+        frame = branch()
+    return receiver_of
+
+
+def _mix(receiver_of: list[int], excluded: list[set[int]], allow_mutual: bool, steps: int, rng: random.Random,
+         stats: SolverStats):
+    """
+    Randomizes a valid assignment with swap (two givers) and rotation (three givers) moves.
+    Invalid proposals are rejected, so the chain is symmetric and converges to the uniform distribution.
+    """
+    n = len(receiver_of)
+    if n < 3:
+        return
+    stats.mixing_steps += steps
+    # distinct random givers are drawn from random() directly, rng.sample and randrange dominated the run time
+    # (the bias of int(random() * n) is below 2 ** -53 and irrelevant here)
+    uniform = rng.random
+    for _ in range(steps):
+        a = int(uniform() * n)
+        b = int(uniform() * (n - 1))
+        b += b >= a
+        if uniform() < 0.5:
+            moves = {a: receiver_of[b], b: receiver_of[a]}
+        else:
+            c = int(uniform() * (n - 2))
+            for taken in sorted((a, b)):
+                c += c >= taken
+            moves = {a: receiver_of[b], b: receiver_of[c], c: receiver_of[a]}
+        if _is_valid_move(receiver_of, excluded, allow_mutual, moves):
+            for giver, receiver in moves.items():
+                receiver_of[giver] = receiver
+            stats.accepted_moves += 1
+
+
+def default_mixing_steps(n: int) -> int:
+    """Number of mixing steps used if not given explicitly, grows with n log n."""
+    return 4 * n * max(1, math.ceil(math.log2(n + 1)))
+
+
+def assignment_violations(receiver_of: list[int], excluded: list[set[int]], allow_mutual: bool = True) -> list[str]:
+    """Checks an assignment against all constraints, returns a description of every violation (empty if valid)."""
+    n = len(receiver_of)
+    violations = []
+    if sorted(receiver_of) != list(range(n)):
+        violations.append("receivers are not a permutation of the participants")
+    for giver, receiver in enumerate(receiver_of):
+        if not 0 <= receiver < n:
+            continue
+        if receiver == giver:
+            violations.append(f"participant {giver} draws themselves")
+        elif receiver in excluded[giver]:
+            violations.append(f"participant {giver} draws excluded participant {receiver}")
+        elif not allow_mutual and receiver_of[receiver] == giver and giver < receiver:
+            violations.append(f"participants {giver} and {receiver} draw each other")
+    return violations
+
+
+def splice_participant(receiver_of: list[int], excluded: list[set[int]], rng: random.Random,
+                       stats: Optional[SolverStats] = None) -> list[int]:
+    """
+    Adds the participant n - 1 to a valid assignment of the participants 0..n-2 without touching the rest:
+    a random giver g whose receiver r fits is changed to g -> new -> r, which never creates a mutual pair.
+
+    :param receiver_of: current assignment of the first n - 1 participants
+    :param excluded: excluded[g] for all n participants including the new one
+    :return: the new assignment of all n participants
+    :raises PairingError: if no giver can take the new participant, a full pairing is needed then
+    """
+    new = len(receiver_of)
+    excluded = [set(excluded[g]) | {g} for g in range(new + 1)]
+    candidates = [giver for giver, receiver in enumerate(receiver_of)
+                  if new not in excluded[giver] and receiver not in excluded[new]]
+    if not candidates:
+        raise PairingError(f"Participant {new} cannot be added to the existing assignment.")
+    giver = rng.choice(candidates)
+    if stats is not None:
+        stats.splice_candidates = len(candidates)
+    result = receiver_of + [receiver_of[giver]]
+    result[giver] = new
+    return result
+
+
+def _match(excluded: list[set[int]], rng: random.Random, stats: SolverStats) -> list[int]:
+    """
+    Finds a random perfect matching giver -> receiver, excluded already contains the givers themselves.
+    :raises PairingError: if no perfect matching exists
+    """
+    n = len(excluded)
+    # greedy start from a random permutation, most givers are matched here
+    receiver_of = [-1] * n
+    giver_of = [-1] * n
+    permutation = list(range(n))
+    rng.shuffle(permutation)
+    for giver, receiver in enumerate(permutation):
+        if receiver not in excluded[giver]:
+            receiver_of[giver] = receiver
+            giver_of[receiver] = giver
+    free_receivers = {r for r in range(n) if giver_of[r] == -1}
+    stats.greedy_matched = n - len(free_receivers)
+
+    for giver in range(n):
+        if receiver_of[giver] == -1:
+            stats.augmenting_paths += 1
+            if not _augment(giver, receiver_of, giver_of, excluded, free_receivers, rng, stats):
+                raise PairingError(f"No valid assignment exists, participant {giver} cannot be matched.")
+    return receiver_of
+
+
+def solve_assignment(n: int, excluded: list[set[int]], allow_mutual: bool = True,
+                     rng: Optional[random.Random] = None, mixing_steps: Optional[int] = None,
+                     stats: Optional[SolverStats] = None) -> list[int]:
+    """
+    Finds a random assignment giver -> receiver for n participants.
+
+    :param n: number of participants, identified by 0..n-1
+    :param excluded: excluded[g] holds the receivers giver g must not get, self pairing is always excluded
+    :param allow_mutual: whether a gives to b and b gives to a is allowed
+    :param rng: random generator to use, defaults to a freshly seeded one
+    :param mixing_steps: number of randomization steps, defaults to default_mixing_steps(n)
+    :param stats: filled with the counters of this run if given
+    :return: list with the receiver of each giver
+    :raises PairingError: if no valid assignment exists
+    """
+    if rng is None:
+        rng = random.Random()
+    if stats is None:
+        stats = SolverStats()
+    if n < 2:
+        raise PairingError("At least two participants are needed.")
+    if not allow_mutual and n < 3:
+        raise PairingError("At least three participants are needed if mutual pairs are not allowed.")
+
+    excluded = [set(excluded[g]) | {g} for g in range(n)]
+
+    receiver_of = _match(excluded, rng, stats)
+    if not allow_mutual and not _remove_mutual_pairs(receiver_of, excluded, rng, stats):
+        # the repair depends on the start matching, try a few others before searching exhaustively
+        for _ in range(MUTUAL_REPAIR_RESTARTS):
+            stats.restarts += 1
+            receiver_of = _match(excluded, rng, stats)
+            if _remove_mutual_pairs(receiver_of, excluded, rng, stats):
+                break
+        else:
+            receiver_of = _exact_assignment(excluded, allow_mutual, stats)
+            if receiver_of is None:
+                raise PairingError("No valid assignment without mutual pairs exists.")
+
+    if mixing_steps is None:
+        mixing_steps = default_mixing_steps(n)
+    _mix(receiver_of, excluded, allow_mutual, mixing_steps, rng, stats)
+    return receiver_of
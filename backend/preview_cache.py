@@ -0,0 +1,88 @@
+# Persistent cache of link previews in the database, keyed by normalized url
+import logging
+import time
+from dataclasses import dataclass
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from backend import config
+from backend.db import SessionLocal, LinkPreview
+
+TRACKING_PARAM_PREFIXES = ("utm_", "fbclid", "gclid", "ref_", "pd_rd_", "pf_rd_")
+
+
+@dataclass
+class CachedPreview:
+    image_url: str | None
+    preview_image_path: str | None
+
+    @property
+    def failed(self) -> bool:
+        return self.preview_image_path is None
+
+
+def normalize_url(url: str) -> str:
+    """Lowercases scheme and host, drops fragments, default ports and tracking parameters and sorts the query."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme, netloc.rsplit(":", 1)[-1]) in (("http", "80"), ("https", "443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if not key.lower().startswith(TRACKING_PARAM_PREFIXES))
+    return urlunsplit((scheme, netloc, parts.path or "/", urlencode(query), ""))
+
+
+def _preview_file_exists(preview_image_path: str) -> bool:
+    return (config.base_dir / preview_image_path).exists()
+
+
+def lookup(url: str) -> CachedPreview | None:
+    """
+    Returns the cached preview for the normalized url, None if there is no valid entry.
+    Entries whose image was deleted (e.g. by the garbage collection) count as missing.
+    """
+    db = SessionLocal()
+    try:
+        entry = db.query(LinkPreview).filter_by(url=url).first()
+    except SQLAlchemyError as e:
+        logging.warning(f"Link preview cache lookup failed: {e}")
+        return None
+    finally:
+        db.close()
+    if entry is None or entry.expires_at < time.time():
+        return None
+    if entry.preview_image_path and not _preview_file_exists(entry.preview_image_path):
+        return None
+    return CachedPreview(image_url=entry.image_url, preview_image_path=entry.preview_image_path)
+
+
+def store(url: str, image_url: str | None, preview_image_path: str | None):
+    """
+    Caches the preview for the normalized url. A missing preview_image_path is cached as failure, repeated
+    failures back off exponentially up to config.preview_failure_backoff_max_seconds.
+    """
+    now = time.time()
+    db = SessionLocal()
+    try:
+        entry = db.query(LinkPreview).filter_by(url=url).first()
+        if entry is None:
+            entry = LinkPreview(url=url, failures=0)
+            db.add(entry)
+        entry.image_url = image_url
+        entry.preview_image_path = preview_image_path
+        entry.fetched_at = now
+        if preview_image_path is None:
+            entry.failures = (entry.failures or 0) + 1
+            backoff = config.preview_failure_backoff_seconds * 2 ** (entry.failures - 1)
+            entry.expires_at = now + min(backoff, config.preview_failure_backoff_max_seconds)
+        else:
+            entry.failures = 0
+            entry.expires_at = now + config.preview_cache_ttl_seconds
+        db.commit()
+    except SQLAlchemyError as e:
+        db.rollback()
+        logging.warning(f"Storing link preview in cache failed: {e}")
+    finally:
+        db.close()
@@ -0,0 +1,114 @@
+# Content addressed storage for preview images below config.previews
+import argparse
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from backend import config
+from backend.db import Gift, SessionLocal
+
+IMAGE_SUFFIX = ".png"
+
+
+def path_for_digest(digest: str) -> Path:
+    """Images are sharded into sub directories by the first two hex digits of their hash."""
+    return config.previews / digest[:2] / f"{digest}{IMAGE_SUFFIX}"
+
+
+def url_for_path(path: Path) -> str:
+    """Returns the url (as stored in Gift.preview_image_path) for an image in the store."""
+    return config.previews_url + path.relative_to(config.previews).as_posix()
+
+
+def _write_atomic(path: Path, data: bytes):
+    """Writes to a temporary file first, so readers never see partial files."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+def store_image_bytes(data: bytes) -> Path:
+    """
+    Stores the encoded image under the hash of its content and returns its path.
+    Identical images are only written once.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = path_for_digest(digest)
+    if path.exists():
+        logging.info(f"Preview image {digest} already stored, reusing it.")
+        return path
+    _write_atomic(path, data)
+    return path
+
+
+def rendition_path(path: Path, suffix: str) -> Path:
+    """Renditions are stored next to their image as <digest>_<size>.<extension>."""
+    return path.with_name(f"{path.stem}_{suffix}")
+
+
+def store_renditions(path: Path, renditions: dict[str, bytes]):
+    """Stores the renditions of the image at path, existing ones are kept."""
+    for suffix, data in renditions.items():
+        target = rendition_path(path, suffix)
+        if not target.exists():
+            _write_atomic(target, data)
+
+
+def is_stored_url(preview_image_path: str | None) -> bool:
+    """Only images in the sharded store have renditions, not the default or legacy previews."""
+    if not preview_image_path or not preview_image_path.startswith(config.previews_url):
+        return False
+    return "/" in preview_image_path[len(config.previews_url):]
+
+
+def iter_stored_files():
+    """Yields all images and renditions in the sharded store, the flat previews folder is not managed by it."""
+    if not config.previews.exists():
+        return
+    for shard in config.previews.iterdir():
+        if shard.is_dir():
+            yield from (path for path in shard.iterdir() if path.is_file() and path.suffix != ".tmp")
+
+
+def collect_garbage(db, min_age_seconds: int = 60 * 60, dry_run: bool = False) -> list[Path]:
+    """
+    Deletes stored images (and their renditions) that are not referenced by any gift.
+    Images younger than min_age_seconds are kept, background preview jobs store the image before updating the gift.
+    :return: the deleted (or with dry_run the deletable) paths
+    """
+    referenced = {path for (path,) in db.query(Gift.preview_image_path).distinct() if path}
+    now = time.time()
+    orphans = []
+    for path in iter_stored_files():
+        digest = path.stem.split("_")[0]
+        if url_for_path(path_for_digest(digest)) in referenced or now - path.stat().st_mtime < min_age_seconds:
+            continue
+        orphans.append(path)
+        if not dry_run:
+            path.unlink(missing_ok=True)
+    logging.info(f"{'Found' if dry_run else 'Deleted'} {len(orphans)} orphaned preview images.")
+    return orphans
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Delete preview images no gift references anymore.")
+    parser.add_argument("--dry-run", action="store_true", help="only list the orphaned images")
+    parser.add_argument("--min-age", type=int, default=60 * 60, help="keep images younger than this (seconds)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    session = SessionLocal()
+    try:
+        for orphan in collect_garbage(session, min_age_seconds=args.min_age, dry_run=args.dry_run):
+            print(orphan)
+    finally:
+        session.close()
@@ -0,0 +1,91 @@
+# Background generation of link previews, so gift writes don't wait for external sites
+import logging
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from backend import config, events
+from backend.db import SessionLocal, Gift
+from backend.link_preview import preview_external_links
+from backend.response_cache import bump_statement
+
+PREVIEW_PENDING = "pending"
+PREVIEW_READY = "ready"
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=config.preview_workers, thread_name_prefix="preview")
+    return _executor
+
+
+def shutdown(wait: bool = False):
+    """Stops the worker pool, pending previews are picked up again by requeue_pending_previews on next start."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait, cancel_futures=True)
+        _executor = None
+
+
+def preview_status(gift: Gift) -> str:
+    """A gift with a link but without a preview image is still waiting for its preview."""
+    if gift.link and not gift.preview_image_path:
+        return PREVIEW_PENDING
+    return PREVIEW_READY
+
+
+def generate_preview(gift_id: int, link: str) -> str | None:
+    """
+    Fetches the preview for link and stores it on the gift. Skips the update if the gift was deleted
+    or its link changed in the meantime. Returns the stored preview path.
+    """
+    preview_image_path = preview_external_links(link)
+    db = SessionLocal()
+    try:
+        gift = db.query(Gift).filter_by(id=gift_id).first()
+        if gift is None or gift.link != link:
+            logging.info(f"Discarding preview for gift {gift_id}, gift was deleted or its link changed.")
+            return None
+        gift.preview_image_path = preview_image_path
+        if gift.group_id is not None:
+            db.execute(bump_statement(gift.group_id))
+        db.commit()
+        # imported here, gifts imports this module
+        from backend.gifts import get_renditions
+        data = {
+            "preview_image_path": preview_image_path or config.default_preview_image_path,
+            "preview_status": PREVIEW_READY,
+            "renditions": [rendition.model_dump() for rendition in get_renditions(preview_image_path)],
+        }
+        events.publish(*events.gift_event(events.PREVIEW_READY, gift.id, gift.group_id, gift.created_by_id,
+                                          gift.created_for_id, data))
+        return preview_image_path
+    finally:
+        db.close()
+
+
+def _log_failure(future: Future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Link preview generation failed: {future.exception()}")
+
+
+def schedule_preview(gift_id: int, link: str) -> Future:
+    """Queues the preview generation for a gift and returns immediately."""
+    future = get_executor().submit(generate_preview, gift_id, link)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def requeue_pending_previews():
+    """Queues all gifts whose preview was not generated, e.g. because the server restarted."""
+    db = SessionLocal()
+    try:
+        pending = db.query(Gift.id, Gift.link).filter(Gift.link.isnot(None), Gift.link != "",
+                                                      Gift.preview_image_path.is_(None)).all()
+    finally:
+        db.close()
+    for gift_id, link in pending:
+        schedule_preview(gift_id, link)
+    if pending:
+        logging.info(f"Requeued {len(pending)} pending link previews.")
@@ -0,0 +1,98 @@
+# Decoding and encoding of preview images in a process pool, so Pillow doesn't hold the GIL of the API workers
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO
+
+from PIL import Image
+
+from backend import config
+
+FORMAT_EXTENSIONS = {"webp": "webp", "jpeg": "jpg"}
+
+
+@dataclass
+class RenderedPreview:
+    png: bytes
+    renditions: dict[str, bytes]  # file name suffix like "320.webp" -> encoded image
+
+
+class ImageTooLargeError(Exception):
+    """Raised when an image has more pixels than allowed."""
+
+
+def rendition_suffix(size: int, image_format: str) -> str:
+    return f"{size}.{FORMAT_EXTENSIONS[image_format]}"
+
+
+def _encode(image: Image.Image, image_format: str) -> bytes:
+    buffer = BytesIO()
+    if image_format == "jpeg":
+        # jpeg has no alpha channel, put transparent images on white
+        if image.mode == "RGBA":
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        image.save(buffer, format="JPEG", quality=82, optimize=True, progressive=True)
+    else:
+        image.save(buffer, format="WEBP", quality=80, method=4)
+    return buffer.getvalue()
+
+
+def render_preview(data: bytes, max_pixels: int, thumbnail_size: int, sizes: tuple[int, ...],
+                   formats: tuple[str, ...]) -> RenderedPreview:
+    """
+    Decodes the downloaded image and encodes the PNG thumbnail and all renditions.
+    Runs inside the process pool, so it only gets plain arguments and no config.
+    """
+    # opening only reads the header, the pixels are decoded on load
+    image = Image.open(BytesIO(data))
+    if image.width * image.height > max_pixels:
+        raise ImageTooLargeError(f"{image.width}x{image.height} pixels")
+    size = (thumbnail_size, thumbnail_size)
+    # let the JPEG decoder scale down while decoding, then shrink to the thumbnail size
+    image.draft("RGB", size)
+    image.thumbnail(size)
+    # Convert to RGB if needed (e.g., for JPEG or palette images)
+    if image.mode in ("RGBA", "P", "LA"):
+        image = image.convert("RGBA")
+    else:
+        image = image.convert("RGB")
+
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+
+    renditions = {}
+    for rendition_size in sorted(sizes, reverse=True):
+        # sizes are shrunk from the previous (larger) rendition instead of the original
+        image.thumbnail((rendition_size, rendition_size))
+        for image_format in formats:
+            renditions[rendition_suffix(rendition_size, image_format)] = _encode(image, image_format)
+    return RenderedPreview(png=buffer.getvalue(), renditions=renditions)
+
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn instead of fork, the parent runs threads (preview workers, http pools)
+        _executor = ProcessPoolExecutor(max_workers=config.rendition_workers,
+                                        mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def render(data: bytes) -> RenderedPreview:
+    """Renders the preview in the process pool and waits for the result."""
+    future = get_executor().submit(render_preview, data, config.preview_max_image_pixels,
+                                   config.preview_thumbnail_size, config.preview_rendition_sizes,
+                                   config.preview_rendition_formats)
+    return future.result()
@@ -0,0 +1,108 @@
+# Cache of read heavy JSON responses with ETags, invalidated by a version counter per group
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Iterable
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.requests import Request
+from starlette.responses import Response
+
+from backend import config
+from backend.db import Group
+from backend.static_files import url_epoch
+
+# bump when the format of a cached response changes, so clients don't keep a stale body after a deploy
+ETAG_SCHEMA = 1
+
+# clients always revalidate, unchanged data then costs a 304 without body
+CACHE_CONTROL = "private, no-cache"
+
+
+def bump_statement(group_ids: int | Iterable[int]):
+    """
+    UPDATE that invalidates all cached responses of the groups. Write paths execute it in their own transaction,
+    so the new version is visible exactly when the data is.
+    """
+    if isinstance(group_ids, int):
+        group_ids = [group_ids]
+    group_ids = [group_id for group_id in group_ids if group_id is not None]
+    return update(Group).where(Group.id.in_(group_ids)).values(cache_version=Group.cache_version + 1)
+
+
+async def bump_version(db: AsyncSession, group_id: int | None):
+    if group_id is not None:
+        await db.execute(bump_statement(group_id))
+
+
+async def get_version(db: AsyncSession, group_id: int) -> int:
+    result = await db.execute(select(Group.cache_version).where(Group.id == group_id))
+    return result.scalar_one()
+
+
+class ResponseCache:
+    """LRU of serialized response bodies, each stored with the version it was built for."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, tuple[int, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, version: int) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: tuple, version: int, body: bytes):
+        with self._lock:
+            self._entries[key] = (version, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = ResponseCache(config.response_cache_max_entries)
+
+
+def make_etag(key: tuple, version: int) -> str:
+    """Strong ETag of a key and version, the same version always produces the same body."""
+    digest = hashlib.sha256(repr((ETAG_SCHEMA, key, version)).encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [value.strip() for value in if_none_match.split(",")]
+
+
+async def cached_json_response(request: Request, key: tuple, version: int,
+                               build: Callable[[], Awaitable[Any]]) -> Response:
+    """
+    Returns 304 if the client has the current version, the cached body if this worker built it already,
+    and otherwise builds, caches and returns it.
+    :param key: identifies the response, e.g. (endpoint, user id, group id, year)
+    :param build: coroutine function returning the response data, only called on a cache miss
+    """
+    # bodies contain signed preview urls, a new signing window needs a new body
+    key = (*key, url_epoch())
+    etag = make_etag(key, version)
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    body = cache.get(key, version)
+    if body is None:
+        body = json.dumps(jsonable_encoder(await build()), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        cache.put(key, version, body)
+    return Response(content=body, media_type="application/json", headers=headers)
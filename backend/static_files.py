@@ -0,0 +1,112 @@
+# Delivery of /static: signed preview urls, immutable cache headers and the handoff of the file to nginx
+import base64
+import hashlib
+import hmac
+import re
+import time
+from urllib.parse import parse_qs, quote
+
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles
+
+from backend import config, preview_store
+from backend.auth import get_session_secret
+
+# files of the preview store are named by the hash of their content, they never change
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# <shard>/<sha256>[_<rendition>].<extension> below previews/, relative to the static directory
+CONTENT_HASHED_PATH = re.compile(r"previews/[0-9a-f]{2}/[0-9a-f]{64}(_[0-9a-z.]+)?\.[a-z]+")
+
+DELIVERY_PYTHON = "python"  # uvicorn streams the file
+DELIVERY_X_ACCEL_REDIRECT = "x-accel-redirect"  # nginx streams it from an internal location
+DELIVERY_X_SENDFILE = "x-sendfile"  # apache/lighttpd stream it from the file system path
+
+SIGNATURE_BYTES = 16
+
+
+def _signing_key() -> bytes:
+    # derived from the session secret, so a url signature can never be used as a session signature
+    return hmac.new(get_session_secret(), b"static-url", hashlib.sha256).digest()
+
+
+def _signature(path: str, expires: int) -> str:
+    digest = hmac.new(_signing_key(), f"{path}\n{expires}".encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:SIGNATURE_BYTES]).rstrip(b"=").decode("ascii")
+
+
+def url_epoch(now: float = None) -> int:
+    """
+    Number of the current signing window, 0 without signing. Signed urls stay the same within a window,
+    so browsers keep hitting their cache, and cached responses containing urls are keyed by it.
+    """
+    if not config.static_url_signing:
+        return 0
+    return int((now if now is not None else time.time()) // config.static_url_ttl_seconds)
+
+
+def sign_url(url: str, now: float = None) -> str:
+    """
+    Appends expiry and signature to the url of a stored preview (as in Gift.preview_image_path) if signing is
+    enabled. The url expires at the end of the window after the current one, so it is valid for at least one ttl.
+    """
+    if not config.static_url_signing or not preview_store.is_stored_url(url):
+        return url
+    expires = (url_epoch(now) + 2) * config.static_url_ttl_seconds
+    path = url[len("static/"):]
+    return f"{url}?exp={expires}&sig={_signature(path, expires)}"
+
+
+def verify_signature(path: str, query_string: bytes, now: float = None) -> bool:
+    """Checks expiry and signature of a request for path, relative to the static directory."""
+    params = parse_qs(query_string.decode("latin-1"))
+    try:
+        expires = int(params["exp"][0])
+        signature = params["sig"][0]
+    except (KeyError, ValueError):
+        return False
+    if expires < (now if now is not None else time.time()):
+        return False
+    return hmac.compare_digest(signature, _signature(path, expires))
+
+
+def is_content_hashed(path: str) -> bool:
+    return CONTENT_HASHED_PATH.fullmatch(path) is not None
+
+
+class PreviewStaticFiles(StaticFiles):
+    """
+    StaticFiles for the preview store. Content hashed files are served with an immutable Cache-Control and,
+    with static_url_signing, only for a valid signature. With the x-accel-redirect or x-sendfile delivery
+    the response only carries the headers and the web server in front streams the file.
+    """
+
+    def __init__(self, *args, delivery: str = DELIVERY_PYTHON, accel_redirect_prefix: str = "/internal/static/",
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        if delivery not in (DELIVERY_PYTHON, DELIVERY_X_ACCEL_REDIRECT, DELIVERY_X_SENDFILE):
+            raise ValueError(f"Unknown static delivery: {delivery}")
+        self.delivery = delivery
+        self.accel_redirect_prefix = accel_redirect_prefix
+
+    async def get_response(self, path: str, scope) -> Response:
+        content_hashed = is_content_hashed(path)
+        if content_hashed and config.static_url_signing and \
+                not verify_signature(path, scope.get("query_string", b"")):
+            raise HTTPException(status_code=403)
+        response = await super().get_response(path, scope)
+        if content_hashed and response.status_code in (200, 304):
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        if isinstance(response, FileResponse) and self.delivery != DELIVERY_PYTHON:
+            return self._handoff(path, response)
+        return response
+
+    def _handoff(self, path: str, response: FileResponse) -> Response:
+        """Replaces the file body by the header telling the web server which file to send."""
+        headers = {name: value for name, value in response.headers.items()
+                   if name in ("cache-control", "etag", "last-modified")}
+        if self.delivery == DELIVERY_X_ACCEL_REDIRECT:
+            headers["X-Accel-Redirect"] = self.accel_redirect_prefix + quote(path)
+        else:
+            headers["X-Sendfile"] = str(response.path)
+        return Response(status_code=response.status_code, headers=headers, media_type=response.media_type)
@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+# the engines are created on import of backend.db, so the test database has to be configured first
+_database_dir = tempfile.mkdtemp(prefix="secretsanta-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_database_dir}/test.db"
+os.environ.setdefault("SESSION_SECRET", "test-secret")
+
+import pytest  # noqa: E402
+from starlette.testclient import TestClient  # noqa: E402
+
+from backend import migrations, response_cache  # noqa: E402
+from backend.auth import token_index  # noqa: E402
+from backend.db import Base, SessionLocal, engine  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    migrations.upgrade(engine)
+
+
+@pytest.fixture
+def db():
+    """Session on the test database, all rows are deleted after the test."""
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        with engine.begin() as connection:
+            for table in reversed(Base.metadata.sorted_tables):
+                connection.execute(table.delete())
+        response_cache.cache.clear()
+        token_index.invalidate()
+
+
+@pytest.fixture
+def client():
+    from backend.app import app
+
+    # without the context manager, so the lifespan (preview workers, event broker) is not started
+    return TestClient(app)
+
@@ -0,0 +1,41 @@
+# Helpers for the tests, imported by the test modules. conftest.py configures the test database before any of them.
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from starlette.testclient import TestClient
+
+from backend.auth import SESSION_COOKIE, Principal, create_session_token
+from backend.db import async_engine, engine
+
+
+def login(client: TestClient, user) -> TestClient:
+    """Sets a valid session cookie for the user (a User row or Principal) on the client."""
+    client.cookies.set(SESSION_COOKIE, create_session_token(Principal(id=user.id, name=user.name)))
+    return client
+
+
+class QueryCounter:
+    def __init__(self):
+        self.statements: list[str] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+
+@contextmanager
+def count_queries():
+    """Counts the statements executed by the sync and the async engine inside the block."""
+    counter = QueryCounter()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counter.statements.append(statement)
+
+    targets = [engine, async_engine.sync_engine]
+    for target in targets:
+        event.listen(target, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        for target in targets:
+            event.remove(target, "before_cursor_execute", before_cursor_execute)
@@ -0,0 +1,17 @@
+from backend.batch_pairing import STATUS_OK, STATUS_SKIPPED, run_batch
+from backend.db import Group, Membership, SecretSantaPair, User
+
+
+def test_groups_without_enough_members_are_skipped(db):
+    # like the default group that migration 3 creates on a new database
+    empty, family = Group(name="empty"), Group(name="family")
+    users = [User(name=name, token=f"token-{name}") for name in ("Anna", "Ben", "Carl", "Dora")]
+    db.add_all([empty, family, *users])
+    db.flush()
+    db.add_all([Membership(group_id=family.id, user_id=user.id) for user in users])
+    db.commit()
+
+    results = {result.group_name: result for result in run_batch([empty, family], [2030], workers=1)}
+    assert results["empty"].status == STATUS_SKIPPED
+    assert results["family"].status == STATUS_OK
+    assert db.query(SecretSantaPair).filter_by(group_id=family.id, year=2030).count() == 4
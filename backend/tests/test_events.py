@@ -0,0 +1,21 @@
+import importlib.util
+
+import pytest
+
+from backend.events import check_postgres_broker
+
+
+def test_postgres_broker_needs_a_postgres_database():
+    with pytest.raises(ValueError, match="postgresql DATABASE_URL"):
+        check_postgres_broker("sqlite:///santa.db")
+
+
+def test_postgres_broker_names_missing_drivers(monkeypatch):
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name: None)
+    with pytest.raises(ValueError, match="needs asyncpg, psycopg.*uv sync --extra postgres"):
+        check_postgres_broker("postgresql://santa@localhost/santa")
+
+
+def test_postgres_broker_with_installed_drivers(monkeypatch):
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name: object())
+    check_postgres_broker("postgresql://santa@localhost/santa")
@@ -0,0 +1,28 @@
+import datetime
+
+import pytest
+
+from backend.db import Gift, Group, Membership, User
+from backend.tests.helpers import login
+
+
+@pytest.fixture
+def family(db):
+    """Anna added a surprise gift for Ben, Carl is in another group."""
+    family, others = Group(name="family"), Group(name="others")
+    anna, ben, carl = (User(name=name, token=f"token-{name}") for name in ("Anna", "Ben", "Carl"))
+    db.add_all([family, others, anna, ben, carl])
+    db.flush()
+    db.add_all([Membership(group_id=family.id, user_id=anna.id), Membership(group_id=family.id, user_id=ben.id),
+                Membership(group_id=others.id, user_id=carl.id)])
+    gift = Gift(title="surprise", year=datetime.datetime.now().year, created_by_id=anna.id, created_for_id=ben.id,
+                group_id=family.id)
+    db.add(gift)
+    db.commit()
+    return {"anna": anna, "ben": ben, "carl": carl, "gift_id": gift.id}
+
+
+@pytest.mark.parametrize("user, status_code", [("anna", 200), ("ben", 404), ("carl", 404)])
+def test_gift_preview_is_hidden_from_receiver_and_other_groups(client, family, user, status_code):
+    response = login(client, family[user]).get(f"/api/gifts/{family['gift_id']}/preview")
+    assert response.status_code == status_code
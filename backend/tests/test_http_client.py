@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from backend import http_client, link_preview
+from backend.http_client import HttpClient
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers by path: /ok, /flaky (503 on the first request), /slow (waits longer than the client timeout)."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.client_address))
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        try:
+            if self.path == "/flaky" and sum(path == "/flaky" for path, _ in server.requests) == 1:
+                self._respond(503, b"unavailable")
+            else:
+                if self.path == "/slow":
+                    time.sleep(0.5)
+                self._respond(200, b"x" * 1000)
+        finally:
+            with server.lock:
+                server.running -= 1
+
+    def _respond(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.running = 0
+    server.max_running = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_connections_are_reused(stub_server):
+    client = HttpClient(retries=0)
+    for _ in range(5):
+        assert client.get(f"{stub_server.url}/ok").status_code == 200
+    # keep-alive: every request came over the same client socket
+    assert len({address for _, address in stub_server.requests}) == 1
+    client.close()
+
+
+def test_transient_errors_are_retried(stub_server):
+    client = HttpClient(retries=2)
+    response = client.get(f"{stub_server.url}/flaky")
+    assert response.status_code == 200
+    assert [path for path, _ in stub_server.requests] == ["/flaky", "/flaky"]
+    client.close()
+
+
+def test_timeout(stub_server):
+    client = HttpClient(timeout=0.1, retries=0)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.get(f"{stub_server.url}/slow")
+    client.close()
+
+
+def test_streamed_responses_hold_their_slot_until_closed(stub_server):
+    client = HttpClient(retries=0, max_concurrency=2)
+    first = client.get(f"{stub_server.url}/ok", stream=True)
+    second = client.get(f"{stub_server.url}/ok", stream=True)
+
+    third = []
+    waiting = threading.Thread(target=lambda: third.append(client.get(f"{stub_server.url}/ok")))
+    waiting.start()
+    waiting.join(0.3)
+    assert waiting.is_alive() and not third
+
+    with first:
+        first.content
+    waiting.join(2)
+    assert third and third[0].status_code == 200
+    second.close()
+    second.close()  # closing twice releases the slot only once
+    assert client._semaphore.acquire(blocking=False) and client._semaphore.acquire(blocking=False)
+    client.close()
+
+
+def test_concurrent_requests_are_bounded(stub_server):
+    client = HttpClient(retries=0, max_concurrency=2)
+    threads = [threading.Thread(target=client.get, args=(f"{stub_server.url}/slow",), kwargs={"timeout": 5})
+               for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stub_server.max_running == 2
+    client.close()
+
+
+def test_async_requests_share_the_bound_and_keep_the_loop_free(stub_server):
+    client = HttpClient(retries=0, max_concurrency=2)
+
+    async def requests_and_ticks():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        responses = await asyncio.gather(*(client.aget(f"{stub_server.url}/slow", timeout=5) for _ in range(4)))
+        ticker.cancel()
+        return responses, ticks
+
+    responses, ticks = asyncio.run(requests_and_ticks())
+    assert [response.status_code for response in responses] == [200] * 4
+    assert stub_server.max_running == 2
+    # two rounds of 0.5 s, the loop kept running meanwhile
+    assert ticks > 50
+    client.close()
+
+
+def test_cancelled_async_stream_releases_its_slot(stub_server):
+    client = HttpClient(retries=0, max_concurrency=1)
+
+    async def cancel_while_waiting():
+        task = asyncio.create_task(client.aget(f"{stub_server.url}/slow", timeout=5, stream=True))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_while_waiting())
+    # the request finishes in its worker thread and closes the response
+    assert client._semaphore.acquire(timeout=2)
+    client.close()
+
+
+def test_async_fetch_url_content(stub_server, monkeypatch):
+    client = HttpClient(retries=0)
+    monkeypatch.setattr(http_client, "get_client", lambda: client)
+    assert asyncio.run(link_preview.afetch_url_content(f"{stub_server.url}/ok")).content == b"x" * 1000
+    assert asyncio.run(link_preview.afetch_url_content("http://127.0.0.1:1/unreachable")) is None
+    client.close()
@@ -0,0 +1,29 @@
+from backend.link_preview import parse_html_for_image_url, read_capped
+
+
+class StubResponse:
+    def __init__(self, body: bytes, content_length: bool = True):
+        self.body = body
+        self.url = "https://shop.example/product"
+        self.headers = {"Content-Length": str(len(body))} if content_length else {}
+
+    def iter_content(self, chunk_size: int):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+
+LARGE_PAGE = (b'<html><head><meta property="og:image" content="/images/product.jpg"></head><body>'
+              + b"<p>reviews</p>" * 300_000 + b"</body></html>")
+
+
+def test_oversized_image_bodies_are_dropped():
+    assert read_capped(StubResponse(b"x" * 1000), 100) is None
+    assert read_capped(StubResponse(b"x" * 1000, content_length=False), 100) is None
+    assert read_capped(StubResponse(b"x" * 100), 100) == b"x" * 100
+
+
+def test_oversized_html_is_parsed_from_its_prefix():
+    max_bytes = 64 * 1024
+    html = read_capped(StubResponse(LARGE_PAGE), max_bytes, truncate=True)
+    assert len(html) == max_bytes
+    assert parse_html_for_image_url(html, "https://shop.example/product") == "https://shop.example/images/product.jpg"
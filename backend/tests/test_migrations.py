@@ -0,0 +1,55 @@
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+from backend import config, migrations
+from backend.db import Base
+
+
+@pytest.fixture
+def empty_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+    yield engine
+    engine.dispose()
+
+
+def test_migrated_schema_matches_models(empty_engine):
+    migrations.upgrade(empty_engine)
+    inspector = inspect(empty_engine)
+    for table in Base.metadata.sorted_tables:
+        assert {column["name"] for column in inspector.get_columns(table.name)} == set(table.columns.keys()), table.name
+        assert ({index["name"] for index in inspector.get_indexes(table.name)}
+                >= {index.name for index in table.indexes}), table.name
+
+
+def test_initial_schema_is_the_baseline(empty_engine):
+    migrations.upgrade(empty_engine, target=1)
+    inspector = inspect(empty_engine)
+    assert set(inspector.get_table_names()) == {"users", "pairs", "gifts", "votes", "link_previews",
+                                                 migrations.MIGRATIONS_TABLE}
+    assert "group_id" not in {column["name"] for column in inspector.get_columns("gifts")}
+
+
+def test_upgrade_of_baseline_database(empty_engine):
+    migrations.upgrade(empty_engine, target=1)
+    with empty_engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (id, name, token) VALUES (1, 'admin', 'admin'), "
+                                "(2, 'Max', 'Max'), (3, 'Anka', 'Anka')"))
+        connection.execute(text("INSERT INTO pairs (year, giver_id, receiver_id) VALUES (2025, 2, 3), (2025, 3, 2)"))
+        connection.execute(text("INSERT INTO gifts (title, year, created_by_id, created_for_id) VALUES ('a', 2025, 2, 3)"))
+        connection.execute(text("INSERT INTO votes (value, user_id, gift_id) VALUES (1, 2, 1), (-1, 2, 1)"))
+
+    migrations.upgrade(empty_engine)
+    with empty_engine.connect() as connection:
+        group_id = connection.execute(text("SELECT id FROM user_groups WHERE name = :name"),
+                                      {"name": config.default_group_name}).scalar_one()
+        members = connection.execute(text("SELECT user_id FROM memberships WHERE group_id = :group_id "
+                                          "ORDER BY user_id"), {"group_id": group_id}).scalars().all()
+        assert members == [2, 3]
+        assert connection.execute(text("SELECT COUNT(*) FROM pairs WHERE group_id IS NULL")).scalar_one() == 0
+        assert connection.execute(text("SELECT group_id FROM gifts")).scalar_one() == group_id
+        # the duplicate vote is removed before the unique index is built, the newest one is kept
+        assert connection.execute(text("SELECT value FROM votes")).scalars().all() == [-1]
+        assert connection.execute(text("SELECT history_years, cache_version FROM user_groups")).one() == (1, 0)
+        tokens = connection.execute(text("SELECT name, token FROM users")).all()
+        assert all(token != name for name, token in tokens)
+    assert all(applied for _, applied in migrations.status(empty_engine))
@@ -0,0 +1,88 @@
+import random
+
+import pytest
+
+from backend.benchmark_pairing import benchmark_size, has_valid_assignment, synthetic_exclusions
+from backend.pairing_solver import PairingError, SolverStats, _exact_assignment, assignment_violations, solve_assignment
+
+
+def random_instance(rng: random.Random, n: int, density: float) -> list[set[int]]:
+    return [{r for r in range(n) if r != g and rng.random() < density} for g in range(n)]
+
+
+def isolated_group(n: int, members: list[int], group_excluded: list[set[int]]) -> list[set[int]]:
+    """n participants, members only give to each other with group_excluded (by position), the rest to everyone else."""
+    excluded = [set(members) for _ in range(n)]
+    for i, member in enumerate(members):
+        excluded[member] = set(range(n)) - set(members) | {members[j] for j in group_excluded[i]}
+    return excluded
+
+
+def test_couples_with_history_edge_without_mutual_pairs():
+    # two couples and one history edge, (2, 3, 1, 0) is the only valid assignment
+    excluded = [{1}, {0, 2}, {3}, {2}]
+    for seed in range(200):
+        assert solve_assignment(4, excluded, allow_mutual=False, rng=random.Random(seed)) == [2, 3, 1, 0]
+
+
+@pytest.mark.parametrize("allow_mutual", [True, False])
+def test_solver_agrees_with_brute_force(allow_mutual):
+    rng = random.Random(1)
+    for _ in range(1500):
+        n = rng.randint(3, 6)
+        excluded = random_instance(rng, n, rng.choice([0.2, 0.3, 0.5]))
+        seed = rng.randrange(2 ** 32)
+        if has_valid_assignment(n, excluded, allow_mutual):
+            receiver_of = solve_assignment(n, excluded, allow_mutual=allow_mutual, rng=random.Random(seed))
+            assert assignment_violations(receiver_of, excluded, allow_mutual) == []
+        else:
+            with pytest.raises(PairingError):
+                solve_assignment(n, excluded, allow_mutual=allow_mutual, rng=random.Random(seed))
+
+
+@pytest.mark.parametrize("allow_mutual", [True, False])
+@pytest.mark.parametrize("couples", [True, False])
+def test_solver_properties_on_synthetic_groups(allow_mutual, couples):
+    rng = random.Random(2)
+    for _ in range(300):
+        n = rng.randint(3, 7)
+        excluded = synthetic_exclusions(n, rng.choice([0.1, 0.3, 0.5]), n, couples, rng)
+        try:
+            receiver_of = solve_assignment(n, excluded, allow_mutual=allow_mutual, rng=random.Random(rng.random()))
+        except PairingError:
+            assert not has_valid_assignment(n, excluded, allow_mutual), excluded
+            continue
+        assert sorted(receiver_of) == list(range(n))
+        for giver, receiver in enumerate(receiver_of):
+            assert receiver != giver
+            assert receiver not in excluded[giver]
+            if not allow_mutual:
+                assert receiver_of[receiver] != giver
+
+
+def test_benchmark_separates_infeasible_groups_from_false_negatives():
+    result = benchmark_size(6, 200, 0.3, 50, couples=True, allow_mutual=False, seed=0)
+    assert result["infeasible_rate"] > 0
+    assert result["false_negatives"] == 0
+    assert result["invalid"] == 0
+
+
+def test_forced_group_in_a_large_assignment():
+    # the couples of the test above as a closed group among 1500 participants, only [2, 3, 1, 0] fits the group
+    excluded = isolated_group(1500, [0, 1, 2, 3], [{1}, {0, 2}, {3}, {2}])
+    for seed in range(30):
+        receiver_of = solve_assignment(1500, excluded, allow_mutual=False, rng=random.Random(seed), mixing_steps=0)
+        assert receiver_of[:4] == [2, 3, 1, 0]
+        assert assignment_violations(receiver_of, excluded, allow_mutual=False) == []
+
+
+def test_forced_mutual_pair_in_a_large_assignment_fails():
+    excluded = isolated_group(1500, [0, 1], [set(), set()])
+    with pytest.raises(PairingError):
+        solve_assignment(1500, excluded, allow_mutual=False, rng=random.Random(0), mixing_steps=0)
+
+
+def test_exact_search_gives_up_after_its_work_limit():
+    excluded = [set() for _ in range(30)]
+    with pytest.raises(PairingError, match="search limit"):
+        _exact_assignment(excluded, allow_mutual=False, stats=SolverStats(), max_work=1000)
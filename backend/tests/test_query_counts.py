@@ -0,0 +1,72 @@
+import datetime
+
+from backend import response_cache
+from backend.db import Gift, Group, Membership, SecretSantaPair, User, Vote
+from backend.tests.helpers import count_queries, login
+
+GROUP_SIZES = (3, 12)
+
+
+def seed_group(db, name: str, size: int) -> tuple[Group, list[User]]:
+    """A group with a closed pairing for the current year, two gifts per member and votes on all of them."""
+    year = datetime.datetime.now().year
+    group = Group(name=name)
+    users = [User(name=f"{name}-{i}", token=f"{name}-token-{i}") for i in range(size)]
+    db.add_all([group, *users])
+    db.flush()
+    for i, user in enumerate(users):
+        receiver = users[(i + 1) % size]
+        db.add(Membership(group_id=group.id, user_id=user.id))
+        db.add(SecretSantaPair(giver_id=user.id, receiver_id=receiver.id, year=year, group_id=group.id))
+        db.add(Gift(title="own", year=year, created_by_id=user.id, created_for_id=user.id, group_id=group.id))
+        db.add(Gift(title="surprise", year=year, created_by_id=receiver.id, created_for_id=user.id,
+                    group_id=group.id))
+    db.flush()
+    for gift in db.query(Gift).filter(Gift.group_id == group.id):
+        db.add(Vote(user_id=users[0].id, gift_id=gift.id, value=1))
+    db.commit()
+    return group, users
+
+
+def queries_per_group_size(db, client, path: str, as_admin: bool = False) -> dict[int, int]:
+    """Requests path for groups of GROUP_SIZES (without cached responses) and counts the statements."""
+    admin = None
+    if as_admin:
+        admin = User(name="admin", token="admin-test-token")
+        db.add(admin)
+        db.commit()
+    counts = {}
+    for size in GROUP_SIZES:
+        group, users = seed_group(db, f"group{size}", size)
+        login(client, admin or users[0])
+        response_cache.cache.clear()
+        with count_queries() as counter:
+            response = client.get(path, params={"group_id": group.id})
+        assert response.status_code == 200, response.text
+        counts[size] = counter.count
+    return counts
+
+
+def test_gift_lists_query_count_is_constant(db, client):
+    counts = queries_per_group_size(db, client, "/api/gift-lists")
+    assert len(set(counts.values())) == 1, counts
+
+
+def test_gift_lists_contain_all_members(db, client):
+    group, users = seed_group(db, "family", 4)
+    lists = login(client, users[0]).get("/api/gift-lists", params={"group_id": group.id}).json()
+    # the receiver's list comes first, then the own one
+    assert [gift_list["username"] for gift_list in lists][:2] == [users[1].name, users[0].name]
+    # the surprise gift for users[0] is hidden from them
+    assert [gift["title"] for gift in lists[1]["gifts"]] == ["own"]
+    assert len(lists) == 4
+
+
+def test_receiver_query_count_is_constant(db, client):
+    counts = queries_per_group_size(db, client, "/api/receiver")
+    assert len(set(counts.values())) == 1, counts
+
+
+def test_pairing_query_count_is_constant(db, client):
+    counts = queries_per_group_size(db, client, "/api/pairing", as_admin=True)
+    assert len(set(counts.values())) == 1, counts
@@ -0,0 +1,64 @@
+import pytest
+
+from backend import migrations
+from backend.bulk_import import BulkImportError, import_users
+from backend.db import User, engine
+from backend.tests.helpers import login
+from backend.tokens import is_guessable, set_user_tokens
+
+
+def test_migration_replaces_guessable_tokens(db):
+    db.add_all([User(name="admin", token="admin"), User(name="Max", token="Max"), User(name="Anka", token=None),
+                User(name="Jürgen", token="daddyCool-8b3f")])
+    db.commit()
+    with engine.begin() as connection:
+        migrations._replace_guessable_tokens(connection)
+    db.expire_all()
+    tokens = {user.name: user.token for user in db.query(User)}
+    assert tokens["Jürgen"] == "daddyCool-8b3f"
+    assert not any(is_guessable(name, token) for name, token in tokens.items())
+    assert len(set(tokens.values())) == 4
+
+
+def test_guessable_tokens_do_not_log_in(db, client):
+    db.add_all([User(name="admin", token="admin"), User(name="Max", token="Max")])
+    db.commit()
+    with engine.begin() as connection:
+        migrations._replace_guessable_tokens(connection)
+    assert client.get("/api/healthcheck", params={"token": "admin"}, follow_redirects=False).status_code == 401
+    assert client.get("/api/healthcheck", params={"token": "Max"}, follow_redirects=False).status_code == 401
+
+    set_user_tokens(db, {"Max": "numberone-4d2c"})
+    response = client.get("/api/healthcheck", params={"token": "numberone-4d2c"}, follow_redirects=False)
+    assert response.status_code == 307
+
+
+def test_set_user_tokens_refuses_guessable_tokens(db):
+    db.add(User(name="Max", token="numberone-4d2c"))
+    db.commit()
+    with pytest.raises(ValueError):
+        set_user_tokens(db, {"Max": "Max"})
+
+
+def test_login_sets_session(db, client):
+    db.add(User(name="admin", token="long-random-admin-token"))
+    db.commit()
+    response = client.get("/api/users", params={"token": "long-random-admin-token"}, follow_redirects=False)
+    assert response.status_code == 307
+    assert "APP_SESSION" in response.headers["set-cookie"]
+    assert login(client, db.query(User).one()).get("/api/auth").json()["username"] == "admin"
+
+
+def test_bulk_import_refuses_guessable_tokens(db):
+    db.add(User(name="Max", token="numberone-4d2c"))
+    db.commit()
+    for token in ("Max", "admin"):
+        with pytest.raises(BulkImportError, match="Max"):
+            import_users(engine, [{"name": "Anka", "token": "sweety-9a1e"}, {"name": "Max", "token": token}])
+    assert [(user.name, user.token) for user in db.query(User)] == [("Max", "numberone-4d2c")]
+
+    import_users(engine, [{"name": "Max", "token": "numberone-77f0"}, {"name": "Anka"}])
+    db.expire_all()
+    tokens = {user.name: user.token for user in db.query(User)}
+    assert tokens["Max"] == "numberone-77f0"
+    assert not is_guessable("Anka", tokens["Anka"])
@@ -0,0 +1,78 @@
+# Login tokens of the users (users.token), run with: python -m backend.tokens import tokens.json
+import argparse
+import csv
+import json
+import secrets
+from pathlib import Path
+
+from sqlalchemy.orm import Session
+
+from backend.db import User
+
+TOKEN_BYTES = 16
+
+
+def new_token() -> str:
+    return secrets.token_urlsafe(TOKEN_BYTES)
+
+
+def is_guessable(name: str, token: str | None) -> bool:
+    """The tokens earlier versions seeded: the user's name, "admin" or none at all."""
+    return not token or token == name or token == "admin"
+
+
+def read_tokens(path: Path) -> dict[str, str]:
+    """Reads user name -> token from a JSON object or a CSV file with the columns name,token."""
+    if path.suffix.lower() == ".json":
+        with open(path, encoding="utf-8") as json_file:
+            return dict(json.load(json_file))
+    with open(path, encoding="utf-8", newline="") as csv_file:
+        return {row["name"]: row["token"] for row in csv.DictReader(csv_file)}
+
+
+def set_user_tokens(db: Session, tokens: dict[str, str]) -> list[str]:
+    """
+    Sets the login tokens (user name -> token) of existing users, the app authenticates against users.token.
+    Guessable tokens are refused. Returns the names of the updated users, commits.
+    """
+    for name, token in tokens.items():
+        if is_guessable(name, token):
+            raise ValueError(f"The token of user '{name}' is guessable.")
+    users = db.query(User).filter(User.name.in_(tokens.keys())).all()
+    for user in users:
+        user.token = tokens[user.name]
+    db.commit()
+    return [user.name for user in users]
+
+
+def generate_tokens(db: Session, names: list[str] = None) -> dict[str, str]:
+    """Gives the users (all users if names is None) new random tokens and returns them by name, commits."""
+    query = db.query(User)
+    if names is not None:
+        query = query.filter(User.name.in_(names))
+    tokens = {}
+    for user in query.order_by(User.name):
+        user.token = new_token()
+        tokens[user.name] = user.token
+    db.commit()
+    return tokens
+
+
+if __name__ == "__main__":
+    from backend.db import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Set or generate the login tokens of users.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="write existing tokens (JSON name -> token or CSV name,token)")
+    import_parser.add_argument("path", type=Path)
+    generate_parser = subparsers.add_parser("generate", help="give users new random tokens and print them")
+    generate_parser.add_argument("names", nargs="*", help="defaults to all users")
+    args = parser.parse_args()
+
+    with SessionLocal() as session:
+        if args.command == "import":
+            updated = set_user_tokens(session, read_tokens(args.path))
+            print(f"Tokens of {len(updated)} users updated.")
+        else:
+            for user_name, user_token in generate_tokens(session, args.names or None).items():
+                print(f"{user_name}\t{user_token}")
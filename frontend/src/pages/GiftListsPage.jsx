@@ -17,18 +17,62 @@ const GiftListsPage = () => {
   const listRef = useRef(null);
   const swipeContainerRef = useRef(null);
 
-  useEffect(() => {
+  const loadGiftLists = (resetActiveUser) => {
     fetch('./api/gift-lists')
       .then(res => res.json())
       .then(data => {
         if (Array.isArray(data)) {
           setUsers(data);
-          setActiveUserIdx(0);
+          if (resetActiveUser) setActiveUserIdx(0);
         } else {
           setUsers([]);
         }
       })
       .catch(() => setUsers([]));
+  };
+
+  useEffect(() => {
+    loadGiftLists(true);
+  }, []);
+
+  // Patch the lists with the pushed changes instead of fetching them again
+  useEffect(() => {
+    if (typeof EventSource === 'undefined') return undefined;
+    const source = new EventSource('./api/events');
+    let connected = false;
+    const updateGift = (data, update) => {
+      setUsers(users => users.map(u =>
+        u.pk === data.created_for_id ? {
+          ...u,
+          gifts: u.gifts.map(g => g.pk === data.gift_id ? { ...g, ...update } : g)
+        } : u
+      ));
+    };
+    const listeners = {
+      // sent on every (re)connect, events may have been missed in between
+      resync: () => {
+        if (connected) loadGiftLists(false);
+        connected = true;
+      },
+      gift_added: (data) => setUsers(users => users.map(u =>
+        u.pk === data.created_for_id && !u.gifts.some(g => g.pk === data.gift_id)
+          ? { ...u, gifts: [data.gift, ...u.gifts] } : u
+      )),
+      gift_updated: (data) => updateGift(data, data.gift),
+      gift_deleted: (data) => setUsers(users => users.map(u =>
+        u.pk === data.created_for_id ? { ...u, gifts: u.gifts.filter(g => g.pk !== data.gift_id) } : u
+      )),
+      vote_changed: (data) => updateGift(data, { votes: data.votes }),
+      preview_ready: (data) => updateGift(data, {
+        preview_image_path: data.preview_image_path,
+        preview_status: data.preview_status,
+        renditions: data.renditions
+      }),
+    };
+    Object.entries(listeners).forEach(([type, handler]) => {
+      source.addEventListener(type, e => handler(JSON.parse(e.data)));
+    });
+    return () => source.close();
   }, []);
 
   const getCurrentUserFromCookie = () => {